@@ -1,5 +1,7 @@
 import { type NextRequest, NextResponse } from "next/server"
 
+const PIPELINE_WORKER_URL = process.env.PIPELINE_WORKER_URL || "http://127.0.0.1:8765"
+
 export async function POST(request: NextRequest) {
   try {
     const { sampleId, sequenceFiles, documentFiles, analysisType } = await request.json()
@@ -19,30 +21,41 @@ export async function POST(request: NextRequest) {
       documentAnalysisResults = await processDocuments(documentFiles)
     }
 
-    // Process sequence files if available
-    let sequenceAnalysisResults = null
-    if (sequenceFiles && sequenceFiles.length > 0) {
-      console.log(`[v0] Processing ${sequenceFiles.length} sequence files`)
-      sequenceAnalysisResults = await processSequenceFiles(sequenceFiles)
+    // Document-only submissions have nothing to queue on the worker
+    if (!sequenceFiles || sequenceFiles.length === 0) {
+      return NextResponse.json({
+        success: true,
+        runId,
+        sampleId,
+        status: "completed",
+        documentAnalysis: documentAnalysisResults,
+        timestamp: new Date().toISOString(),
+        message: "Document analysis completed",
+      })
     }
 
-    const pipelineResults = await processMlPipeline(
-      sampleId,
-      sequenceAnalysisResults,
-      documentAnalysisResults,
-      analysisType,
+    // Queue the analysis on the resident Python worker (scripts/pipeline_worker.py) and return at once;
+    // clients poll GET /api/ml-pipeline?runId=... for progress
+    const job = await queuePipelineJob(runId, sampleId, sequenceFiles, analysisType)
+
+    return NextResponse.json(
+      {
+        success: true,
+        runId: job.runId,
+        sampleId,
+        status: job.status,
+        progress: job.progress,
+        documentAnalysis: documentAnalysisResults,
+        timestamp: new Date().toISOString(),
+        message: "ML pipeline queued successfully",
+      },
+      { status: 202 },
     )
-
-    return NextResponse.json({
-      success: true,
-      runId,
-      sampleId,
-      results: pipelineResults,
-      timestamp: new Date().toISOString(),
-      message: "ML pipeline started successfully",
-    })
   } catch (error) {
     console.error("[v0] ML Pipeline error:", error)
+    if (error instanceof WorkerUnavailableError) {
+      return NextResponse.json({ error: error.message }, { status: 503 })
+    }
     return NextResponse.json({ error: "Pipeline processing failed" }, { status: 500 })
   }
 }
@@ -55,10 +68,16 @@ export async function GET(request: NextRequest) {
     return NextResponse.json({ error: "Run ID required" }, { status: 400 })
   }
 
-  // Get pipeline status
-  const status = await getPipelineStatus(runId)
-
-  return NextResponse.json(status)
+  try {
+    const status = await getPipelineStatus(runId)
+    if (!status) {
+      return NextResponse.json({ error: "Unknown run ID" }, { status: 404 })
+    }
+    return NextResponse.json(status)
+  } catch (error) {
+    console.error("[v0] ML Pipeline status error:", error)
+    return NextResponse.json({ error: "Pipeline worker unavailable" }, { status: 503 })
+  }
 }
 
 async function processDocuments(documentFiles: any[]) {
@@ -83,140 +102,50 @@ async function processDocuments(documentFiles: any[]) {
   return documentResults
 }
 
-async function processSequenceFiles(sequenceFiles: any[]) {
-  console.log("[v0] Starting sequence analysis")
-
-  // Simulate sequence processing
-  const totalSequences = sequenceFiles.reduce((acc, file) => acc + (file.sequenceCount || 500), 0)
+class WorkerUnavailableError extends Error {}
 
-  const sequenceResults = {
-    totalFiles: sequenceFiles.length,
-    totalSequences,
-    processedSequences: Math.floor(totalSequences * 0.95),
-    qualityFilteredSequences: Math.floor(totalSequences * 0.85),
-    averageQualityScore: 28.5 + Math.random() * 5,
-    averageSequenceLength: 450 + Math.random() * 100,
-    processingTime: 45.2,
+async function workerRequest(path: string, init?: RequestInit) {
+  try {
+    return await fetch(`${PIPELINE_WORKER_URL}${path}`, { ...init, cache: "no-store" })
+  } catch (error) {
+    throw new WorkerUnavailableError(`Pipeline worker unreachable at ${PIPELINE_WORKER_URL}`)
   }
-
-  console.log("[v0] Sequence analysis completed")
-  return sequenceResults
 }
 
-async function processMlPipeline(sampleId: string, sequenceResults: any, documentResults: any, analysisType: string) {
-  console.log(`[v0] Running comprehensive ML analysis for ${analysisType}`)
-
-  // Combine results from both sequence and document analysis
-  const combinedSpecies = new Set()
-
-  // Add species from sequence analysis (simulated)
-  const sequenceSpecies = [
-    "Gadus morhua",
-    "Calanus finmarchicus",
-    "Mytilus edulis",
-    "Pleuronectes platessa",
-    "Fucus vesiculosus",
-    "Asterias rubens",
-  ]
-  sequenceSpecies.forEach((species) => combinedSpecies.add(species))
-
-  // Add species from document analysis
-  if (documentResults?.extractedSpecies) {
-    documentResults.extractedSpecies.forEach((species: any) => combinedSpecies.add(species.name))
+async function queuePipelineJob(runId: string, sampleId: string, sequenceFiles: any[], analysisType: string) {
+  const response = await workerRequest("/jobs", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      run_id: runId,
+      sample_id: sampleId,
+      analysis_type: analysisType,
+      // The worker resolves paths inside its --upload-root, so send them relative to the uploads directory
+      sequence_files: sequenceFiles
+        .map((file: any) => (typeof file === "string" ? file : file.storagePath))
+        .map((path: string) => path.replace(/^\/?uploads\//, "")),
+      options: { dereplicate: true, quality_filter: true },
+    }),
+  })
+
+  if (!response.ok) {
+    const { error } = await response.json()
+    throw new Error(error || "Pipeline worker rejected the job")
   }
 
-  const mlResults = {
-    analysisType,
-    sampleId,
-    runId: `ML_${Date.now()}`,
-
-    // Sequence analysis results
-    sequenceAnalysis: sequenceResults || {
-      message: "No sequence files provided",
-    },
-
-    // Document analysis results
-    documentAnalysis: documentResults || {
-      message: "No documents provided",
-    },
-
-    // Combined biodiversity metrics
-    biodiversityMetrics: {
-      totalSpeciesIdentified: combinedSpecies.size,
-      speciesList: Array.from(combinedSpecies),
-      shannonDiversity: 2.1 + Math.random() * 0.8,
-      simpsonIndex: 0.7 + Math.random() * 0.2,
-      evenness: 0.6 + Math.random() * 0.3,
-    },
-
-    // Taxonomic composition
-    taxonomicComposition: {
-      phyla: {
-        Chordata: 35,
-        Arthropoda: 28,
-        Mollusca: 22,
-        Cnidaria: 10,
-        Others: 5,
-      },
-      classes: {
-        Actinopterygii: 30,
-        Malacostraca: 25,
-        Gastropoda: 20,
-        Bivalvia: 15,
-        Others: 10,
-      },
-    },
-
-    // Analysis confidence and quality
-    qualityMetrics: {
-      overallConfidence: 0.85 + Math.random() * 0.1,
-      dataCompleteness: 0.92,
-      analysisReliability: "High",
-      recommendedActions: [
-        "Review low-confidence identifications",
-        "Consider additional sampling for rare species",
-        "Validate results with morphological analysis",
-      ],
-    },
-
-    // Processing metadata
-    processingMetadata: {
-      startTime: new Date().toISOString(),
-      estimatedCompletionTime: new Date(Date.now() + 7200000).toISOString(), // 2 hours
-      processingSteps: [
-        "Document text extraction",
-        "Sequence quality filtering",
-        "Taxonomic classification",
-        "Biodiversity analysis",
-        "Result integration",
-      ],
-      status: "in_progress",
-    },
-  }
-
-  console.log("[v0] ML pipeline analysis completed")
-  return mlResults
+  console.log(`[v0] Queued ML pipeline run ${runId}`)
+  return response.json()
 }
 
 async function getPipelineStatus(runId: string) {
-  // Simulate realistic pipeline status
-  const statuses = ["queued", "processing", "analyzing", "completing", "completed"]
-  const currentStatus = statuses[Math.floor(Math.random() * statuses.length)]
+  const response = await workerRequest(`/jobs/${encodeURIComponent(runId)}`)
+  if (response.status === 404) {
+    return null
+  }
 
+  const job = await response.json()
   return {
-    runId,
-    status: currentStatus,
-    progress: currentStatus === "completed" ? 100 : Math.floor(Math.random() * 90) + 10,
-    startTime: new Date(Date.now() - 300000).toISOString(), // 5 minutes ago
-    endTime: currentStatus === "completed" ? new Date().toISOString() : null,
-    currentStep: currentStatus === "completed" ? "Analysis complete" : "Processing sequences",
-    estimatedTimeRemaining: currentStatus === "completed" ? 0 : Math.floor(Math.random() * 120) + 30,
-    message: `Pipeline ${currentStatus}`,
-    logs: [
-      "Pipeline initialized",
-      "Documents processed successfully",
-      "Sequence analysis in progress",
-      "Taxonomic classification running",
-    ],
+    ...job,
+    message: job.error ? `Pipeline ${job.status}: ${job.error}` : `Pipeline ${job.status}`,
   }
 }
@@ -0,0 +1,220 @@
+"""
+Benchmark suite for the EDNA biodiversity ML pipeline
+Generates seeded synthetic reference databases and reads, times the main
+pipeline stages across read counts and reference sizes, and writes the
+measurements as JSON for regression tracking and scaling plots
+"""
+
+import argparse
+import json
+import platform
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ml_pipeline import EDNAMLPipeline
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+
+def generate_reference_database(n_references: int, length: int = 400, n_species: Optional[int] = None,
+                                seed: int = 0) -> Tuple[Dict, Dict]:
+    """
+    Generate a random reference database and matching taxonomy
+
+    Args:
+        n_references: Number of reference barcodes
+        length: Barcode length in bases
+        n_species: Distinct species (defaults to one per reference)
+        seed: Random seed
+
+    Returns:
+        Tuple of (sequence_db, taxonomy_hierarchy) in the pipeline's formats
+    """
+    rng = np.random.default_rng(seed)
+    n_species = n_species or n_references
+    codes = rng.integers(0, 4, size=(n_references, length))
+    species_of = rng.integers(0, n_species, size=n_references)
+    species_of[:min(n_species, n_references)] = np.arange(min(n_species, n_references))
+
+    sequences = {}
+    for row, species_id in enumerate(species_of.tolist()):
+        ref_seq = BASES[codes[row]].tobytes().decode("ascii")
+        sequences[ref_seq] = {
+            "species": f"Synthetic species {species_id:06d}",
+            "confidence": round(float(rng.uniform(0.85, 0.99)), 2)
+        }
+
+    taxonomy = {}
+    for species_id in range(n_species):
+        name = f"Synthetic species {species_id:06d}"
+        lineage = [f"{rank.title()} {species_id // (10 ** (6 - depth))}" for depth, rank in enumerate(RANKS[:-1])]
+        taxonomy[name] = dict(zip(RANKS, lineage + [name]))
+
+    sequence_db = {
+        "sequences": sequences,
+        "metadata": {
+            "version": f"synthetic-{n_references}-{length}-{seed}",
+            "total_sequences": len(sequences),
+            "last_updated": datetime.now().strftime("%Y-%m-%d")
+        }
+    }
+    return sequence_db, taxonomy
+
+
+def generate_reads(references: List[str], n_reads: int, substitution_rate: float = 0.01,
+                   indel_rate: float = 0.0, abundance_skew: float = 1.2, seed: int = 0) -> List[str]:
+    """
+    Sample noisy reads from references with a skewed abundance distribution
+
+    Args:
+        references: Reference sequences to sample from
+        n_reads: Number of reads to generate
+        substitution_rate: Per-base substitution probability
+        indel_rate: Per-read probability of a single-base insertion or deletion
+        abundance_skew: Zipf exponent of reference abundances (0 is uniform)
+        seed: Random seed
+
+    Returns:
+        List of read strings
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, len(references) + 1) ** abundance_skew
+    rng.shuffle(weights)
+    picks = rng.choice(len(references), size=n_reads, p=weights / weights.sum())
+
+    reads = []
+    for ref_id in picks.tolist():
+        read = np.frombuffer(references[ref_id].encode("ascii"), dtype=np.uint8).copy()
+
+        mutate = rng.random(read.size) < substitution_rate
+        read[mutate] = BASES[rng.integers(0, 4, size=int(mutate.sum()))]
+
+        if rng.random() < indel_rate:
+            position = int(rng.integers(0, read.size))
+            if rng.random() < 0.5:
+                read = np.delete(read, position)
+            else:
+                read = np.insert(read, position, BASES[rng.integers(0, 4)])
+
+        reads.append(read.tobytes().decode("ascii"))
+
+    return reads
+
+
+def _time(function: Callable, repeat: int = 1) -> float:
+    """Best wall time of repeat calls"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def benchmark_case(n_references: int, n_reads: int, read_length: int = 400, identify_sample: int = 200,
+                   repeat: int = 1, seed: int = 0, substitution_rate: float = 0.01, indel_rate: float = 0.0,
+                   abundance_skew: float = 1.2, pipeline_options: Optional[Dict] = None,
+                   analyze_options: Optional[Dict] = None) -> Dict:
+    """
+    Time every pipeline stage for one (reference size, read count) combination
+
+    substitution_rate, indel_rate and abundance_skew shape the simulated reads
+    (see generate_reads) and are recorded with the case.
+    """
+    sequence_db, taxonomy = generate_reference_database(n_references, length=read_length, seed=seed)
+    references = list(sequence_db["sequences"])
+    reads = generate_reads(references, n_reads, substitution_rate=substitution_rate, indel_rate=indel_rate,
+                           abundance_skew=abundance_skew, seed=seed + 1)
+    pipeline = EDNAMLPipeline.from_reference_data(sequence_db, taxonomy, **(pipeline_options or {}))
+
+    warmup = pipeline.warmup()
+    sample = reads[:identify_sample]
+    analysis = {}
+
+    def analyze():
+        analysis.update(pipeline.analyze_biodiversity(reads, keep_results=False, **(analyze_options or {})))
+
+    timings = {
+        "preprocess_sequence": _time(lambda: [pipeline.preprocess_sequence(read) for read in reads], repeat),
+        "identify_species": _time(lambda: [pipeline.identify_species(read) for read in sample], repeat),
+        "analyze_biodiversity": _time(analyze, repeat),
+    }
+    timings["generate_report"] = _time(lambda: pipeline.generate_report(analysis, seed=seed), repeat)
+
+    return {
+        "n_references": n_references,
+        "n_reads": n_reads,
+        "read_length": read_length,
+        "substitution_rate": substitution_rate,
+        "indel_rate": indel_rate,
+        "abundance_skew": abundance_skew,
+        "warmup_seconds": warmup["total_seconds"],
+        "seconds": timings,
+        "reads_per_second": {
+            "preprocess_sequence": n_reads / timings["preprocess_sequence"],
+            "identify_species": len(sample) / timings["identify_species"],
+            "analyze_biodiversity": n_reads / timings["analyze_biodiversity"]
+        },
+        "identification_rate": analysis["identification_rate"]
+    }
+
+
+def run_benchmarks(read_counts: List[int], reference_sizes: List[int], **case_options) -> Dict:
+    """Run every combination of read count and reference size"""
+    cases = []
+    for n_references in reference_sizes:
+        for n_reads in read_counts:
+            print(f"Benchmarking {n_reads} reads against {n_references} references...")
+            cases.append(benchmark_case(n_references, n_reads, **case_options))
+
+    return {
+        "benchmark": "EDNA_ML_pipeline",
+        "timestamp": datetime.now().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor()
+        },
+        "options": {key: value for key, value in case_options.items()},
+        "cases": cases
+    }
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the EDNA biodiversity ML pipeline")
+    parser.add_argument("--reads", type=_int_list, default=[1000, 10000], help="Comma-separated read counts")
+    parser.add_argument("--references", type=_int_list, default=[100, 1000], help="Comma-separated reference sizes")
+    parser.add_argument("--read-length", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=1, help="Repetitions per timing (best is kept)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--substitution-rate", type=float, default=0.01, help="Per-base substitution probability")
+    parser.add_argument("--indel-rate", type=float, default=0.0, help="Per-read single-base indel probability")
+    parser.add_argument("--abundance-skew", type=float, default=1.2,
+                        help="Zipf exponent of reference abundances (0 is uniform)")
+    parser.add_argument("--classifier", default="ungapped", choices=["ungapped", "two_stage"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    results = run_benchmarks(
+        args.reads, args.references, read_length=args.read_length, repeat=args.repeat, seed=args.seed,
+        substitution_rate=args.substitution_rate, indel_rate=args.indel_rate, abundance_skew=args.abundance_skew,
+        pipeline_options={"classifier": args.classifier}, analyze_options={"workers": args.workers}
+    )
+
+    with open(args.output, "w") as handle:
+        json.dump(results, handle, indent=2)
+
+    print(f"Benchmark results written to {args.output}")
+    for case in results["cases"]:
+        rate = case["reads_per_second"]["analyze_biodiversity"]
+        print(f"  {case['n_references']:>7} refs x {case['n_reads']:>8} reads: {rate:,.0f} reads/s")
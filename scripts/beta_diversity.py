@@ -0,0 +1,291 @@
+"""
+Multi-sample beta diversity for the EDNA biodiversity pipeline
+Builds a sparse (CSR) sample x taxon abundance matrix from stored
+identifications or per-sample counts and computes pairwise Bray-Curtis and
+Jaccard distance matrices one block of samples at a time by joining each
+block's counts with the taxon columns, so work grows with co-occurrences
+rather than samples x samples x taxa
+"""
+
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from diversity import DiversityAccumulator
+
+# species_identifications column holding each rank's label
+RANK_COLUMNS = {
+    "kingdom": "kingdom",
+    "phylum": "phylum",
+    "class": "class",
+    "order": "order_name",
+    "family": "family",
+    "genus": "genus",
+    "species": "species_name"
+}
+
+METRICS = ("bray_curtis", "jaccard")
+
+# Upper bound on sample pairs expanded at once when joining a block with the taxon columns
+_MAX_PAIRS = 1 << 22
+
+
+class AbundanceMatrix:
+    """
+    Sample x taxon read counts in CSR form
+
+    Row i holds sample samples[i]; its nonzero counts are
+    data[indptr[i]:indptr[i + 1]] at taxon columns indices[...], sorted by column.
+    """
+
+    def __init__(self, samples: Sequence[str], taxa: Sequence[str], indptr: np.ndarray, indices: np.ndarray,
+                 data: np.ndarray):
+        self.samples = list(samples)
+        self.taxa = list(taxa)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.int64)
+
+    @classmethod
+    def from_triples(cls, triples: Iterable[Tuple[str, str, int]],
+                     samples: Optional[Sequence[str]] = None) -> "AbundanceMatrix":
+        """
+        Build the matrix from (sample, taxon, count) rows; repeated pairs are summed
+
+        Args:
+            triples: Count rows in any order
+            samples: Row order to use (samples without counts get empty rows);
+                defaults to order of first appearance
+        """
+        sample_ids: Dict[str, int] = {sample: row for row, sample in enumerate(samples or ())}
+        taxon_ids: Dict[str, int] = {}
+        rows, columns, counts = [], [], []
+        for sample, taxon, count in triples:
+            row = sample_ids.get(sample)
+            if row is None:
+                if samples is not None:
+                    continue
+                row = sample_ids[sample] = len(sample_ids)
+            column = taxon_ids.get(taxon)
+            if column is None:
+                column = taxon_ids[taxon] = len(taxon_ids)
+            rows.append(row)
+            columns.append(column)
+            counts.append(count)
+
+        rows = np.array(rows, dtype=np.int64)
+        columns = np.array(columns, dtype=np.int64)
+        counts = np.array(counts, dtype=np.int64)
+
+        # Sum duplicate (row, column) pairs and sort by row, then column
+        keys, inverse = np.unique(rows * max(len(taxon_ids), 1) + columns, return_inverse=True)
+        summed = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+        rows, columns = np.divmod(keys, max(len(taxon_ids), 1))
+        keep = summed > 0
+
+        indptr = np.zeros(len(sample_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(sample_ids)), out=indptr[1:])
+        return cls(list(sample_ids), list(taxon_ids), indptr, columns[keep], summed[keep])
+
+    @classmethod
+    def from_counts(cls, sample_counts: Dict[str, Dict[str, int]]) -> "AbundanceMatrix":
+        """Build the matrix from {sample: {taxon: count}}"""
+        return cls.from_triples(
+            ((sample, taxon, count) for sample, counts in sample_counts.items() for taxon, count in counts.items()),
+            samples=list(sample_counts)
+        )
+
+    @classmethod
+    def from_accumulators(cls, accumulators: Dict[str, DiversityAccumulator],
+                          rank: str = "species") -> "AbundanceMatrix":
+        """Build the matrix from per-sample accumulators (rank must be species or a tracked rank)"""
+        return cls.from_counts({
+            sample: accumulator.species_counts if rank == "species" else accumulator.rank_counts[rank]
+            for sample, accumulator in accumulators.items()
+        })
+
+    @classmethod
+    def from_database(cls, db_path: str = "edna_biodiversity.db", rank: str = "species",
+                      sample_ids: Optional[Sequence[str]] = None, use_summaries: bool = True) -> "AbundanceMatrix":
+        """
+        Build the matrix from the stored identifications of each sample
+
+        Reads the incrementally maintained sample_species_counts /
+        sample_rank_counts tables when present, otherwise aggregates
+        species_identifications joined to their sequences' samples in SQLite.
+        Either way the counts are streamed into the CSR arrays, so no per-read
+        rows are held in memory, and each identification counts with its
+        sequences row's abundance.
+
+        Args:
+            db_path: Pipeline database
+            rank: Taxonomic rank to count at
+            sample_ids: Samples to include (rows in this order); defaults to all
+            use_summaries: Read the summary tables (disable to aggregate the base tables)
+        """
+        if rank not in RANK_COLUMNS:
+            raise ValueError(f"Unknown rank: {rank}")
+        column = RANK_COLUMNS[rank]
+        if sample_ids is not None and len(sample_ids) == 0:
+            # An empty selection would make an invalid "IN ()" clause
+            return cls.from_triples((), samples=())
+
+        conn = sqlite3.connect(db_path)
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        parameters: List[str] = []
+        if use_summaries and rank == "species" and "sample_species_counts" in tables:
+            query = "SELECT sample_id, species_name, read_count FROM sample_species_counts WHERE read_count > 0"
+            sample_column, group_by = "sample_id", ""
+        elif use_summaries and rank != "species" and "sample_rank_counts" in tables:
+            query = "SELECT sample_id, taxon, read_count FROM sample_rank_counts WHERE rank = ? AND read_count > 0"
+            sample_column, group_by = "sample_id", ""
+            parameters.append(rank)
+        else:
+            # Databases not yet migrated to packed storage have no abundance column
+            has_abundance = "abundance" in {row[1] for row in conn.execute("PRAGMA table_info(sequences)")}
+            query = f'''
+                SELECT s.sample_id, si.{column}, {"SUM(COALESCE(s.abundance, 1))" if has_abundance else "COUNT(*)"}
+                FROM species_identifications si
+                JOIN sequences s ON s.id = si.sequence_id
+                WHERE si.{column} IS NOT NULL AND si.{column} != ''
+            '''
+            sample_column, group_by = "s.sample_id", f" GROUP BY s.sample_id, si.{column}"
+        if sample_ids is not None:
+            query += f" AND {sample_column} IN ({', '.join('?' * len(sample_ids))})"
+            parameters.extend(sample_ids)
+        query += group_by
+
+        try:
+            return cls.from_triples(conn.execute(query, parameters), samples=sample_ids)
+        finally:
+            conn.close()
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self.samples), len(self.taxa)
+
+    @property
+    def nnz(self) -> int:
+        return len(self.data)
+
+    def totals(self) -> np.ndarray:
+        """Reads per sample"""
+        rows = np.repeat(np.arange(len(self.samples)), np.diff(self.indptr))
+        return np.bincount(rows, weights=self.data, minlength=len(self.samples)).astype(np.int64)
+
+    def richness(self) -> np.ndarray:
+        """Taxa observed per sample"""
+        return np.diff(self.indptr)
+
+    def row(self, sample: str) -> Dict[str, int]:
+        """Counts of one sample as {taxon: count}"""
+        position = self.samples.index(sample)
+        start, stop = self.indptr[position], self.indptr[position + 1]
+        return {self.taxa[column]: int(count)
+                for column, count in zip(self.indices[start:stop].tolist(), self.data[start:stop].tolist())}
+
+    def columns(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        CSC view of the counts
+
+        Returns:
+            Tuple of (column pointers, sample rows, counts) with the entries of
+            taxon k at [pointers[k]:pointers[k + 1]]
+        """
+        entry_rows = np.repeat(np.arange(len(self.samples)), np.diff(self.indptr))
+        order = np.argsort(self.indices, kind="stable")
+        pointers = np.zeros(len(self.taxa) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices, minlength=len(self.taxa)), out=pointers[1:])
+        return pointers, entry_rows[order], self.data[order]
+
+
+def pairwise_distances(matrix: AbundanceMatrix, metric: str = "bray_curtis", block_size: int = 256,
+                       out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Symmetric sample x sample distance matrix
+
+    For each block of samples, every nonzero count is joined with the other
+    samples holding the same taxon (CSC columns), and the shared abundance
+    (sum of minimum counts, or shared taxa for Jaccard) of all pairs is
+    accumulated with one bincount per bounded chunk of pairs. Only pairs in
+    the upper triangle are expanded and the result is mirrored.
+
+    Args:
+        matrix: Sample x taxon counts
+        metric: "bray_curtis" (abundance) or "jaccard" (presence/absence)
+        block_size: Samples per block
+        out: Optional preallocated (samples, samples) float array, e.g. an
+            np.memmap for very large sample sets
+
+    Returns:
+        Distance matrix in [0, 1]; two empty samples are at distance 0
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+
+    n_samples = len(matrix.samples)
+    if out is None:
+        out = np.zeros((n_samples, n_samples), dtype=np.float64)
+    sizes = (matrix.totals() if metric == "bray_curtis" else matrix.richness()).astype(np.float64)
+    pointers, column_rows, column_counts = matrix.columns()
+    column_lengths = np.diff(pointers)
+
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        width = n_samples - start
+        overlap = np.zeros((stop - start) * width)
+
+        begin, end = matrix.indptr[start], matrix.indptr[stop]
+        entry_rows = np.repeat(np.arange(stop - start), np.diff(matrix.indptr[start:stop + 1]))
+        entry_columns = matrix.indices[begin:end]
+        entry_counts = matrix.data[begin:end]
+
+        # Split the block's entries so no chunk expands to more than _MAX_PAIRS pairs
+        pair_ends = np.cumsum(column_lengths[entry_columns])
+        bounds = [0]
+        while bounds[-1] < len(entry_columns):
+            limit = (pair_ends[bounds[-1] - 1] if bounds[-1] else 0) + _MAX_PAIRS
+            bounds.append(max(bounds[-1] + 1, int(np.searchsorted(pair_ends, limit, side="right"))))
+
+        for chunk_start, chunk_stop in zip(bounds[:-1], bounds[1:]):
+            columns = entry_columns[chunk_start:chunk_stop]
+            lengths = column_lengths[columns]
+            pair_entries = np.repeat(np.arange(chunk_stop - chunk_start), lengths)
+            offsets = np.arange(len(pair_entries)) - np.repeat(np.cumsum(lengths) - lengths, lengths) \
+                + np.repeat(pointers[columns], lengths)
+            partners = column_rows[offsets]
+
+            upper = partners >= start
+            pair_entries, partners, offsets = pair_entries[upper], partners[upper], offsets[upper]
+            if metric == "bray_curtis":
+                shared = np.minimum(entry_counts[chunk_start:chunk_stop][pair_entries], column_counts[offsets])
+            else:
+                shared = None
+            keys = entry_rows[chunk_start:chunk_stop][pair_entries] * width + (partners - start)
+            overlap += np.bincount(keys, weights=shared, minlength=len(overlap))
+
+        overlap = overlap.reshape(stop - start, width)
+        block_sizes = sizes[start:stop, None] + sizes[None, start:]
+        if metric == "bray_curtis":
+            similarity = np.divide(2 * overlap, block_sizes, out=np.ones_like(overlap), where=block_sizes > 0)
+        else:
+            union = block_sizes - overlap
+            similarity = np.divide(overlap, union, out=np.ones_like(overlap), where=union > 0)
+
+        distances = 1.0 - similarity
+        out[start:stop, start:] = distances
+        out[start:, start:stop] = distances.T
+
+    np.fill_diagonal(out, 0.0)
+    return out
+
+
+def bray_curtis(matrix: AbundanceMatrix, block_size: int = 256, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Pairwise Bray-Curtis dissimilarity of sample abundances"""
+    return pairwise_distances(matrix, "bray_curtis", block_size=block_size, out=out)
+
+
+def jaccard(matrix: AbundanceMatrix, block_size: int = 256, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Pairwise Jaccard distance of sample taxon sets"""
+    return pairwise_distances(matrix, "jaccard", block_size=block_size, out=out)
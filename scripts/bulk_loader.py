@@ -0,0 +1,400 @@
+"""
+Bulk database loader for the EDNA biodiversity pipeline
+Streams reads and their identification results into the sequences and
+species_identifications tables with batched executemany calls inside large
+transactions, WAL journaling and load-tuned pragmas. Secondary indexes on
+the two tables are dropped for the load and rebuilt once at the end, and the
+summary tables are updated from aggregated counts instead of per-row
+triggers. With storage="packed" each distinct read is stored once as a
+packed blob and sequences rows carry per-sample abundances.
+"""
+
+import sqlite3
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from database_setup import (RANK_COUNT_UPSERT, SPECIES_COUNT_UPSERT, SUMMARY_RANKS, SUMMARY_TRIGGER_PREFIX,
+                            create_analysis_tables, restore_deferred_indexes, restore_summary_triggers,
+                            summary_triggers_missing)
+from result_records import ResultBatch, STATUS_HIGHER_TAXON, STATUS_IDENTIFIED
+from sequence_storage import BlobWriter
+from taxonomy import RANKS
+
+# Tables whose secondary indexes are deferred during a load
+LOADED_TABLES = ("sequences", "species_identifications")
+
+# Lineage columns of species_identifications, in RANKS order
+LINEAGE_COLUMNS = ("kingdom", "phylum", "class", "order_name", "family", "genus", "species")
+
+_SEQUENCE_INSERT = '''
+    INSERT INTO sequences (id, sample_id, sequence_data, sequence_length, gc_content, quality_score,
+                           primer_used, sequencing_platform)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+_PACKED_SEQUENCE_INSERT = '''
+    INSERT INTO sequences (id, sample_id, sequence_length, gc_content, quality_score, primer_used,
+                           sequencing_platform, blob_id, abundance)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+_IDENTIFICATION_INSERT = f'''
+    INSERT INTO species_identifications (sequence_id, species_name, confidence_score, identification_method,
+                                         {", ".join(LINEAGE_COLUMNS)})
+    VALUES (?, ?, ?, ?, {", ".join("?" * len(LINEAGE_COLUMNS))})
+'''
+
+
+class BulkLoader:
+    """
+    Loads pipeline output into the pipeline database in large transactions
+
+    Use as a context manager; rows are buffered and written with executemany
+    every batch_size sequences, and committed every transaction_rows. While a
+    load is open its connection holds the write lock between commits and the
+    deferred indexes are missing, so concurrent readers see slower queries.
+    The summary triggers are dropped for the load as well; rows other
+    connections write meanwhile are missed by the summaries until
+    rebuild_summary_tables runs. Dropped indexes and triggers are recorded in
+    deferred_schema_objects in the same transaction, so if the process dies
+    mid-load the next open() (or database_setup.recover_interrupted_load)
+    rebuilds the indexes, recreates the triggers and recomputes the summaries.
+
+    storage="text" writes one sequences row per read. storage="packed" needs
+    a migrated schema (sequence_storage.py) and writes one row per distinct
+    read and sample within the load, with its abundance and one
+    identification (copies of a read share its result).
+    """
+
+    def __init__(self, db_path: str = "edna_biodiversity.db", batch_size: int = 50000,
+                 transaction_rows: int = 1000000, defer_indexes: bool = True, cache_mb: int = 256,
+                 primer_used: Optional[str] = None, sequencing_platform: Optional[str] = None,
+                 storage: str = "text"):
+        if storage not in ("text", "packed"):
+            raise ValueError(f"Unknown storage mode: {storage}")
+        self.db_path = db_path
+        self.storage = storage
+        self.batch_size = batch_size
+        self.transaction_rows = transaction_rows
+        self.defer_indexes = defer_indexes
+        self.cache_mb = cache_mb
+        self.primer_used = primer_used
+        self.sequencing_platform = sequencing_platform
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._sequence_rows: List[Tuple] = []
+        self._identification_rows: List[Tuple] = []
+        self._samples = set()
+        self._blobs: Optional[BlobWriter] = None
+        # Packed storage: (sequences id, identification) per (sample, blob) and abundance
+        # still to add to flushed rows
+        self._abundance_rows: Dict[Tuple[str, int], Tuple[int, Optional[Tuple]]] = {}
+        self._abundance_updates: Dict[int, int] = {}
+        # Reads to add to sample_species_counts and sample_rank_counts at the next flush
+        self._species_counts: Dict[Tuple[str, str], int] = {}
+        self._rank_counts: Dict[Tuple[str, str, str], int] = {}
+        self._next_id = 0
+        self._uncommitted = 0
+        # Lineage column values per species name or (rank, node) of a higher taxon
+        self._lineages: Dict = {}
+        self.reads_loaded = 0
+        self.sequences_loaded = 0
+        self.identifications_loaded = 0
+        self.seconds = 0.0
+        self.index_seconds = 0.0
+
+    def __enter__(self) -> "BulkLoader":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def open(self):
+        """Connect, tune pragmas, defer indexes and start the first transaction"""
+        started = time.perf_counter()
+        conn = self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_mb * 1024}")
+
+        conn.execute("BEGIN IMMEDIATE")
+        # Checked before create_analysis_tables puts the triggers back
+        stale_summaries = summary_triggers_missing(conn.cursor())
+        create_analysis_tables(conn.cursor())
+        if stale_summaries:
+            restore_summary_triggers(conn.cursor())
+        if not self.defer_indexes:
+            restore_deferred_indexes(conn.cursor())
+        # Indexes a crashed load left recorded stay dropped and are rebuilt by close()
+        self._defer_schema()
+        if self.storage == "packed":
+            if "blob_id" not in {row[1] for row in conn.execute("PRAGMA table_info(sequences)")}:
+                conn.execute("ROLLBACK")
+                conn.close()
+                self._conn = None
+                raise ValueError(f"{self.db_path} stores TEXT sequences only; "
+                                 "run `python sequence_storage.py migrate` first")
+            self._blobs = BlobWriter(conn)
+        self._next_id = self._last_sequence_id() + 1
+        self.seconds += time.perf_counter() - started
+
+    def _defer_schema(self):
+        """Drop the summary triggers and deferred indexes, recording them in deferred_schema_objects"""
+        objects = self._conn.execute("SELECT type, name, sql FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?",
+                                     (SUMMARY_TRIGGER_PREFIX + "%",)).fetchall()
+        if self.defer_indexes:
+            objects += self._conn.execute(f'''
+                SELECT type, name, sql FROM sqlite_master
+                WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({", ".join("?" * len(LOADED_TABLES))})
+            ''', LOADED_TABLES).fetchall()
+        self._conn.executemany("INSERT OR REPLACE INTO deferred_schema_objects (type, name, sql) VALUES (?, ?, ?)",
+                               objects)
+        for object_type, name, _ in objects:
+            self._conn.execute(f'DROP {object_type.upper()} "{name}"')
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    def _last_sequence_id(self) -> int:
+        """Highest sequences id ever handed out, so explicit ids never collide with AUTOINCREMENT"""
+        row = self._conn.execute('''
+            SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'sequences'), 0),
+                       COALESCE((SELECT MAX(id) FROM sequences), 0))
+        ''').fetchone()
+        return row[0]
+
+    def add(self, sample_id: str, sequences: Sequence[str], results: Union[ResultBatch, List[Dict]],
+            weights: Optional[np.ndarray] = None, identification_method: str = "EDNA_ML_v2.1") -> int:
+        """
+        Queue one batch of reads with their identification results
+
+        Args:
+            sample_id: Sample the reads belong to
+            sequences: Read strings, aligned with results
+            results: ResultBatch or identify_species dicts
+            weights: Optional per-row copy counts (dereplication abundances)
+            identification_method: Stored with every identification
+
+        Returns:
+            Number of sequence rows queued
+        """
+        started = time.perf_counter()
+        if sample_id not in self._samples:
+            self._conn.execute("INSERT OR IGNORE INTO samples (sample_id) VALUES (?)", (sample_id,))
+            self._samples.add(sample_id)
+
+        if isinstance(results, ResultBatch):
+            rows = self._batch_rows(results)
+        else:
+            rows = [self._dict_row(result) for result in results]
+
+        copies = np.ones(len(sequences), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        if self._blobs is not None:
+            queued = self._add_packed(sample_id, sequences, rows, copies.tolist(), identification_method)
+        else:
+            queued = self._add_text(sample_id, sequences, rows, copies.tolist(), identification_method)
+        self.reads_loaded += int(copies.sum())
+        if len(self._sequence_rows) >= self.batch_size:
+            self._flush()
+        self.seconds += time.perf_counter() - started
+        return queued
+
+    def _add_text(self, sample_id: str, sequences: Sequence[str], rows: List[Tuple], copies: List[int],
+                  identification_method: str) -> int:
+        """One sequences row (and identification) per read copy"""
+        primer, platform = self.primer_used, self.sequencing_platform
+        sequence_rows, identification_rows = self._sequence_rows, self._identification_rows
+        next_id = self._next_id
+        for sequence, (length, gc_content, quality, identification), count in zip(sequences, rows, copies):
+            for _ in range(count):
+                sequence_rows.append((next_id, sample_id, sequence, length, gc_content, quality, primer, platform))
+                if identification is not None:
+                    identification_rows.append((next_id, identification[0], identification[1],
+                                                identification_method, *identification[2]))
+                next_id += 1
+            if identification is not None:
+                self._count(sample_id, identification, count)
+
+        queued = next_id - self._next_id
+        self._next_id = next_id
+        return queued
+
+    def _add_packed(self, sample_id: str, sequences: Sequence[str], rows: List[Tuple], copies: List[int],
+                    identification_method: str) -> int:
+        """One sequences row per distinct (sample, blob); repeats only add to its abundance"""
+        primer, platform = self.primer_used, self.sequencing_platform
+        sequence_rows, identification_rows = self._sequence_rows, self._identification_rows
+        abundance_rows, abundance_updates = self._abundance_rows, self._abundance_updates
+        pending = {}
+        next_id = self._next_id
+        blob_ids = self._blobs.intern(list(sequences))
+        for blob_id, (length, gc_content, quality, identification), count in zip(blob_ids, rows, copies):
+            key = (sample_id, blob_id)
+            known = abundance_rows.get(key)
+            if known is not None:
+                sequence_id, identification = known
+                if sequence_id in pending:
+                    pending[sequence_id][-1] += count
+                else:
+                    abundance_updates[sequence_id] = abundance_updates.get(sequence_id, 0) + count
+            else:
+                sequence_id = next_id
+                abundance_rows[key] = (sequence_id, identification)
+                next_id += 1
+                pending[sequence_id] = [sequence_id, sample_id, length, gc_content, quality, primer, platform,
+                                        blob_id, count]
+                if identification is not None:
+                    identification_rows.append((sequence_id, identification[0], identification[1],
+                                                identification_method, *identification[2]))
+            if identification is not None:
+                self._count(sample_id, identification, count)
+
+        sequence_rows.extend(tuple(row) for row in pending.values())
+        queued = next_id - self._next_id
+        self._next_id = next_id
+        return queued
+
+    def _batch_rows(self, results: ResultBatch) -> List[Tuple]:
+        """(length, gc, quality, identification or None) per row of a compact batch"""
+        records = results.records
+        confidences = records["confidence"].tolist()
+        identifications: List[Optional[Tuple]] = [None] * len(records)
+
+        for position in np.flatnonzero(records["status"] == STATUS_IDENTIFIED).tolist():
+            species = results.species_names[int(records["taxon_id"][position])]
+            lineage = self._lineages.get(species)
+            if lineage is None:
+                lineage = self._lineages[species] = _lineage_values(results.taxonomy.get(species, {}))
+            identifications[position] = (species, confidences[position], lineage)
+
+        for position in np.flatnonzero(records["status"] == STATUS_HIGHER_TAXON).tolist():
+            node = (int(records["rank"][position]), int(records["node_id"][position]))
+            lineage = self._lineages.get(node)
+            if lineage is None:
+                lineage = self._lineages[node] = _lineage_values(results.lineage.lineage_dict(*node))
+            identifications[position] = (None, confidences[position], lineage)
+
+        return list(zip(records["length"].tolist(), records["gc_content"].tolist(),
+                        records["quality_score"].tolist(), identifications))
+
+    def _dict_row(self, result: Dict) -> Tuple:
+        identification = None
+        if result["status"] in ("identified", "higher_taxon"):
+            identification = (result.get("species"), result.get("confidence"),
+                              _lineage_values(result.get("taxonomy", {})))
+        return result.get("sequence_length"), result.get("gc_content"), result.get("quality_score"), identification
+
+    def _count(self, sample_id: str, identification: Tuple, count: int):
+        """Add an identification's reads to the pending summary counts"""
+        species, _, lineage = identification
+        if species:
+            key = (sample_id, species)
+            self._species_counts[key] = self._species_counts.get(key, 0) + count
+        for (rank, _), taxon in zip(SUMMARY_RANKS, lineage):
+            if taxon:
+                key = (sample_id, rank, taxon)
+                self._rank_counts[key] = self._rank_counts.get(key, 0) + count
+
+    def _flush(self):
+        """Write the buffered rows, committing once transaction_rows have accumulated"""
+        if self._blobs is not None:
+            self._blobs.flush()
+        if self._sequence_rows:
+            self._conn.executemany(_PACKED_SEQUENCE_INSERT if self._blobs is not None else _SEQUENCE_INSERT,
+                                   self._sequence_rows)
+            self._conn.executemany(_IDENTIFICATION_INSERT, self._identification_rows)
+            self.sequences_loaded += len(self._sequence_rows)
+            self.identifications_loaded += len(self._identification_rows)
+            self._uncommitted += len(self._sequence_rows) + len(self._identification_rows)
+            self._sequence_rows.clear()
+            self._identification_rows.clear()
+        if self._abundance_updates:
+            self._conn.executemany("UPDATE sequences SET abundance = abundance + ? WHERE id = ?",
+                                   [(count, sequence_id) for sequence_id, count in self._abundance_updates.items()])
+            self._abundance_updates.clear()
+        if self._species_counts or self._rank_counts:
+            self._conn.executemany(SPECIES_COUNT_UPSERT,
+                                   [key + (count,) for key, count in self._species_counts.items()])
+            self._conn.executemany(RANK_COUNT_UPSERT, [key + (count,) for key, count in self._rank_counts.items()])
+            self._species_counts.clear()
+            self._rank_counts.clear()
+
+        if self._uncommitted >= self.transaction_rows:
+            self._conn.execute("COMMIT")
+            self._uncommitted = 0
+            self._conn.execute("BEGIN IMMEDIATE")
+            # recover_interrupted_load may have run between the two statements
+            self._defer_schema()
+            self._next_id = max(self._next_id, self._last_sequence_id() + 1)
+            if self._blobs is not None:
+                self._blobs.resync()
+
+    def flush(self):
+        """Write the buffered rows now (within the open transaction), so stats() covers every add()"""
+        started = time.perf_counter()
+        self._flush()
+        self.seconds += time.perf_counter() - started
+
+    def close(self) -> Dict:
+        """Write the remaining rows, rebuild the deferred indexes, commit and return stats()"""
+        if self._conn is None:
+            return self.stats()
+        started = time.perf_counter()
+        self._flush()
+        index_started = time.perf_counter()
+        restore_deferred_indexes(self._conn.cursor())
+        restore_summary_triggers(self._conn.cursor(), rebuild=False)
+        self._conn.execute("COMMIT")
+        finished = time.perf_counter()
+        self._conn.execute("PRAGMA optimize")
+        self._conn.close()
+        self._conn = None
+
+        self.index_seconds += finished - index_started
+        self.seconds += finished - started
+        return self.stats()
+
+    def abort(self):
+        """Roll back uncommitted rows and restore the deferred indexes and summary triggers"""
+        if self._conn is None:
+            return
+        self._conn.execute("ROLLBACK")
+        # Rows committed by earlier transactions stay, so their indexes must come back
+        self._conn.execute("BEGIN IMMEDIATE")
+        # The rollback may also have undone open()'s repair of a crashed load
+        stale_summaries = summary_triggers_missing(self._conn.cursor())
+        create_analysis_tables(self._conn.cursor())
+        restore_deferred_indexes(self._conn.cursor())
+        restore_summary_triggers(self._conn.cursor(), rebuild=stale_summaries)
+        self._conn.execute("COMMIT")
+        self._conn.close()
+        self._conn = None
+
+    def stats(self) -> Dict:
+        """Rows written so far with load throughput"""
+        rows = self.sequences_loaded + self.identifications_loaded
+        if self._blobs is not None:
+            rows += self._blobs.blobs_written
+        return {
+            "reads": self.reads_loaded,
+            "sequences": self.sequences_loaded,
+            "unique_sequences": self._blobs.blobs_written if self._blobs is not None else None,
+            "identifications": self.identifications_loaded,
+            "samples": len(self._samples),
+            "seconds": self.seconds,
+            "index_rebuild_seconds": self.index_seconds,
+            "rows_per_second": rows / self.seconds if self.seconds else None
+        }
+
+
+def _lineage_values(taxonomy: Dict[str, str]) -> Tuple:
+    """Lineage column values of a taxonomy dict, in LINEAGE_COLUMNS order"""
+    return tuple(taxonomy.get(rank) for rank in RANKS)
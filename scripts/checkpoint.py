@@ -0,0 +1,97 @@
+"""
+Run checkpoints for the EDNA biodiversity pipeline
+Persists the progress of a long analyze_biodiversity run (input offset,
+diversity state, filter counters) as an atomically replaced JSON file next to
+an append-only file of compact result records, so a crashed or pre-empted run
+resumes from its last checkpoint instead of the first read
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import BinaryIO, Dict, Optional
+
+import numpy as np
+
+from result_records import RESULT_DTYPE
+
+
+class RunCheckpoint:
+    """JSON state file plus an append-only RESULT_DTYPE records file for one run"""
+
+    def __init__(self, path: str, settings: Dict):
+        self.path = path
+        self.records_path = path + ".records"
+        # Round-trip through JSON so tuples compare equal to what a saved state holds
+        self.settings = json.loads(json.dumps(settings))
+        self.records_count = 0
+        self._records: Optional[BinaryIO] = None
+
+    def load(self) -> Optional[Dict]:
+        """
+        Read the last saved state (None when starting fresh)
+
+        Raises:
+            ValueError: If the checkpoint was written by a run with different settings
+        """
+        if not os.path.exists(self.path):
+            self.records_count = 0
+            return None
+
+        with open(self.path, encoding="utf-8") as handle:
+            state = json.load(handle)
+        if state["settings"] != self.settings:
+            raise ValueError(f"Checkpoint {self.path} was written with different settings: {state['settings']}")
+
+        self.records_count = state["records_count"]
+        return state
+
+    def open_records(self):
+        """Open the records file for appending, dropping rows written after the last saved state"""
+        mode = "r+b" if os.path.exists(self.records_path) else "w+b"
+        self._records = open(self.records_path, mode)
+        self._records.truncate(self.records_count * RESULT_DTYPE.itemsize)
+        self._records.seek(0, os.SEEK_END)
+
+    def append_records(self, records: np.ndarray):
+        self._records.write(np.ascontiguousarray(records, dtype=RESULT_DTYPE).tobytes())
+        self.records_count += len(records)
+
+    def save(self, state: Dict):
+        """Make the appended records durable, then atomically replace the state file"""
+        if self._records is not None:
+            self._records.flush()
+            os.fsync(self._records.fileno())
+
+        state = {
+            **state,
+            "settings": self.settings,
+            "records_count": self.records_count,
+            "saved_at": datetime.now().isoformat()
+        }
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as handle:
+            json.dump(state, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temporary, self.path)
+
+    def read_records(self) -> np.ndarray:
+        """All records up to the current count"""
+        if self._records is not None:
+            self._records.flush()
+        if not os.path.exists(self.records_path):
+            return np.zeros(0, dtype=RESULT_DTYPE)
+        return np.fromfile(self.records_path, dtype=RESULT_DTYPE, count=self.records_count)
+
+    def close(self):
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+
+    def remove(self):
+        """Delete the checkpoint once the run has finished"""
+        self.close()
+        for path in (self.path, self.records_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,221 @@
+"""
+Classification cache for the EDNA biodiversity pipeline
+Two-tier (in-process LRU + on-disk SQLite) cache of identify_species results,
+keyed by a hash of the cleaned sequence and the reference database version
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+class ClassificationCache:
+    """Content-addressed, bounded cache of per-sequence identification results"""
+
+    # New disk entries between exact recounts of the disk tier, which other processes may also write
+    RESYNC_INSERTS = 100000
+
+    def __init__(self, reference_version: str, db_path: Optional[str] = None,
+                 memory_size: int = 100000, disk_max_entries: int = 5000000):
+        self.reference_version = reference_version
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.disk_max_entries = disk_max_entries
+        self._memory: "OrderedDict[str, Dict]" = OrderedDict()
+        self._conn = None
+        self._conn_pid = None
+        # Running size of the disk tier, so trimming never has to count the table per batch
+        self._disk_entries: Optional[int] = None
+        self._inserts_since_count = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+        if self.db_path:
+            self._init_database()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Per-process SQLite connection (connections must not cross a fork)"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn_pid = os.getpid()
+            self._disk_entries = None
+        return self._conn
+
+    def _init_database(self):
+        """Create cache tables and drop stale entries from an older reference version"""
+        conn = self._connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS classification_cache (
+                cache_key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS classification_cache_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_used ON classification_cache (last_used)')
+
+        row = cursor.execute(
+            "SELECT value FROM classification_cache_meta WHERE key = 'reference_version'"
+        ).fetchone()
+        if row is None or row[0] != self.reference_version:
+            if row is not None:
+                self.stats["invalidations"] += 1
+            cursor.execute('DELETE FROM classification_cache')
+            cursor.execute(
+                "INSERT OR REPLACE INTO classification_cache_meta (key, value) VALUES ('reference_version', ?)",
+                (self.reference_version,)
+            )
+
+        conn.commit()
+        self._count_disk_entries(conn)
+
+    def key(self, cleaned_sequence: str) -> str:
+        """Content hash of a cleaned sequence under the current reference version"""
+        return hashlib.sha256(f"{self.reference_version}\0{cleaned_sequence}".encode()).hexdigest()
+
+    def get_many(self, cleaned_sequences: List[str]) -> List[Optional[Dict]]:
+        """Look up cached results, returning None for misses"""
+        keys = [self.key(seq) for seq in cleaned_sequences]
+        found: List[Optional[Dict]] = [None] * len(keys)
+        disk_lookups = []
+
+        for position, cache_key in enumerate(keys):
+            result = self._memory.get(cache_key)
+            if result is not None:
+                self._memory.move_to_end(cache_key)
+                self.stats["memory_hits"] += 1
+                found[position] = result
+            else:
+                disk_lookups.append(position)
+
+        if disk_lookups and self.db_path:
+            conn = self._connection()
+            wanted = {keys[position] for position in disk_lookups}
+            rows = {}
+            wanted_list = list(wanted)
+            for start in range(0, len(wanted_list), 500):
+                block = wanted_list[start:start + 500]
+                placeholders = ",".join("?" * len(block))
+                rows.update(conn.execute(
+                    f"SELECT cache_key, result FROM classification_cache WHERE cache_key IN ({placeholders})", block
+                ).fetchall())
+
+            if rows:
+                conn.executemany(
+                    "UPDATE classification_cache SET last_used = ? WHERE cache_key = ?",
+                    [(time.time(), cache_key) for cache_key in rows]
+                )
+                conn.commit()
+
+            for position in disk_lookups:
+                payload = rows.get(keys[position])
+                if payload is not None:
+                    result = json.loads(payload)
+                    self._remember(keys[position], result)
+                    self.stats["disk_hits"] += 1
+                    found[position] = result
+
+        self.stats["misses"] += sum(1 for result in found if result is None)
+        return found
+
+    def get(self, cleaned_sequence: str) -> Optional[Dict]:
+        """Look up a single cached result"""
+        return self.get_many([cleaned_sequence])[0]
+
+    def put_many(self, cleaned_sequences: List[str], results: List[Dict]):
+        """Store results in both tiers"""
+        keys = [self.key(seq) for seq in cleaned_sequences]
+        for cache_key, result in zip(keys, results):
+            self._remember(cache_key, result)
+
+        if self.db_path and keys:
+            conn = self._connection()
+            now = time.time()
+            distinct = list(set(keys))
+            stored = 0
+            for start in range(0, len(distinct), 500):
+                block = distinct[start:start + 500]
+                placeholders = ",".join("?" * len(block))
+                stored += conn.execute(
+                    f"SELECT COUNT(*) FROM classification_cache WHERE cache_key IN ({placeholders})", block
+                ).fetchone()[0]
+            conn.executemany(
+                "INSERT OR REPLACE INTO classification_cache (cache_key, result, last_used) VALUES (?, ?, ?)",
+                [(cache_key, json.dumps(result), now) for cache_key, result in zip(keys, results)]
+            )
+            self._evict_disk(conn, len(distinct) - stored)
+            conn.commit()
+
+    def put(self, cleaned_sequence: str, result: Dict):
+        """Store a single result"""
+        self.put_many([cleaned_sequence], [result])
+
+    def _remember(self, cache_key: str, result: Dict):
+        """Insert into the in-process LRU tier, evicting the least recently used entries"""
+        if self.memory_size <= 0:
+            return
+        self._memory[cache_key] = result
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _count_disk_entries(self, conn: sqlite3.Connection):
+        """Seed the running disk tier size with an exact count"""
+        (self._disk_entries,) = conn.execute("SELECT COUNT(*) FROM classification_cache").fetchone()
+        self._inserts_since_count = 0
+
+    def _evict_disk(self, conn: sqlite3.Connection, inserted: int):
+        """Trim the SQLite tier back to disk_max_entries by last use, given how many new keys were stored"""
+        self._inserts_since_count += inserted
+        if self._disk_entries is None or self._inserts_since_count >= self.RESYNC_INSERTS:
+            self._count_disk_entries(conn)
+        else:
+            self._disk_entries += inserted
+        excess = self._disk_entries - self.disk_max_entries
+        if excess > 0:
+            deleted = conn.execute('''
+                DELETE FROM classification_cache WHERE cache_key IN (
+                    SELECT cache_key FROM classification_cache ORDER BY last_used LIMIT ?
+                )
+            ''', (excess,)).rowcount
+            self._disk_entries -= deleted
+            self.stats["evictions"] += deleted
+
+    def clear(self):
+        """Drop every cached entry"""
+        self._memory.clear()
+        if self.db_path:
+            conn = self._connection()
+            conn.execute('DELETE FROM classification_cache')
+            conn.commit()
+            self._disk_entries = 0
+
+    def get_stats(self) -> Dict:
+        """Hit/miss counters and current tier sizes"""
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0,
+            "memory_entries": len(self._memory)
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_conn_pid"] = None
+        return state
@@ -3,16 +3,41 @@ Database setup script for EDNA biodiversity pipeline
 Creates tables for storing ML analysis results and taxonomic data
 """
 
+import argparse
+import json
 import sqlite3
+import sys
 from datetime import datetime
 
-def create_database_schema():
+def create_database_schema(db_path: str = 'edna_biodiversity.db'):
     """Create database schema for EDNA pipeline"""
     
+    # Repair an interrupted bulk load first, while its missing triggers still show
+    recovered = recover_interrupted_load(db_path)
+    
     # Connect to database (creates if doesn't exist)
-    conn = sqlite3.connect('edna_biodiversity.db')
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
+    create_analysis_tables(cursor)
+    create_pipeline_run_tables(cursor)
+    
+    conn.commit()
+    print("Database schema created successfully!")
+    
+    if recovered and (recovered['indexes'] or recovered['summaries_rebuilt']):
+        print(f"Repaired an interrupted bulk load: {recovered['indexes']} indexes rebuilt, "
+              f"summaries rebuilt: {recovered['summaries_rebuilt']}")
+    
+    # Insert sample reference data
+    insert_sample_data(cursor)
+    conn.commit()
+    
+    conn.close()
+
+def create_analysis_tables(cursor):
+    """Create the sample, sequence, identification, report and reference taxonomy tables with their indexes"""
+    
     # Samples table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS samples (
@@ -32,19 +57,33 @@ def create_database_schema():
         )
     ''')
     
-    # Sequences table
+    # Unique sequences, 2-bit packed and keyed by SHA-1 content hash (see sequence_storage.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sequence_blobs (
+            id INTEGER PRIMARY KEY,
+            content_hash BLOB UNIQUE NOT NULL,
+            sequence_length INTEGER NOT NULL,
+            packed_sequence BLOB NOT NULL,
+            exceptions TEXT
+        )
+    ''')
+    
+    # Sequences table; packed rows leave sequence_data NULL and point at a blob with an abundance
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sequences (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             sample_id TEXT,
-            sequence_data TEXT NOT NULL,
+            sequence_data TEXT,
             sequence_length INTEGER,
             gc_content REAL,
             quality_score REAL,
             primer_used TEXT,
             sequencing_platform TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (sample_id) REFERENCES samples (sample_id)
+            blob_id INTEGER,
+            abundance INTEGER DEFAULT 1,
+            FOREIGN KEY (sample_id) REFERENCES samples (sample_id),
+            FOREIGN KEY (blob_id) REFERENCES sequence_blobs (id)
         )
     ''')
     
@@ -108,6 +147,326 @@ def create_database_schema():
         )
     ''')
     
+    # Create indexes for better performance
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_location ON samples (latitude, longitude)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sequences_sample ON sequences (sample_id)')
+    # Databases created before packed storage get blob_id from `python sequence_storage.py migrate`
+    if 'blob_id' in {row[1] for row in cursor.execute('PRAGMA table_info(sequences)').fetchall()}:
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sequences_blob ON sequences (blob_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_species_sequence ON species_identifications (sequence_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_species_name ON species_identifications (species_name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_taxonomy_species ON reference_taxonomy (species_name)')
+    
+    create_deferred_objects_table(cursor)
+    create_summary_tables(cursor)
+
+def create_deferred_objects_table(cursor):
+    """Create the table of schema objects a bulk load dropped, committed with the drop so a crashed load can be undone"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deferred_schema_objects (
+            name TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            sql TEXT NOT NULL
+        )
+    ''')
+
+# Ranks rolled up in sample_rank_counts, with their species_identifications column
+SUMMARY_RANKS = (
+    ('kingdom', 'kingdom'),
+    ('phylum', 'phylum'),
+    ('class', 'class'),
+    ('order', 'order_name'),
+    ('family', 'family'),
+    ('genus', 'genus')
+)
+
+# Triggers keeping the summary tables current; the bulk loader drops them by this prefix during a load
+SUMMARY_TRIGGER_PREFIX = 'trg_summary_'
+
+SPECIES_COUNT_UPSERT = '''
+    INSERT INTO sample_species_counts (sample_id, species_name, read_count) VALUES (?, ?, ?)
+    ON CONFLICT (sample_id, species_name) DO UPDATE SET read_count = read_count + excluded.read_count
+'''
+
+RANK_COUNT_UPSERT = '''
+    INSERT INTO sample_rank_counts (sample_id, rank, taxon, read_count) VALUES (?, ?, ?, ?)
+    ON CONFLICT (sample_id, rank, taxon) DO UPDATE SET read_count = read_count + excluded.read_count
+'''
+
+def create_summary_tables(cursor, replace_triggers=False):
+    """
+    Create the per-sample summary tables and the triggers maintaining them
+    
+    sample_species_counts holds reads per (sample, species) and
+    sample_rank_counts reads per (sample, rank, taxon) for SUMMARY_RANKS, both
+    weighted by sequences.abundance where the schema has it. Pass
+    replace_triggers after a schema change (e.g. the packed storage migration).
+    """
+    
+    # Reads per sample and species
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sample_species_counts (
+            sample_id TEXT NOT NULL,
+            species_name TEXT NOT NULL,
+            read_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (sample_id, species_name)
+        )
+    ''')
+    
+    # Reads per sample and taxon at every rank above species
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sample_rank_counts (
+            sample_id TEXT NOT NULL,
+            rank TEXT NOT NULL,
+            taxon TEXT NOT NULL,
+            read_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (sample_id, rank, taxon)
+        )
+    ''')
+    
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_species_counts_species ON sample_species_counts (species_name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rank_counts_taxon ON sample_rank_counts (rank, taxon)')
+    
+    if replace_triggers:
+        for (name,) in cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE ?", (SUMMARY_TRIGGER_PREFIX + '%',)
+        ).fetchall():
+            cursor.execute(f'DROP TRIGGER "{name}"')
+    
+    # Databases not migrated to packed storage count every sequences row once
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(sequences)').fetchall()}
+    abundance = 'COALESCE({}.abundance, 1)' if 'abundance' in columns else '1'
+    sequence_updates = 'abundance, sample_id' if 'abundance' in columns else 'sample_id'
+    
+    new_sample = '(SELECT sample_id FROM sequences WHERE id = NEW.sequence_id)'
+    old_sample = '(SELECT sample_id FROM sequences WHERE id = OLD.sequence_id)'
+    triggers = {
+        'identification_insert': (
+            'AFTER INSERT ON species_identifications',
+            _summary_deltas('NEW', 'sequences s', 's.id = NEW.sequence_id', 's.sample_id', abundance.format('s'))
+        ),
+        'identification_delete': (
+            'AFTER DELETE ON species_identifications',
+            _summary_deltas('OLD', 'sequences s', 's.id = OLD.sequence_id', 's.sample_id',
+                            '-' + abundance.format('s')) + _summary_cleanup(old_sample)
+        ),
+        'identification_update': (
+            'AFTER UPDATE OF sequence_id, species_name, kingdom, phylum, class, order_name, family, genus '
+            'ON species_identifications',
+            _summary_deltas('OLD', 'sequences s', 's.id = OLD.sequence_id', 's.sample_id', '-' + abundance.format('s'))
+            + _summary_deltas('NEW', 'sequences s', 's.id = NEW.sequence_id', 's.sample_id', abundance.format('s'))
+            + _summary_cleanup(old_sample) + _summary_cleanup(new_sample)
+        ),
+        'sequence_update': (
+            f'AFTER UPDATE OF {sequence_updates} ON sequences',
+            _summary_deltas('si', 'species_identifications si', 'si.sequence_id = OLD.id', 'OLD.sample_id',
+                            '-' + abundance.format('OLD'))
+            + _summary_deltas('si', 'species_identifications si', 'si.sequence_id = NEW.id', 'NEW.sample_id',
+                              abundance.format('NEW'))
+            + _summary_cleanup('OLD.sample_id')
+        ),
+        'sequence_delete': (
+            'AFTER DELETE ON sequences',
+            _summary_deltas('si', 'species_identifications si', 'si.sequence_id = OLD.id', 'OLD.sample_id',
+                            '-' + abundance.format('OLD'))
+            + _summary_cleanup('OLD.sample_id')
+        )
+    }
+    for name, (event, statements) in triggers.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {SUMMARY_TRIGGER_PREFIX}{name} {event}
+            BEGIN
+                {" ".join(statements)}
+            END
+        ''')
+
+def _summary_deltas(row, source, condition, sample, weight):
+    """Trigger statements adding weight for identification `row` (joined via source) to both summaries"""
+    statements = [f'''
+        INSERT INTO sample_species_counts (sample_id, species_name, read_count)
+        SELECT {sample}, {row}.species_name, {weight} FROM {source}
+        WHERE {condition} AND {sample} IS NOT NULL AND {row}.species_name IS NOT NULL AND {row}.species_name != ''
+        ON CONFLICT (sample_id, species_name) DO UPDATE SET read_count = read_count + excluded.read_count;
+    ''']
+    for rank, column in SUMMARY_RANKS:
+        statements.append(f'''
+            INSERT INTO sample_rank_counts (sample_id, rank, taxon, read_count)
+            SELECT {sample}, '{rank}', {row}.{column}, {weight} FROM {source}
+            WHERE {condition} AND {sample} IS NOT NULL AND {row}.{column} IS NOT NULL AND {row}.{column} != ''
+            ON CONFLICT (sample_id, rank, taxon) DO UPDATE SET read_count = read_count + excluded.read_count;
+        ''')
+    return statements
+
+def _summary_cleanup(sample):
+    """Trigger statements dropping a sample's summary rows that reached zero"""
+    return [
+        f'DELETE FROM sample_species_counts WHERE sample_id = {sample} AND read_count <= 0;',
+        f'DELETE FROM sample_rank_counts WHERE sample_id = {sample} AND read_count <= 0;'
+    ]
+
+def _summary_queries(cursor):
+    """Full aggregation queries of (sample_species_counts, sample_rank_counts) from the base tables"""
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(sequences)').fetchall()}
+    weight = 'SUM(COALESCE(s.abundance, 1))' if 'abundance' in columns else 'COUNT(*)'
+    species = f'''
+        SELECT s.sample_id, si.species_name, {weight}
+        FROM species_identifications si JOIN sequences s ON s.id = si.sequence_id
+        WHERE s.sample_id IS NOT NULL AND si.species_name IS NOT NULL AND si.species_name != ''
+        GROUP BY s.sample_id, si.species_name
+    '''
+    ranks = ' UNION ALL '.join(f'''
+        SELECT s.sample_id, '{rank}', si.{column}, {weight}
+        FROM species_identifications si JOIN sequences s ON s.id = si.sequence_id
+        WHERE s.sample_id IS NOT NULL AND si.{column} IS NOT NULL AND si.{column} != ''
+        GROUP BY s.sample_id, si.{column}
+    ''' for rank, column in SUMMARY_RANKS)
+    return species, ranks
+
+def rebuild_summary_tables(db_path='edna_biodiversity.db'):
+    """Recompute both summary tables from sequences and species_identifications"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    cursor = conn.cursor()
+    try:
+        create_summary_tables(cursor)
+        counts = _rebuild_summaries(cursor)
+        conn.commit()
+        return counts
+    finally:
+        conn.close()
+
+def _rebuild_summaries(cursor):
+    """Replace both summary tables' rows with a fresh aggregation, returning their row counts"""
+    species, ranks = _summary_queries(cursor)
+    cursor.execute('DELETE FROM sample_species_counts')
+    cursor.execute('DELETE FROM sample_rank_counts')
+    cursor.execute(f'INSERT INTO sample_species_counts (sample_id, species_name, read_count) {species}')
+    cursor.execute(f'INSERT INTO sample_rank_counts (sample_id, rank, taxon, read_count) {ranks}')
+    return {
+        'species_rows': cursor.execute('SELECT COUNT(*) FROM sample_species_counts').fetchone()[0],
+        'rank_rows': cursor.execute('SELECT COUNT(*) FROM sample_rank_counts').fetchone()[0]
+    }
+
+def restore_deferred_indexes(cursor):
+    """Recreate the indexes recorded in deferred_schema_objects that are missing and clear them; returns the count"""
+    existing = {name for (name,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()}
+    rebuilt = 0
+    for name, sql in cursor.execute(
+        "SELECT name, sql FROM deferred_schema_objects WHERE type = 'index'"
+    ).fetchall():
+        if name not in existing:
+            cursor.execute(sql)
+            rebuilt += 1
+    cursor.execute("DELETE FROM deferred_schema_objects WHERE type = 'index'")
+    return rebuilt
+
+def summary_triggers_missing(cursor):
+    """
+    Whether a bulk load left the summary triggers dropped: they are recorded in
+    deferred_schema_objects, or a database with identifications has none at all
+    """
+    names = {name for (name,) in cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"
+    ).fetchall()}
+    if 'species_identifications' not in names:
+        return False
+    if 'deferred_schema_objects' in names and cursor.execute(
+        "SELECT 1 FROM deferred_schema_objects WHERE type = 'trigger' LIMIT 1"
+    ).fetchone():
+        return True
+    return not any(name.startswith(SUMMARY_TRIGGER_PREFIX) for name in names)
+
+def restore_summary_triggers(cursor, rebuild=True):
+    """
+    Recreate the summary triggers and clear their deferred_schema_objects markers
+    
+    With rebuild the summary tables are recomputed as well, since rows written
+    while the triggers were gone were never counted.
+    """
+    create_summary_tables(cursor)
+    if rebuild:
+        _rebuild_summaries(cursor)
+    cursor.execute("DELETE FROM deferred_schema_objects WHERE type = 'trigger'")
+
+def recover_interrupted_load(db_path='edna_biodiversity.db'):
+    """
+    Undo what a crashed bulk load left behind: rebuild its dropped indexes and,
+    if the summary triggers are missing, recreate them and recompute the summaries
+    
+    Does nothing while another connection holds the write lock, since that is
+    a load still in progress.
+    
+    Returns:
+        Dictionary with the number of indexes rebuilt and whether the summaries
+        were rebuilt, or None if a load is running
+    """
+    conn = sqlite3.connect(db_path, timeout=0, isolation_level=None)
+    try:
+        cursor = conn.cursor()
+        has_markers = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'deferred_schema_objects'"
+        ).fetchone() and cursor.execute('SELECT 1 FROM deferred_schema_objects LIMIT 1').fetchone()
+        if not has_markers and not summary_triggers_missing(cursor):
+            return {'indexes': 0, 'summaries_rebuilt': False}
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            return None
+        try:
+            cursor.execute('PRAGMA busy_timeout = 30000')
+            # Decide again under the lock; a load may have finished in between
+            stale_summaries = summary_triggers_missing(cursor)
+            create_deferred_objects_table(cursor)
+            recovered = {'indexes': restore_deferred_indexes(cursor), 'summaries_rebuilt': stale_summaries}
+            if stale_summaries:
+                restore_summary_triggers(cursor)
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return recovered
+    finally:
+        conn.close()
+
+def check_summary_tables(db_path='edna_biodiversity.db', max_examples=10):
+    """
+    Compare the summary tables with a fresh aggregation of the base tables
+    
+    Returns:
+        Dictionary with consistent, the number of differing rows per table and
+        up to max_examples (table, sample, taxon, stored, expected) examples
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    cursor = conn.cursor()
+    try:
+        create_summary_tables(cursor)
+        species, ranks = _summary_queries(cursor)
+        comparisons = {
+            'sample_species_counts': (
+                species, "SELECT sample_id, species_name, read_count FROM sample_species_counts WHERE read_count != 0",
+                2
+            ),
+            'sample_rank_counts': (
+                ranks, "SELECT sample_id, rank, taxon, read_count FROM sample_rank_counts WHERE read_count != 0", 3
+            )
+        }
+        report = {'consistent': True, 'mismatches': {}, 'examples': []}
+        for table, (expected_query, stored_query, key_size) in comparisons.items():
+            expected = {row[:key_size]: row[key_size] for row in cursor.execute(expected_query)}
+            stored = {row[:key_size]: row[key_size] for row in cursor.execute(stored_query)}
+            differing = [key for key in expected.keys() | stored.keys() if expected.get(key) != stored.get(key)]
+            report['mismatches'][table] = len(differing)
+            report['consistent'] = report['consistent'] and not differing
+            for key in sorted(differing)[:max_examples - len(report['examples'])]:
+                report['examples'].append({
+                    'table': table, 'key': list(key), 'stored': stored.get(key), 'expected': expected.get(key)
+                })
+        return report
+    finally:
+        conn.close()
+
+def create_pipeline_run_tables(cursor):
+    """Create the pipeline_runs table with its profiling detail and job queue tables"""
+    
     # Pipeline runs table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS pipeline_runs (
@@ -124,21 +483,50 @@ def create_database_schema():
         )
     ''')
     
-    # Create indexes for better performance
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_location ON samples (latitude, longitude)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sequences_sample ON sequences (sample_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_species_sequence ON species_identifications (sequence_id)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_species_name ON species_identifications (species_name)')
-    cursor.execute('CREATE INDEX IF NOT EXISTS idx_taxonomy_species ON reference_taxonomy (species_name)')
+    # Per-stage timings of a pipeline run
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_stage_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
+            stage_name TEXT NOT NULL,
+            wall_seconds REAL,
+            calls INTEGER,
+            items INTEGER,
+            items_per_second REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (run_id) REFERENCES pipeline_runs (run_id)
+        )
+    ''')
     
-    conn.commit()
-    print("Database schema created successfully!")
+    # Run-level metrics (reads/sec, cache hits, peak memory, ...)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_run_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
+            metric_name TEXT NOT NULL,
+            metric_value REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (run_id) REFERENCES pipeline_runs (run_id)
+        )
+    ''')
     
-    # Insert sample reference data
-    insert_sample_data(cursor)
-    conn.commit()
+    # Job queue of the pipeline worker service; status lives in pipeline_runs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT UNIQUE NOT NULL,
+            payload TEXT NOT NULL,
+            progress REAL DEFAULT 0,
+            current_step TEXT,
+            reads_processed INTEGER DEFAULT 0,
+            report_path TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (run_id) REFERENCES pipeline_runs (run_id)
+        )
+    ''')
     
-    conn.close()
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stage_metrics_run ON pipeline_stage_metrics (run_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_run_metrics_run ON pipeline_run_metrics (run_id)')
 
 def insert_sample_data(cursor):
     """Insert sample reference taxonomy data"""
@@ -161,6 +549,19 @@ def insert_sample_data(cursor):
     print("Sample reference data inserted successfully!")
 
 if __name__ == "__main__":
-    print("Setting up EDNA Biodiversity Database...")
-    create_database_schema()
-    print("Database setup complete!")
+    parser = argparse.ArgumentParser(description="EDNA Biodiversity Database setup and maintenance")
+    parser.add_argument("command", nargs="?", default="setup", choices=["setup", "rebuild-summaries", "check-summaries"])
+    parser.add_argument("--db", default="edna_biodiversity.db")
+    args = parser.parse_args()
+    
+    if args.command == "rebuild-summaries":
+        counts = rebuild_summary_tables(args.db)
+        print(f"Summary tables rebuilt: {counts['species_rows']} species rows, {counts['rank_rows']} rank rows")
+    elif args.command == "check-summaries":
+        report = check_summary_tables(args.db)
+        print(json.dumps(report, indent=2))
+        sys.exit(0 if report['consistent'] else 1)
+    else:
+        print("Setting up EDNA Biodiversity Database...")
+        create_database_schema(args.db)
+        print("Database setup complete!")
@@ -0,0 +1,308 @@
+"""
+Diversity metrics for the EDNA biodiversity pipeline
+Incremental, mergeable accumulator of species counts that can report
+richness, Shannon, Simpson and Chao1 at any point of a streaming run, plus
+batched rarefaction curves and bootstrap confidence intervals
+"""
+
+import json
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+
+def shannon_rows(counts: np.ndarray) -> np.ndarray:
+    """Shannon index of every row of a (replicates x species) count matrix"""
+    counts = np.asarray(counts, dtype=np.float64)
+    totals = counts.sum(axis=1, keepdims=True)
+    proportions = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+    logs = np.log(proportions, out=np.zeros_like(proportions), where=proportions > 0)
+    return -(proportions * logs).sum(axis=1)
+
+
+def simpson_rows(counts: np.ndarray) -> np.ndarray:
+    """Gini-Simpson index of every row of a count matrix"""
+    counts = np.asarray(counts, dtype=np.float64)
+    totals = counts.sum(axis=1, keepdims=True)
+    proportions = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+    return np.where(totals[:, 0] > 0, 1.0 - (proportions ** 2).sum(axis=1), 0.0)
+
+
+def chao1_rows(counts: np.ndarray) -> np.ndarray:
+    """Bias-corrected Chao1 estimate of every row of a count matrix"""
+    counts = np.asarray(counts)
+    richness = (counts > 0).sum(axis=1)
+    singletons = (counts == 1).sum(axis=1)
+    doubletons = (counts == 2).sum(axis=1)
+    return richness + singletons * (singletons - 1) / (2 * (doubletons + 1))
+
+
+def rarefaction_curve(counts: Sequence[int], depths: Optional[Sequence[int]] = None, steps: int = 20,
+                      iterations: int = 100, seed: Optional[int] = None) -> Dict:
+    """
+    Rarefy a species count vector to a range of sequencing depths
+
+    Every depth draws all replicates at once from a multivariate
+    hypergeometric (subsampling reads without replacement).
+
+    Args:
+        counts: Reads per species
+        depths: Depths to evaluate (defaults to steps evenly spaced depths up to the total)
+        steps: Number of default depths
+        iterations: Replicate subsamples per depth
+        seed: Random seed for reproducible curves
+
+    Returns:
+        Dictionary of per-depth mean richness and Shannon with 95% intervals
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    rng = np.random.default_rng(seed)
+
+    if depths is None:
+        depths = np.unique(np.linspace(0, total, steps + 1).astype(np.int64)[1:]) if total else []
+    depths = [int(depth) for depth in depths if 0 < depth <= total]
+
+    curve = {"depths": depths, "richness_mean": [], "richness_lower": [], "richness_upper": [],
+             "shannon_mean": [], "shannon_lower": [], "shannon_upper": [], "iterations": iterations}
+
+    for depth in depths:
+        draws = rng.multivariate_hypergeometric(counts, depth, size=iterations)
+        richness = (draws > 0).sum(axis=1)
+        shannon = shannon_rows(draws)
+
+        curve["richness_mean"].append(float(richness.mean()))
+        curve["richness_lower"].append(float(np.percentile(richness, 2.5)))
+        curve["richness_upper"].append(float(np.percentile(richness, 97.5)))
+        curve["shannon_mean"].append(float(shannon.mean()))
+        curve["shannon_lower"].append(float(np.percentile(shannon, 2.5)))
+        curve["shannon_upper"].append(float(np.percentile(shannon, 97.5)))
+
+    return curve
+
+
+def bootstrap_diversity(counts: Sequence[int], iterations: int = 1000, confidence: float = 0.95,
+                        depth: Optional[int] = None, seed: Optional[int] = None) -> Dict:
+    """
+    Bootstrap confidence intervals for diversity metrics
+
+    All replicates are drawn in one multinomial call over the observed
+    species proportions, then every metric is computed row-wise.
+
+    Args:
+        counts: Reads per species
+        iterations: Number of bootstrap replicates
+        confidence: Two-sided interval coverage
+        depth: Reads per replicate (defaults to the observed total)
+        seed: Random seed for reproducible intervals
+
+    Returns:
+        Dictionary mapping each metric to its mean, lower and upper bound
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    total = int(counts.sum())
+    depth = total if depth is None else depth
+    metrics = ("richness", "shannon", "simpson", "chao1")
+
+    if total == 0 or depth == 0:
+        return {metric: {"mean": 0.0, "lower": 0.0, "upper": 0.0} for metric in metrics}
+
+    rng = np.random.default_rng(seed)
+    draws = rng.multinomial(depth, counts / total, size=iterations)
+    values = {
+        "richness": (draws > 0).sum(axis=1),
+        "shannon": shannon_rows(draws),
+        "simpson": simpson_rows(draws),
+        "chao1": chao1_rows(draws)
+    }
+
+    tail = (1 - confidence) / 2 * 100
+    return {
+        metric: {
+            "mean": float(values[metric].mean()),
+            "lower": float(np.percentile(values[metric], tail)),
+            "upper": float(np.percentile(values[metric], 100 - tail))
+        }
+        for metric in metrics
+    }
+
+
+def bootstrap_samples(sample_counts: Dict[str, Sequence[int]], iterations: int = 1000,
+                      confidence: float = 0.95, seed: Optional[int] = None) -> Dict[str, Dict]:
+    """Bootstrap intervals for many samples, sharing one seeded generator"""
+    rng = np.random.default_rng(seed)
+    return {
+        sample_id: bootstrap_diversity(counts, iterations=iterations, confidence=confidence,
+                                       seed=int(rng.integers(2 ** 32)))
+        for sample_id, counts in sample_counts.items()
+    }
+
+
+class DiversityAccumulator:
+    """
+    Streaming species-count accumulator, serializable and mergeable across shards
+
+    Optionally also counts reads per taxon at higher ranks (e.g. genus,
+    family), including reads only resolved to a common ancestor.
+    """
+
+    def __init__(self, ranks: Sequence[str] = ()):
+        self.species_counts: Dict[str, int] = {}
+        self.total_sequences = 0
+        self.identified_sequences = 0
+        self.status_counts: Dict[str, int] = {}
+        self.rank_counts: Dict[str, Dict[str, int]] = {rank: {} for rank in ranks}
+
+    def update(self, result: Dict, weight: int = 1):
+        """Add one identification result, counted weight times"""
+        self.total_sequences += weight
+        status = result["status"]
+        self.status_counts[status] = self.status_counts.get(status, 0) + weight
+
+        if status == "identified":
+            self.identified_sequences += weight
+            species = result["species"]
+            self.species_counts[species] = self.species_counts.get(species, 0) + weight
+
+        if status in ("identified", "higher_taxon"):
+            for rank, counts in self.rank_counts.items():
+                taxon = result["taxonomy"].get(rank)
+                if taxon:
+                    counts[taxon] = counts.get(taxon, 0) + weight
+
+    def update_batch(self, batch, weights: Optional[np.ndarray] = None):
+        """Add a compact ResultBatch in one vectorized step, optionally weighted per row"""
+        for status, count in batch.status_totals(weights).items():
+            self.status_counts[status] = self.status_counts.get(status, 0) + count
+            self.total_sequences += count
+            if status == "identified":
+                self.identified_sequences += count
+
+        for species, count in batch.species_totals(weights):
+            self.species_counts[species] = self.species_counts.get(species, 0) + count
+
+        for rank, counts in self.rank_counts.items():
+            for taxon, count in batch.rank_totals(rank, weights):
+                counts[taxon] = counts.get(taxon, 0) + count
+
+    def update_many(self, results: Iterable[Dict]):
+        """Add a sequence of unweighted results"""
+        for result in results:
+            self.update(result)
+
+    def merge(self, other: "DiversityAccumulator") -> "DiversityAccumulator":
+        """Fold another shard's counts into this accumulator"""
+        self.total_sequences += other.total_sequences
+        self.identified_sequences += other.identified_sequences
+        for status, count in other.status_counts.items():
+            self.status_counts[status] = self.status_counts.get(status, 0) + count
+        for species, count in other.species_counts.items():
+            self.species_counts[species] = self.species_counts.get(species, 0) + count
+        for rank, other_counts in other.rank_counts.items():
+            counts = self.rank_counts.setdefault(rank, {})
+            for taxon, count in other_counts.items():
+                counts[taxon] = counts.get(taxon, 0) + count
+        return self
+
+    @property
+    def richness(self) -> int:
+        """Number of distinct species observed"""
+        return len(self.species_counts)
+
+    @property
+    def shannon(self) -> float:
+        """Shannon diversity index H' (natural log)"""
+        shannon_diversity = 0
+        if self.identified_sequences > 0:
+            for count in self.species_counts.values():
+                p = count / self.identified_sequences
+                shannon_diversity -= p * np.log(p)
+        return shannon_diversity
+
+    @property
+    def simpson(self) -> float:
+        """Gini-Simpson index 1 - sum(p^2)"""
+        if self.identified_sequences == 0:
+            return 0.0
+        counts = np.fromiter(self.species_counts.values(), dtype=np.float64)
+        proportions = counts / self.identified_sequences
+        return float(1.0 - np.sum(proportions ** 2))
+
+    @property
+    def chao1(self) -> float:
+        """Bias-corrected Chao1 richness estimate from singletons and doubletons"""
+        singletons = sum(1 for count in self.species_counts.values() if count == 1)
+        doubletons = sum(1 for count in self.species_counts.values() if count == 2)
+        return self.richness + singletons * (singletons - 1) / (2 * (doubletons + 1))
+
+    def rarefaction(self, iterations: int = 100, steps: int = 20, seed: Optional[int] = None) -> Dict:
+        """Rarefaction curve of the current species counts"""
+        return rarefaction_curve(list(self.species_counts.values()), steps=steps, iterations=iterations, seed=seed)
+
+    def bootstrap(self, iterations: int = 1000, confidence: float = 0.95, seed: Optional[int] = None) -> Dict:
+        """Bootstrap confidence intervals of the current diversity metrics"""
+        return bootstrap_diversity(list(self.species_counts.values()), iterations=iterations,
+                                   confidence=confidence, seed=seed)
+
+    def metrics(self) -> Dict:
+        """Current diversity metrics"""
+        return {
+            "richness": self.richness,
+            "shannon": self.shannon,
+            "simpson": self.simpson,
+            "chao1": self.chao1
+        }
+
+    def rank_metrics(self, rank: str) -> Dict:
+        """Richness, Shannon, Simpson and Chao1 of the taxa counted at a tracked rank"""
+        counts = np.fromiter(self.rank_counts[rank].values(), dtype=np.int64)[None, :]
+        return {
+            "richness": int((counts > 0).sum()),
+            "shannon": float(shannon_rows(counts)[0]),
+            "simpson": float(simpson_rows(counts)[0]),
+            "chao1": float(chao1_rows(counts)[0])
+        }
+
+    def to_dict(self) -> Dict:
+        """JSON-serializable state"""
+        return {
+            "species_counts": dict(self.species_counts),
+            "total_sequences": self.total_sequences,
+            "identified_sequences": self.identified_sequences,
+            "status_counts": dict(self.status_counts),
+            "rank_counts": {rank: dict(counts) for rank, counts in self.rank_counts.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "DiversityAccumulator":
+        """Rebuild an accumulator from to_dict() output"""
+        accumulator = cls()
+        accumulator.load_state(data)
+        return accumulator
+
+    def load_state(self, data: Dict):
+        """Replace this accumulator's counts with to_dict() output (e.g. when resuming a run)"""
+        self.species_counts = dict(data["species_counts"])
+        self.total_sequences = data["total_sequences"]
+        self.identified_sequences = data["identified_sequences"]
+        self.status_counts = dict(data.get("status_counts", {}))
+        self.rank_counts = {rank: dict(counts) for rank, counts in data.get("rank_counts", {}).items()}
+
+    def save(self, path: str):
+        """Write the accumulator state to a JSON file"""
+        with open(path, "w") as handle:
+            json.dump(self.to_dict(), handle)
+
+    @classmethod
+    def load(cls, path: str) -> "DiversityAccumulator":
+        """Read an accumulator written by save()"""
+        with open(path) as handle:
+            return cls.from_dict(json.load(handle))
+
+    @classmethod
+    def merged(cls, shards: Iterable["DiversityAccumulator"], into: Optional["DiversityAccumulator"] = None):
+        """Merge any number of shard accumulators into a new (or given) one"""
+        accumulator = into if into is not None else cls()
+        for shard in shards:
+            accumulator.merge(shard)
+        return accumulator
@@ -0,0 +1,222 @@
+"""
+Run instrumentation for the EDNA biodiversity pipeline
+Collects wall time per stage, throughput, cache hits and peak memory through
+a context-manager API and persists them per run in pipeline_runs plus the
+pipeline_stage_metrics / pipeline_run_metrics detail tables. A disabled
+profiler hands out a shared no-op context, so the hooks cost almost nothing.
+"""
+
+import sqlite3
+import sys
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+from database_setup import create_pipeline_run_tables
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_NULL_STAGE = nullcontext()
+
+
+def peak_memory_mb() -> Optional[float]:
+    """Peak resident set size of this process in MiB (None where unsupported)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is bytes on macOS and kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class _StageTimer:
+    """Times one with-block and adds it to the profiler's stage totals"""
+
+    __slots__ = ("profiler", "name", "items", "started")
+
+    def __init__(self, profiler: "PipelineProfiler", name: str, items: int):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self) -> "_StageTimer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.started, self.items)
+
+
+class PipelineProfiler:
+    """Per-stage timing and run metrics, optionally persisted to the pipeline database"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """Forget all stage totals and metrics"""
+        self.stages: Dict[str, Dict] = {}
+        self.metrics: Dict[str, float] = {}
+
+    def stage(self, name: str, items: int = 0):
+        """
+        Context manager timing one stage; set .items on the returned timer if
+        the item count is only known at the end of the block
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _StageTimer(self, name, items)
+
+    def record(self, name: str, seconds: float, items: int = 0):
+        """Add an already measured duration to a stage"""
+        if not self.enabled:
+            return
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = {"wall_seconds": 0.0, "calls": 0, "items": 0}
+        totals["wall_seconds"] += seconds
+        totals["calls"] += 1
+        totals["items"] += items
+
+    def set_metric(self, name: str, value: Optional[float]):
+        """Store a run-level metric (None values are skipped)"""
+        if self.enabled and value is not None:
+            self.metrics[name] = float(value)
+
+    def stage_summary(self) -> Dict[str, Dict]:
+        """Stage totals with items_per_second"""
+        return {
+            name: {
+                **totals,
+                "items_per_second": totals["items"] / totals["wall_seconds"] if totals["wall_seconds"] else None
+            }
+            for name, totals in self.stages.items()
+        }
+
+    def summary(self) -> Dict:
+        """Stages and run metrics, with current peak memory"""
+        metrics = dict(self.metrics)
+        if self.enabled:
+            memory = peak_memory_mb()
+            if memory is not None:
+                metrics["peak_memory_mb"] = memory
+        return {"stages": self.stage_summary(), "metrics": metrics}
+
+    @contextmanager
+    def run(self, db_path: str = "edna_biodiversity.db", run_id: Optional[str] = None,
+            input_samples: Optional[str] = None) -> Iterator["ProfiledRun"]:
+        """
+        Profile one pipeline run and persist it on exit
+
+        Counters are reset on entry. The pipeline_runs row is marked running
+        on entry and completed (or failed, with the error message) on exit,
+        together with the stage and run metric detail rows. A disabled
+        profiler still yields a ProfiledRun but writes nothing.
+        """
+        profiled = ProfiledRun(run_id or f"RUN_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}")
+        if not self.enabled:
+            yield profiled
+            return
+
+        self.reset()
+        start_time = datetime.now()
+        started = time.perf_counter()
+        _save_run_start(db_path, profiled.run_id, start_time, input_samples)
+
+        status, error_message = "completed", None
+        try:
+            yield profiled
+        except BaseException as error:
+            status, error_message = "failed", f"{type(error).__name__}: {error}"
+            raise
+        finally:
+            processing_seconds = time.perf_counter() - started
+            summary = self.summary()
+            _save_run_end(db_path, profiled.run_id, status, datetime.now(), processing_seconds,
+                          profiled.output_report_id, error_message, summary)
+            profiled.summary = summary
+
+
+class ProfiledRun:
+    """Handle for a run in progress; set output_report_id before the run ends"""
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.output_report_id: Optional[str] = None
+        self.summary: Optional[Dict] = None
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=30)
+    create_pipeline_run_tables(conn.cursor())
+    return conn
+
+
+def _save_run_start(db_path: str, run_id: str, start_time: datetime, input_samples: Optional[str]):
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute('''
+                INSERT INTO pipeline_runs (run_id, status, start_time, input_samples)
+                VALUES (?, 'running', ?, ?)
+                ON CONFLICT (run_id) DO UPDATE SET
+                    status = 'running', start_time = excluded.start_time,
+                    input_samples = COALESCE(excluded.input_samples, input_samples)
+            ''', (run_id, start_time.isoformat(), input_samples))
+    finally:
+        conn.close()
+
+
+def _save_run_end(db_path: str, run_id: str, status: str, end_time: datetime, processing_seconds: float,
+                  output_report_id: Optional[str], error_message: Optional[str], summary: Dict):
+    conn = _connect(db_path)
+    try:
+        with conn:
+            conn.execute('''
+                UPDATE pipeline_runs
+                SET status = ?, end_time = ?, processing_time_seconds = ?,
+                    output_report_id = COALESCE(?, output_report_id), error_message = ?
+                WHERE run_id = ?
+            ''', (status, end_time.isoformat(), processing_seconds, output_report_id, error_message, run_id))
+            conn.execute('DELETE FROM pipeline_stage_metrics WHERE run_id = ?', (run_id,))
+            conn.execute('DELETE FROM pipeline_run_metrics WHERE run_id = ?', (run_id,))
+            conn.executemany('''
+                INSERT INTO pipeline_stage_metrics (run_id, stage_name, wall_seconds, calls, items, items_per_second)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [
+                (run_id, name, stage["wall_seconds"], stage["calls"], stage["items"], stage["items_per_second"])
+                for name, stage in summary["stages"].items()
+            ])
+            conn.executemany('''
+                INSERT INTO pipeline_run_metrics (run_id, metric_name, metric_value) VALUES (?, ?, ?)
+            ''', [(run_id, name, value) for name, value in summary["metrics"].items()])
+    finally:
+        conn.close()
+
+
+def load_run_metrics(db_path: str, run_id: str) -> Dict:
+    """Read back a persisted run with its stage and metric rows"""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        run = conn.execute('SELECT * FROM pipeline_runs WHERE run_id = ?', (run_id,)).fetchone()
+        stages = conn.execute('''
+            SELECT stage_name, wall_seconds, calls, items, items_per_second
+            FROM pipeline_stage_metrics WHERE run_id = ? ORDER BY id
+        ''', (run_id,)).fetchall()
+        metrics = conn.execute('''
+            SELECT metric_name, metric_value FROM pipeline_run_metrics WHERE run_id = ? ORDER BY id
+        ''', (run_id,)).fetchall()
+    finally:
+        conn.close()
+
+    return {
+        "run": dict(run) if run else None,
+        "stages": {row["stage_name"]: {key: row[key] for key in row.keys() if key != "stage_name"} for row in stages},
+        "metrics": {row["metric_name"]: row["metric_value"] for row in metrics}
+    }
@@ -0,0 +1,307 @@
+"""
+K-mer inverted index for the EDNA biodiversity pipeline
+Maps every k-mer of the reference barcodes to the references that contain it,
+so a read is only scored against the handful of references it shares k-mers with.
+A canonical index also records each k-mer's orientation, so one lookup finds
+candidates on both strands.
+"""
+
+import hashlib
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from similarity_engine import encode_flat
+
+FORWARD = 0
+REVERSE = 1
+
+# K-mers are packed into one int64 at 2 bits per base
+MAX_K = 31
+
+_COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+
+def reverse_complement(sequence: str) -> str:
+    """Reverse complement of a cleaned (ACGT-only) sequence"""
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def reference_digest(codes: np.ndarray, offsets: np.ndarray) -> str:
+    """SHA-1 of a reference set in flat encoded form (see encode_flat), identifying what an index was built from"""
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(offsets, dtype=np.int64))
+    digest.update(np.ascontiguousarray(codes, dtype=np.uint8))
+    return digest.hexdigest()
+
+
+class KmerIndex:
+    """
+    Inverted index from k-mers to reference sequence ids
+
+    Postings are kept as CSR arrays: sorted 2-bit k-mer codes, offsets into
+    one posting array, and the reference ids of each k-mer in ascending order.
+
+    With canonical=True each k-mer is stored as the lesser of itself and its
+    reverse complement, and postings are ref_id * 2 + orientation bit (1 when
+    the reference holds the reverse-complement form).
+    """
+
+    # Reference bases turned into k-mers per build step, bounding build memory
+    BUILD_CHUNK_BASES = 1 << 20
+
+    def __init__(self, k: int = 12, canonical: bool = False):
+        if not 1 <= k <= MAX_K:
+            raise ValueError(f"k-mer size must be an integer from 1 to {MAX_K}")
+        self.k = k
+        self.canonical = canonical
+        self.n_references = 0
+        self.reference_hash: Optional[str] = None
+        self.kmer_codes = np.empty(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.int32)
+
+    def build(self, references: Iterable[str]) -> "KmerIndex":
+        """Build the index from reference sequences (ids follow iteration order)"""
+        return self.build_encoded(*encode_flat(list(references)))
+
+    def build_encoded(self, codes: np.ndarray, offsets: np.ndarray) -> "KmerIndex":
+        """
+        Build the index from references in flat encoded form
+
+        References are processed in chunks of about BUILD_CHUNK_BASES bases,
+        so codes may be a memory-mapped array that is never loaded whole.
+
+        Args:
+            codes: 2-bit base codes of all references back to back (other values mark non-ACGT bases)
+            offsets: Start of every reference in codes, plus the total length
+        """
+        self.n_references = len(offsets) - 1
+        self.reference_hash = reference_digest(codes, offsets)
+
+        # (k-mer, posting) pairs are sorted as one packed int64 key when it fits
+        n_postings = max(self.n_references * (2 if self.canonical else 1), 1)
+        packed = (1 << (2 * self.k)) <= (1 << 62) // n_postings
+        kmer_parts, posting_parts = [], []
+        first_ref = 0
+        while first_ref < self.n_references:
+            last_ref = int(np.searchsorted(offsets, offsets[first_ref] + self.BUILD_CHUNK_BASES, side="right")) - 1
+            last_ref = min(max(last_ref, first_ref + 1), self.n_references)
+            chunk_offsets = np.asarray(offsets[first_ref:last_ref + 1], dtype=np.int64)
+            ref_of, forward, backward = self._window_codes(codes[chunk_offsets[0]:chunk_offsets[-1]],
+                                                           chunk_offsets - chunk_offsets[0])
+            if self.canonical:
+                kmers = np.minimum(forward, backward)
+                orientation = (backward < forward).astype(np.int64)
+            else:
+                kmers, orientation = forward, np.zeros(len(forward), dtype=np.int64)
+
+            # Distinct k-mers per reference; the first occurrence decides a canonical k-mer's orientation
+            _, first = np.unique(_combined_key(ref_of, kmers, 1 << (2 * self.k)), return_index=True)
+            ref_ids = ref_of[first] + first_ref
+            postings = ref_ids * 2 + orientation[first] if self.canonical else ref_ids
+            if packed:
+                kmer_parts.append(kmers[first] * n_postings + postings)
+            else:
+                kmer_parts.append(kmers[first])
+                posting_parts.append(postings)
+            first_ref = last_ref
+
+        # Order by k-mer, then posting, so each k-mer's postings are in reference order
+        kmers = np.concatenate(kmer_parts) if kmer_parts else np.empty(0, dtype=np.int64)
+        del kmer_parts
+        if packed:
+            kmers.sort()
+            postings = (kmers % n_postings).astype(np.int32)
+            kmers //= n_postings
+        else:
+            postings = np.concatenate(posting_parts) if posting_parts else np.empty(0, dtype=np.int64)
+            order = np.lexsort((postings, kmers))
+            kmers, postings = kmers[order], postings[order]
+
+        starts = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1]))) if len(kmers) else \
+            np.empty(0, dtype=np.int64)
+        self.kmer_codes = kmers[starts]
+        self.offsets = np.append(starts, len(kmers)).astype(np.int64)
+        self.postings = postings.astype(np.int32)
+        return self
+
+    def _window_codes(self, codes: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Every k-mer that lies inside one sequence of a flat encoded batch
+
+        Windows crossing a sequence boundary or holding a non-ACGT base are dropped.
+
+        Returns:
+            Tuple of (sequence id, forward code, reverse-complement code) per window
+        """
+        k = self.k
+        n_windows = codes.size - k + 1
+        if n_windows <= 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+
+        values = codes.astype(np.int64)
+        forward = np.zeros(n_windows, dtype=np.int64)
+        backward = np.zeros(n_windows, dtype=np.int64)
+        for position in range(k):
+            window = values[position:position + n_windows]
+            forward = (forward << 2) | window
+            backward |= (3 - window) << (2 * position)
+
+        invalid = np.concatenate(([0], np.cumsum(values > 3)))
+        lengths = np.diff(offsets)
+        sequence_of = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)[:n_windows]
+        keep = (invalid[k:] == invalid[:n_windows]) & (np.arange(n_windows) + k <= offsets[1:][sequence_of])
+        return sequence_of[keep], forward[keep], backward[keep]
+
+    def candidates(self, sequence: str, max_candidates: int = 10, min_shared: int = 1) -> List[int]:
+        """
+        Return ids of the references sharing the most k-mers with a sequence
+
+        Args:
+            sequence: Cleaned query sequence
+            max_candidates: Upper bound on the number of ids returned
+            min_shared: Minimum number of shared k-mers for a reference to qualify
+
+        Returns:
+            Reference ids in reference order, so ties resolve like a full scan
+        """
+        return self.candidates_batch([sequence], max_candidates, min_shared)[0]
+
+    def candidates_batch(self, sequences: Sequence[str], max_candidates: int = 10,
+                         min_shared: int = 1) -> List[List[int]]:
+        """
+        candidates for a whole batch of reads with NumPy instead of per-k-mer loops
+
+        Ties in the shared count go to the lower reference id.
+        """
+        if self.canonical:
+            stranded = self.stranded_candidates_batch(sequences, max_candidates, min_shared)
+            return [sorted({ref_id for ref_id, _ in row}) for row in stranded]
+
+        read_of, forward, _ = self._window_codes(*encode_flat(sequences))
+        ranked = self._ranked_postings(len(sequences), read_of, forward, None, max_candidates, min_shared)
+        return [row.tolist() for row in ranked]
+
+    def stranded_candidates(self, sequence: str, max_candidates: int = 10,
+                            min_shared: int = 1) -> List[Tuple[int, int]]:
+        """
+        Return the (reference id, strand) pairs sharing the most k-mers with a sequence
+
+        Strand is REVERSE when the sequence matches the reference's reverse
+        complement. Only available on a canonical index.
+
+        Returns:
+            (ref_id, strand) pairs sorted by reference id, then strand
+        """
+        return self.stranded_candidates_batch([sequence], max_candidates, min_shared)[0]
+
+    def stranded_candidates_batch(self, sequences: Sequence[str], max_candidates: int = 10,
+                                  min_shared: int = 1) -> List[List[Tuple[int, int]]]:
+        """
+        stranded_candidates for a whole batch of reads with NumPy instead of per-k-mer loops
+
+        Canonical k-mer codes of every read are computed with one rolling
+        window over the concatenated batch, looked up in the posting arrays
+        by binary search and counted per (read, reference, strand) in one sort.
+        Ties in the shared count go to the lower reference id.
+        """
+        if not self.canonical:
+            raise ValueError("Stranded candidates need an index built with canonical=True")
+
+        read_of, forward, backward = self._window_codes(*encode_flat(sequences))
+        # Flip the reference orientation bit where the read k-mer was reverse-complemented
+        flip = (backward < forward).astype(np.int64)
+        ranked = self._ranked_postings(len(sequences), read_of, np.minimum(forward, backward), flip,
+                                       max_candidates, min_shared)
+        return [list(zip((row >> 1).tolist(), (row & 1).tolist())) for row in ranked]
+
+    def _ranked_postings(self, n_reads: int, read_of: np.ndarray, kmers: np.ndarray, flip: Optional[np.ndarray],
+                         max_candidates: int, min_shared: int) -> List[np.ndarray]:
+        """
+        Top max_candidates postings per read by shared k-mer count, each row in ascending posting order
+
+        Args:
+            n_reads: Reads in the batch
+            read_of, kmers: Read id and k-mer code of every read window
+            flip: Optional per-window value XORed into the postings it hits
+        """
+        # Distinct k-mers per read, keeping the first occurrence
+        _, first = np.unique(_combined_key(read_of, kmers, 1 << (2 * self.k)), return_index=True)
+        read_of, kmers = read_of[first], kmers[first]
+
+        slot = np.minimum(np.searchsorted(self.kmer_codes, kmers), max(len(self.kmer_codes) - 1, 0))
+        found = self.kmer_codes[slot] == kmers if len(self.kmer_codes) else np.zeros(len(kmers), dtype=bool)
+        slot, read_of = slot[found], read_of[found]
+
+        counts = self.offsets[slot + 1] - self.offsets[slot]
+        within = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        hits = self.postings[np.repeat(self.offsets[slot], counts) + within].astype(np.int64)
+        if flip is not None:
+            hits ^= np.repeat(flip[first][found], counts)
+        n_postings = max(self.n_references * (2 if self.canonical else 1), 1)
+        keys, shared = np.unique(np.repeat(read_of, counts) * n_postings + hits, return_counts=True)
+        read_ids, hits = np.divmod(keys, n_postings)
+
+        # Top max_candidates per read: order by read, shared count (descending), posting
+        keep = shared >= min_shared
+        read_ids, hits, shared = read_ids[keep], hits[keep], shared[keep]
+        max_shared = int(shared.max()) if len(shared) else 0
+        rank_key = _combined_key(max_shared - shared, hits, n_postings)
+        order = np.argsort(_combined_key(read_ids, rank_key, (max_shared + 1) * n_postings), kind="stable")
+        read_ids, hits = read_ids[order], hits[order]
+        group_starts = np.searchsorted(read_ids, read_ids)
+        top = np.arange(len(read_ids)) - group_starts < max_candidates
+        read_ids, hits = read_ids[top], hits[top]
+
+        order = np.lexsort((hits, read_ids))
+        read_ids, hits = read_ids[order], hits[order]
+        bounds = np.searchsorted(read_ids, np.arange(n_reads + 1))
+        return [hits[bounds[row]:bounds[row + 1]] for row in range(n_reads)]
+
+    def save(self, path: str):
+        """Persist the index as a NumPy archive"""
+        with open(path, "wb") as handle:
+            np.savez(handle, k=self.k, canonical=self.canonical, n_references=self.n_references,
+                     reference_hash=self.reference_hash or "", kmer_codes=self.kmer_codes,
+                     offsets=self.offsets, postings=self.postings)
+
+    @classmethod
+    def load(cls, path: str) -> "KmerIndex":
+        """Reload an index written by save()"""
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(k=int(data["k"]), canonical=bool(data["canonical"]))
+            index.n_references = int(data["n_references"])
+            index.reference_hash = str(data["reference_hash"]) or None
+            index.kmer_codes = data["kmer_codes"]
+            index.offsets = data["offsets"]
+            index.postings = data["postings"]
+        return index
+
+    def matches(self, reference_hash: str, k: Optional[int] = None, canonical: Optional[bool] = None) -> bool:
+        """Check that a loaded index was built from the references with this digest (and k, k-mer form)"""
+        if k is not None and k != self.k:
+            return False
+        if canonical is not None and canonical != self.canonical:
+            return False
+        return reference_hash == self.reference_hash
+
+    def __len__(self) -> int:
+        return self.n_references
+
+
+def _combined_key(major: np.ndarray, minor: np.ndarray, minor_range: int) -> np.ndarray:
+    """
+    One int64 sort key ordering by (major, minor) for 0 <= minor < minor_range
+
+    Falls back to the rank of each pair in a lexsort when the product would overflow.
+    """
+    if len(major) == 0 or int(major.max()) < (1 << 62) // max(minor_range, 1):
+        return major * minor_range + minor
+    order = np.lexsort((minor, major))
+    key = np.empty(len(major), dtype=np.int64)
+    changed = np.ones(len(major), dtype=bool)
+    changed[1:] = (major[order][1:] != major[order][:-1]) | (minor[order][1:] != minor[order][:-1])
+    key[order] = np.cumsum(changed) - 1
+    return key
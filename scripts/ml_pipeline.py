@@ -7,19 +7,185 @@ import numpy as np
 import pandas as pd
 import json
 from datetime import datetime
-from typing import Dict, List, Tuple, Optional
-import re
+from functools import cached_property
+from typing import Callable, Dict, Iterable, List, Tuple, Optional, Union
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from itertools import islice
+
+from kmer_index import KmerIndex, REVERSE, reference_digest, reverse_complement
+from similarity_engine import BASE_CODES, SimilarityEngine, encode_flat, encode_sequences, similarity_matrix
+from sequence_io import SequenceRecord, chunked, read_sequences
+from parallel_executor import classify_chunks_parallel
+from classification_cache import ClassificationCache
+from reference_store import ReferenceStore
+from diversity import DiversityAccumulator, bootstrap_diversity, rarefaction_curve
+from beta_diversity import METRICS, AbundanceMatrix, pairwise_distances
+from report_writer import ResultsWriter, write_report
+from quality_filter import QualityFilter
+from result_records import ResultBatch, STATUS_HIGHER_TAXON, STATUS_IDENTIFIED, STATUS_LOW_QUALITY, STATUS_UNKNOWN
+from taxonomy import LineageTable, SPECIES_RANK
+from instrumentation import PipelineProfiler
+from checkpoint import RunCheckpoint
+from bulk_loader import BulkLoader
+
+# Single-pass cleaning: drop every byte that is not a base, then upper-case what is left
+_NON_BASE_BYTES = bytes(b for b in range(256) if b not in b"ACGTacgt")
+_UPPERCASE_BASES = bytes.maketrans(b"acgt", b"ACGT")
 
 class EDNAMLPipeline:
-    """Main ML pipeline for eDNA sequence analysis and taxonomic identification"""
+    """
+    Main ML pipeline for eDNA sequence analysis and taxonomic identification
+    
+    Reference data, taxonomy, models, index, similarity engine and cache are
+    loaded lazily on first use; call warmup() to load them all up front
+    (e.g. before forking workers, which then share them copy-on-write).
+    
+    Pass an enabled PipelineProfiler to record per-stage timings and run
+    metrics; wrap a run in profiler.run(...) to persist them to pipeline_runs.
+    """
+    
+    # Components loaded by warmup(), in dependency order
+    COMPONENTS = ("reference_store", "sequence_db", "taxonomy_hierarchy", "ml_models", "reference_arrays",
+                  "reference_taxa", "lineage_table", "kmer_index", "similarity_engine", "classification_cache")
+    
+    def __init__(self, kmer_size: int = 12, index_path: Optional[str] = None, max_candidates: int = 10,
+                 cache_size: int = 0, cache_path: Optional[str] = None,
+                 reference_store_path: Optional[str] = None, classifier: str = "ungapped",
+                 alignment_mode: str = "semi_global", alignment_band: int = 16,
+                 profiler: Optional[PipelineProfiler] = None, assignment: str = "best_hit",
+                 lca_margin: float = 0.02, diversity_ranks: Tuple[str, ...] = (), strand_aware: bool = False):
+        self.kmer_size = kmer_size
+        self.index_path = index_path
+        self.max_candidates = max_candidates
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.reference_store_path = reference_store_path
+        self.classifier = classifier
+        self.alignment_mode = alignment_mode
+        self.alignment_band = alignment_band
+        self.assignment = assignment
+        self.lca_margin = lca_margin
+        self.diversity_ranks = tuple(diversity_ranks)
+        self.strand_aware = strand_aware
+        self.stage_timings = {"preprocess_seconds": 0.0, "prefilter_seconds": 0.0, "scoring_seconds": 0.0}
+        self.profiler = profiler if profiler is not None else PipelineProfiler(enabled=False)
+    
+    @classmethod
+    def from_reference_data(cls, sequence_db: Dict, taxonomy_hierarchy: Dict, **options) -> "EDNAMLPipeline":
+        """Build a pipeline over in-memory reference data (e.g. synthetic benchmark references)"""
+        pipeline = cls(**options)
+        pipeline.sequence_db = sequence_db
+        pipeline.taxonomy_hierarchy = taxonomy_hierarchy
+        return pipeline
+    
+    @cached_property
+    def reference_store(self) -> Optional[ReferenceStore]:
+        return ReferenceStore(self.reference_store_path) if self.reference_store_path else None
+    
+    @cached_property
+    def sequence_db(self) -> Dict:
+        return self._load_reference_database()
     
-    def __init__(self):
-        self.sequence_db = self._load_reference_database()
-        self.taxonomy_hierarchy = self._load_taxonomy_hierarchy()
-        self.ml_models = self._initialize_models()
+    @cached_property
+    def taxonomy_hierarchy(self) -> Dict:
+        return self._load_taxonomy_hierarchy()
+    
+    @cached_property
+    def ml_models(self) -> Dict:
+        return self._initialize_models()
+    
+    @cached_property
+    def reference_entries(self) -> List[Tuple[str, Dict]]:
+        """(sequence, {"species", "confidence"}) per reference id; decodes a reference store, so scoring never uses it"""
+        store = self.reference_store
+        if store is not None:
+            return [(ref_seq, {"species": store.species(ref_id), "confidence": float(store.confidence[ref_id])})
+                    for ref_id, ref_seq in enumerate(store.sequences())]
+        return list(self.sequence_db["sequences"].items())
+    
+    @cached_property
+    def reference_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Flat 2-bit codes and offsets of the references (see encode_flat); a store's mapped arrays as they are"""
+        store = self.reference_store
+        if store is not None:
+            return store.codes, store.offsets
+        return encode_flat(list(self.sequence_db["sequences"]))
+    
+    @cached_property
+    def reference_taxa(self) -> Dict:
+        """Integer taxon ids and confidences aligned with the reference ids"""
+        store = self.reference_store
+        if store is not None:
+            species_names = [taxon["species_name"] for taxon in store.taxa]
+            return {
+                "species_names": species_names,
+                "species_ids": {species: species_id for species_id, species in enumerate(species_names)},
+                "taxon_ids": store.taxon_ids,
+                "confidence": store.confidence
+            }
         
+        species_names = []
+        species_ids = {}
+        for _, data in self.reference_entries:
+            if data["species"] not in species_ids:
+                species_ids[data["species"]] = len(species_names)
+                species_names.append(data["species"])
+        
+        return {
+            "species_names": species_names,
+            "species_ids": species_ids,
+            "taxon_ids": np.array([species_ids[data["species"]] for _, data in self.reference_entries], dtype=np.int32),
+            "confidence": np.array([data["confidence"] for _, data in self.reference_entries], dtype=np.float64)
+        }
+    
+    @cached_property
+    def lineage_table(self) -> LineageTable:
+        """Integer lineages of the species in reference_taxa, for LCA assignment and rank-level counts"""
+        return LineageTable(self.reference_taxa["species_names"], self.taxonomy_hierarchy)
+    
+    @cached_property
+    def kmer_index(self) -> KmerIndex:
+        return self._load_kmer_index(self.kmer_size, self.index_path)
+    
+    @cached_property
+    def similarity_engine(self) -> SimilarityEngine:
+        return self._build_similarity_engine()
+    
+    @cached_property
+    def classification_cache(self) -> Optional[ClassificationCache]:
+        return self._init_cache(self.cache_size, self.cache_path)
+    
+    def warmup(self) -> Dict:
+        """
+        Load every lazy component now and report how long each took
+        
+        Returns:
+            Seconds per component plus total_seconds; components that were
+            already loaded report (near) zero, so cold vs warm is measurable
+        """
+        timings = {}
+        started = time.perf_counter()
+        for component in self.COMPONENTS:
+            component_started = time.perf_counter()
+            getattr(self, component)
+            timings[component] = time.perf_counter() - component_started
+        timings["total_seconds"] = time.perf_counter() - started
+        return timings
+    
+    @property
+    def is_warm(self) -> bool:
+        """Whether every lazy component has been loaded"""
+        return all(component in self.__dict__ for component in self.COMPONENTS)
+    
     def _load_reference_database(self) -> Dict:
-        """Load reference sequence database (simulated)"""
+        """Load reference sequence database (memory-mapped store if configured, else simulated)"""
+        if self.reference_store is not None:
+            return self._load_reference_store()
+        
         return {
             "sequences": {
                 "ATCGATCGATCGATCG": {"species": "Gadus morhua", "confidence": 0.95},
@@ -34,8 +200,27 @@ class EDNAMLPipeline:
             }
         }
     
+    def _load_reference_store(self) -> Dict:
+        """
+        Reference database metadata of the memory-mapped reference store
+        
+        Sequences stay in the store's arrays (reference_arrays, reference_taxa)
+        instead of being decoded into a "sequences" dict.
+        """
+        store = self.reference_store
+        return {
+            "metadata": {
+                "version": store.version,
+                "total_sequences": len(store),
+                "last_updated": store.header["built_at"][:10]
+            }
+        }
+    
     def _load_taxonomy_hierarchy(self) -> Dict:
         """Load taxonomic hierarchy data"""
+        if self.reference_store is not None:
+            return self.reference_store.taxonomy_hierarchy()
+        
         return {
             "Gadus morhua": {
                 "kingdom": "Animalia",
@@ -66,6 +251,47 @@ class EDNAMLPipeline:
             }
         }
     
+    def _load_kmer_index(self, kmer_size: int, index_path: Optional[str] = None) -> KmerIndex:
+        """Load a persisted k-mer index, rebuilding it if missing or stale"""
+        codes, offsets = self.reference_arrays
+        
+        if index_path and os.path.exists(index_path):
+            index = KmerIndex.load(index_path)
+            if index.matches(reference_digest(codes, offsets), k=kmer_size, canonical=self.strand_aware):
+                return index
+        
+        index = KmerIndex(k=kmer_size, canonical=self.strand_aware).build_encoded(codes, offsets)
+        if index_path:
+            index.save(index_path)
+        return index
+    
+    def _build_similarity_engine(self) -> SimilarityEngine:
+        """Similarity engine sharing the flat reference arrays (no copy of a mapped store)"""
+        return SimilarityEngine.from_encoded(*self.reference_arrays)
+    
+    def _init_cache(self, cache_size: int, cache_path: Optional[str]) -> Optional[ClassificationCache]:
+        """Create the classification cache if enabled, namespaced by reference version and settings"""
+        if cache_size <= 0 and not cache_path:
+            return None
+        return ClassificationCache(self.classification_version(), db_path=cache_path, memory_size=cache_size)
+    
+    def classification_version(self) -> str:
+        """Reference version plus every setting that changes per-read results"""
+        version = "{}/k{}/c{}/{}".format(
+            self.sequence_db["metadata"]["version"], self.kmer_size, self.max_candidates, self.classifier
+        )
+        if self.classifier == "two_stage":
+            version += f"/{self.alignment_mode}/b{self.alignment_band}"
+        if self.assignment == "lca":
+            version += f"/lca{self.lca_margin}"
+        if self.strand_aware:
+            version += "/stranded"
+        return version
+    
+    def cache_stats(self) -> Optional[Dict]:
+        """Hit/miss counters of the classification cache (None when disabled)"""
+        return self.classification_cache.get_stats() if self.classification_cache else None
+    
     def _initialize_models(self) -> Dict:
         """Initialize ML models for sequence analysis"""
         return {
@@ -75,114 +301,627 @@ class EDNAMLPipeline:
             "diversity_calculator": "Custom_v2.0"
         }
     
+    def clean_sequence(self, sequence: str) -> str:
+        """Upper-case a raw read and strip everything but A/T/C/G"""
+        return sequence.encode("ascii", "ignore").translate(_UPPERCASE_BASES, _NON_BASE_BYTES).decode("ascii")
+    
+    def dereplicate(self, sequences: Iterable[str], track_order: bool = False) -> Dict:
+        """
+        Collapse identical cleaned reads into unique sequences with abundances
+        
+        Args:
+            sequences: Iterable of raw read strings
+            track_order: Also record which unique sequence each read maps to
+        
+        Returns:
+            Dictionary with abundances (cleaned sequence -> read count, in
+            first-seen order), optional read_to_unique indices (a compact int64
+            array) and the dedup ratio
+        """
+        abundances = {}
+        unique_ids = {}
+        read_to_unique = array("q") if track_order else None
+        total_reads = 0
+        
+        for sequence in sequences:
+            clean_seq = self.clean_sequence(sequence)
+            total_reads += 1
+            
+            unique_id = unique_ids.get(clean_seq)
+            if unique_id is None:
+                unique_id = unique_ids[clean_seq] = len(unique_ids)
+                abundances[clean_seq] = 0
+            abundances[clean_seq] += 1
+            
+            if track_order:
+                read_to_unique.append(unique_id)
+        
+        return {
+            "abundances": abundances,
+            "read_to_unique": read_to_unique,
+            "total_reads": total_reads,
+            "unique_sequences": len(abundances),
+            "dedup_ratio": 1 - len(abundances) / total_reads if total_reads else 0
+        }
+    
     def preprocess_sequence(self, sequence: str) -> Dict:
         """Preprocess raw DNA sequence data"""
-        # Clean sequence
-        clean_seq = re.sub(r'[^ATCG]', '', sequence.upper())
+        return self._processed_row(self.preprocess_batch([sequence]), 0)
+    
+    def preprocess_batch(self, sequences: List[str]) -> Dict:
+        """
+        Clean and profile a batch of reads in one vectorized pass
+        
+        Args:
+            sequences: Raw read strings
+        
+        Returns:
+            Dictionary with cleaned_sequences (list) and NumPy arrays of length,
+            gc_content, complexity_score and quality_score, one entry per read
+        """
+        cleaned_bytes = [
+            seq.encode("ascii", "ignore").translate(_UPPERCASE_BASES, _NON_BASE_BYTES) for seq in sequences
+        ]
+        n_reads = len(cleaned_bytes)
+        length = np.fromiter((len(seq) for seq in cleaned_bytes), dtype=np.int64, count=n_reads)
         
-        # Quality metrics
-        gc_content = (clean_seq.count('G') + clean_seq.count('C')) / len(clean_seq) if clean_seq else 0
-        length = len(clean_seq)
+        # Per-read base composition from one bincount over (read, base) pairs
+        codes = BASE_CODES[np.frombuffer(b"".join(cleaned_bytes), dtype=np.uint8)].astype(np.int64)
+        read_ids = np.repeat(np.arange(n_reads, dtype=np.int64), length)
+        base_counts = np.bincount(read_ids * 4 + codes, minlength=n_reads * 4).reshape(n_reads, 4)
         
-        # Complexity analysis
-        complexity_score = len(set(clean_seq)) / 4.0 if clean_seq else 0
+        gc_content = np.zeros(n_reads, dtype=np.float64)
+        np.divide(base_counts[:, 1] + base_counts[:, 2], length, out=gc_content, where=length > 0)
+        complexity_score = (base_counts > 0).sum(axis=1) / 4.0
+        quality_score = np.minimum(1.0, gc_content * complexity_score * (length / 500))
         
         return {
-            "cleaned_sequence": clean_seq,
+            "cleaned_sequences": [seq.decode("ascii") for seq in cleaned_bytes],
             "length": length,
             "gc_content": gc_content,
             "complexity_score": complexity_score,
-            "quality_score": min(1.0, (gc_content * complexity_score * (length / 500)))
+            "quality_score": quality_score
+        }
+    
+    def _processed_row(self, batch: Dict, position: int) -> Dict:
+        """Per-read view of a preprocess_batch result in the preprocess_sequence format"""
+        return {
+            "cleaned_sequence": batch["cleaned_sequences"][position],
+            "length": int(batch["length"][position]),
+            "gc_content": float(batch["gc_content"][position]),
+            "complexity_score": float(batch["complexity_score"][position]),
+            "quality_score": float(batch["quality_score"][position])
         }
     
     def identify_species(self, sequence: str) -> Dict:
         """Identify species from DNA sequence using ML models"""
-        processed = self.preprocess_sequence(sequence)
+        return self.identify_species_batch([sequence])[0]
+    
+    def identify_species_batch(self, sequences: List[str]) -> List[Dict]:
+        """Identify species for a batch of sequences, returning per-read result dicts"""
+        return self.identify_species_records(sequences).to_dicts()
+    
+    def identify_species_records(self, sequences: List[str]) -> ResultBatch:
+        """
+        Identify species for a batch of sequences in one vectorized scoring pass
         
-        if processed["quality_score"] < 0.3:
-            return {
-                "status": "low_quality",
-                "message": "Sequence quality too low for reliable identification",
-                "quality_score": processed["quality_score"]
-            }
+        With classifier="two_stage" the k-mer prefilter keeps the top
+        max_candidates references per read and a banded alignment scores only
+        those, tolerating indels; "ungapped" scores candidates position by position.
         
-        # Simulate ML-based species identification
-        best_match = None
-        best_score = 0
+        With assignment="lca" every hit within lca_margin of the best one
+        votes, and reads whose hits span several species are assigned to their
+        lowest common ancestor (status higher_taxon) instead of the top hit.
         
-        for ref_seq, data in self.sequence_db["sequences"].items():
-            # Simplified similarity calculation
-            similarity = self._calculate_similarity(processed["cleaned_sequence"], ref_seq)
-            if similarity > best_score:
-                best_score = similarity
-                best_match = data
+        With strand_aware=True the canonical k-mer prefilter finds candidates
+        on both strands in one pass; a read's reverse complement is scored
+        only against its reverse-strand candidates.
         
-        if best_score > 0.7:
-            species = best_match["species"]
-            taxonomy = self.taxonomy_hierarchy.get(species, {})
-            
-            return {
-                "status": "identified",
-                "species": species,
-                "confidence": best_score * best_match["confidence"],
-                "taxonomy": taxonomy,
-                "quality_score": processed["quality_score"],
-                "sequence_length": processed["length"],
-                "gc_content": processed["gc_content"]
-            }
+        Returns:
+            Compact ResultBatch; call to_dicts() for the identify_species format
+        """
+        started = time.perf_counter()
+        batch = self.preprocess_batch(sequences)
+        taxa = self.reference_taxa
+        records = ResultBatch.empty(len(sequences), taxa["species_names"], self.taxonomy_hierarchy,
+                                    self.lineage_table)
+        rows = records.records
+        
+        rows["quality_score"] = batch["quality_score"]
+        rows["gc_content"] = batch["gc_content"]
+        rows["length"] = batch["length"]
+        low_quality = batch["quality_score"] < 0.3
+        rows["status"][low_quality] = STATUS_LOW_QUALITY
+        queries = np.flatnonzero(~low_quality).tolist()
+        
+        if self.classification_cache and queries:
+            cached = self.classification_cache.get_many(
+                [batch["cleaned_sequences"][position] for position in queries]
+            )
+            for position, result in zip(queries, cached):
+                if result is not None:
+                    records.set_from_dict(position, result, taxa["species_ids"])
+            queries = [position for position, result in zip(queries, cached) if result is None]
+        
+        # Simulate ML-based species identification, scoring only k-mer index candidates
+        prefilter_started = time.perf_counter()
+        cleaned = [batch["cleaned_sequences"][position] for position in queries]
+        if self.strand_aware:
+            stranded = self.kmer_index.stranded_candidates_batch(cleaned, self.max_candidates)
+            candidates = [[ref_id for ref_id, strand in row if strand != REVERSE] for row in stranded]
+            reverse_candidates = [[ref_id for ref_id, strand in row if strand == REVERSE] for row in stranded]
         else:
-            return {
-                "status": "unknown",
-                "message": "No reliable match found in reference database",
-                "best_similarity": best_score,
-                "quality_score": processed["quality_score"]
-            }
+            candidates = self.kmer_index.candidates_batch(cleaned, self.max_candidates)
+        
+        scoring_started = time.perf_counter()
+        best_ids, best_scores, hit_ids, hit_scores = self._score_candidates(cleaned, candidates)
+        strands = np.zeros(len(cleaned), dtype=np.int8)
+        if self.strand_aware:
+            best_ids, best_scores, hit_ids, hit_scores = self._merge_reverse_strand(
+                cleaned, reverse_candidates, strands, best_ids, best_scores, hit_ids, hit_scores
+            )
+        finished = time.perf_counter()
+        
+        self.stage_timings["preprocess_seconds"] += prefilter_started - started
+        self.stage_timings["prefilter_seconds"] += scoring_started - prefilter_started
+        self.stage_timings["scoring_seconds"] += finished - scoring_started
+        if self.profiler.enabled:
+            self.profiler.record("preprocess", prefilter_started - started, len(sequences))
+            self.profiler.record("prefilter", scoring_started - prefilter_started, len(cleaned))
+            self.profiler.record("scoring", finished - scoring_started, len(cleaned))
+        
+        positions = np.asarray(queries, dtype=np.int64)
+        identified = best_scores > 0.7
+        hit_positions, hit_refs = positions[identified], best_ids[identified]
+        rows["confidence"][hit_positions] = best_scores[identified] * taxa["confidence"][hit_refs]
+        rows["strand"][hit_positions] = strands[identified]
+        
+        if self.assignment == "lca":
+            votes = (hit_ids >= 0) & (hit_scores >= best_scores[:, None] - self.lca_margin) & identified[:, None]
+            ranks, nodes = self.lineage_table.lca(taxa["taxon_ids"][np.maximum(hit_ids, 0)], votes)
+            # Hits that disagree even at kingdom level leave the read unknown
+            identified &= ranks >= 0
+            rows["rank"][positions[identified]] = ranks[identified]
+            rows["node_id"][positions[identified]] = nodes[identified]
+            species_level = identified & (ranks == SPECIES_RANK)
+            rows["status"][positions[identified & ~species_level]] = STATUS_HIGHER_TAXON
+            rows["status"][positions[species_level]] = STATUS_IDENTIFIED
+            rows["taxon_id"][positions[species_level]] = nodes[species_level]
+        else:
+            rows["status"][hit_positions] = STATUS_IDENTIFIED
+            rows["taxon_id"][hit_positions] = taxa["taxon_ids"][hit_refs]
+            rows["rank"][hit_positions] = SPECIES_RANK
+            rows["node_id"][hit_positions] = rows["taxon_id"][hit_positions]
+        
+        rows["status"][positions[~identified]] = STATUS_UNKNOWN
+        rows["best_similarity"][positions[~identified]] = best_scores[~identified]
+        
+        if self.classification_cache and queries:
+            self.classification_cache.put_many(cleaned, [records.to_dict(position) for position in queries])
+        
+        return records
+    
+    def _score_candidates(self, reads: List[str], candidates: List[List[int]]) -> Tuple:
+        """
+        Score reads against their candidates with the configured classifier
+        
+        Returns:
+            Tuple of (best reference id, best score, candidate ids, candidate
+            scores); the candidate matrices are only built (else None) for LCA assignment
+        """
+        engine = self.similarity_engine
+        if self.assignment != "lca":
+            if self.classifier == "two_stage":
+                best_ids, best_scores = engine.aligned_best_hits(
+                    reads, candidates, band=self.alignment_band, mode=self.alignment_mode
+                )
+            else:
+                best_ids, best_scores = engine.best_hits(reads, candidates)
+            return best_ids, best_scores, None, None
+        
+        if self.classifier == "two_stage":
+            hit_ids, hit_scores = engine.aligned_candidate_scores(
+                reads, candidates, band=self.alignment_band, mode=self.alignment_mode
+            )
+        else:
+            hit_ids, hit_scores = engine.candidate_scores(reads, candidates)
+        
+        best_ids = np.full(len(reads), -1, dtype=np.int64)
+        best_scores = np.zeros(len(reads), dtype=np.float64)
+        if hit_scores.shape[1]:
+            best_cols = hit_scores.argmax(axis=1)
+            best_ids = hit_ids[np.arange(len(reads)), best_cols]
+            best_scores = np.maximum(hit_scores[np.arange(len(reads)), best_cols], 0.0)
+        return best_ids, best_scores, hit_ids, hit_scores
+    
+    def _merge_reverse_strand(self, reads: List[str], reverse_candidates: List[List[int]], strands: np.ndarray,
+                              best_ids: np.ndarray, best_scores: np.ndarray, hit_ids: Optional[np.ndarray],
+                              hit_scores: Optional[np.ndarray]) -> Tuple:
+        """
+        Score reverse complements against reverse-strand candidates and fold them into the forward results
+        
+        Only reads with at least one reverse-strand candidate are
+        reverse-complemented. A reverse hit replaces the forward best only when
+        it scores strictly higher; strands is updated in place.
+        """
+        rows = np.array([row for row, refs in enumerate(reverse_candidates) if refs], dtype=np.int64)
+        if len(rows) == 0:
+            return best_ids, best_scores, hit_ids, hit_scores
+        
+        rev_ids, rev_scores, rev_hit_ids, rev_hit_scores = self._score_candidates(
+            [reverse_complement(reads[row]) for row in rows.tolist()],
+            [reverse_candidates[row] for row in rows.tolist()]
+        )
+        flip = rev_scores > best_scores[rows]
+        best_ids[rows[flip]] = rev_ids[flip]
+        best_scores[rows[flip]] = rev_scores[flip]
+        strands[rows[flip]] = REVERSE
+        
+        if hit_ids is not None:
+            # Both strands vote in the LCA: append the reverse hits as extra columns
+            forward_width, reverse_width = hit_ids.shape[1], rev_hit_ids.shape[1]
+            merged_ids = np.full((len(reads), forward_width + reverse_width), -1, dtype=np.int64)
+            merged_scores = np.full(merged_ids.shape, -1.0, dtype=np.float64)
+            merged_ids[:, :forward_width], merged_scores[:, :forward_width] = hit_ids, hit_scores
+            merged_ids[rows, forward_width:], merged_scores[rows, forward_width:] = rev_hit_ids, rev_hit_scores
+            hit_ids, hit_scores = merged_ids, merged_scores
+        
+        return best_ids, best_scores, hit_ids, hit_scores
     
     def _calculate_similarity(self, seq1: str, seq2: str) -> float:
         """Calculate sequence similarity (simplified)"""
         if not seq1 or not seq2:
             return 0.0
         
-        min_len = min(len(seq1), len(seq2))
-        matches = sum(1 for i in range(min_len) if seq1[i] == seq2[i])
-        return matches / min_len
+        codes1, lengths1 = encode_sequences([seq1])
+        codes2, lengths2 = encode_sequences([seq2])
+        return float(similarity_matrix(codes1, lengths1, codes2, lengths2)[0, 0])
     
-    def analyze_biodiversity(self, sequences: List[str]) -> Dict:
-        """Analyze biodiversity metrics from multiple sequences"""
+    def analyze_biodiversity(self, sequences: Iterable[Union[str, SequenceRecord]], batch_size: int = 1000,
+                             keep_results: bool = True, workers: int = 1, dereplicate: bool = False,
+                             accumulator: Optional[DiversityAccumulator] = None,
+                             results_path: Optional[str] = None, compact_results: bool = False,
+                             quality_filter: Optional[QualityFilter] = None,
+                             progress: Optional[Callable[[int], None]] = None,
+                             checkpoint_path: Optional[str] = None, checkpoint_every: int = 10,
+                             loader: Optional[BulkLoader] = None, sample_id: Optional[str] = None) -> Dict:
+        """
+        Analyze biodiversity metrics from multiple sequences
+        
+        Args:
+            sequences: Any iterable of sequence strings or SequenceRecord, consumed lazily
+            batch_size: Number of reads classified per vectorized batch
+            keep_results: Keep per-read results; disable for flat memory on large runs
+            workers: Worker processes classifying batches in parallel (1 runs serially)
+            dereplicate: Classify each unique cleaned sequence once and weight by abundance
+            accumulator: Existing DiversityAccumulator to continue (e.g. one shard of a larger run)
+            results_path: Stream per-read results to this JSON Lines file (.gz compresses)
+                instead of keeping them in memory
+            compact_results: Return kept results as one array-backed ResultBatch instead
+                of per-read dicts (generate_report converts it on demand)
+            quality_filter: Phred-quality filter applied to FASTQ records before identification;
+                rejected reads are reported per filter and never classified
+            progress: Called after every classified batch with the accumulator's read count
+            checkpoint_path: Save progress to this file every checkpoint_every batches and
+                resume from it when it exists; the same input and settings must be passed
+                again, and the checkpoint is removed once the run completes
+            checkpoint_every: Batches classified between checkpoints
+            loader: BulkLoader that stores every read and its identification
+                under sample_id in the pipeline database (not combinable with checkpoints,
+                whose resume would load the replayed batches twice); an unopened loader
+                is opened and closed by this run, an open one is flushed and left open
+                for further samples
+            sample_id: Sample the reads belong to when loading
+        """
+        if loader is not None and (checkpoint_path or sample_id is None):
+            raise ValueError("loader needs a sample_id and cannot be combined with checkpoint_path")
+        
         results = []
-        species_counts = {}
+        accumulator = accumulator if accumulator is not None else DiversityAccumulator(ranks=self.diversity_ranks)
+        timings_before = dict(self.stage_timings)
+        started = time.perf_counter()
+        dereplication = None
+        
+        writer = ResultsWriter(results_path) if results_path else None
+        keep_results = keep_results and writer is None
+        store_results = keep_results or writer is not None
+        
+        checkpoint, batches_done, filter_snapshots = None, 0, None
+        if checkpoint_path:
+            checkpoint = RunCheckpoint(checkpoint_path, self._checkpoint_settings(
+                batch_size, dereplicate, store_results, quality_filter
+            ))
+            state = checkpoint.load()
+            if state is not None:
+                batches_done = state["batches_done"]
+                accumulator.load_state(state["accumulator"])
+                if quality_filter is not None and not dereplicate:
+                    quality_filter.stats = state["quality_filter"]
+            checkpoint.open_records()
         
-        for seq in sequences:
-            result = self.identify_species(seq)
-            results.append(result)
+        if checkpoint and not dereplicate:
+            # One batch per raw input chunk, so a checkpoint's input offset and filter counters line up
+            filter_snapshots = deque()
+            batches = self._checkpoint_batches(sequences, quality_filter, batch_size, batches_done, filter_snapshots)
+            weights = None
+        else:
+            if quality_filter is not None:
+                reads = self._quality_filtered_reads(sequences, quality_filter, batch_size)
+            else:
+                reads = (record.sequence if isinstance(record, SequenceRecord) else record for record in sequences)
+            
+            if dereplicate:
+                dereplication = self.dereplicate(reads, track_order=store_results)
+                batches = islice(chunked(dereplication["abundances"], batch_size), batches_done, None)
+                weights = islice((np.array(chunk, dtype=np.int64)
+                                  for chunk in chunked(dereplication["abundances"].values(), batch_size)),
+                                 batches_done, None)
+            else:
+                batches = chunked(reads, batch_size)
+                weights = None
+        
+        loaded_reads = None
+        if loader is not None:
+            loaded_reads = deque()
+            batches = self._tee_batches(batches, loaded_reads)
+            identification_method = f"EDNA_ML_v2.1/{self.classifier}/{self.assignment}"
+        
+        if writer:
+            writer.open()
+        owns_loader = loader is not None and not loader.is_open
+        if owns_loader:
+            loader.open()
+        
+        try:
+            kept = []
+            for records in self._classify_batches(batches, workers):
+                batch_weights = next(weights) if dereplicate else None
+                accumulator.update_batch(records, batch_weights)
+                if loader is not None:
+                    reads = loaded_reads.popleft()
+                    with self.profiler.stage("database_load", len(reads)):
+                        loader.add(sample_id, reads, records, batch_weights, identification_method)
+                if progress is not None:
+                    progress(accumulator.total_sequences)
+                
+                if checkpoint:
+                    batches_done += 1
+                    filter_stats = filter_snapshots.popleft() if filter_snapshots is not None else None
+                    if store_results:
+                        checkpoint.append_records(records.records)
+                    if batches_done % checkpoint_every == 0:
+                        checkpoint.save({
+                            "batches_done": batches_done,
+                            "input_offset": batches_done * batch_size,
+                            "accumulator": accumulator.to_dict(),
+                            "quality_filter": filter_stats
+                        })
+                elif keep_results or (writer and dereplicate):
+                    kept.append(records)
+                elif writer:
+                    writer.write_many(records.iter_dicts())
+            
+            if checkpoint and store_results:
+                taxa = self.reference_taxa
+                kept = [ResultBatch(checkpoint.read_records(), taxa["species_names"], self.taxonomy_hierarchy,
+                                    self.lineage_table)]
             
-            if result["status"] == "identified":
-                species = result["species"]
-                species_counts[species] = species_counts.get(species, 0) + 1
+            if kept:
+                results = ResultBatch.concatenate(kept)
+                if writer:
+                    # Stream a batch at a time; dereplicated results expand to one entry per input read
+                    positions = dereplication["read_to_unique"] if dereplicate else range(len(results))
+                    for chunk in chunked(positions, batch_size):
+                        writer.write_many(results.take(chunk).iter_dicts())
+                    results = []
+                else:
+                    if dereplicate:
+                        # Expand unique-sequence results back to one entry per input read
+                        results = results.take(dereplication["read_to_unique"])
+                    if not compact_results:
+                        results = results.to_dicts()
+        except BaseException:
+            if owns_loader:
+                loader.abort()
+            raise
+        finally:
+            if writer:
+                writer.close()
+            if checkpoint:
+                checkpoint.close()
+        
+        if checkpoint:
+            checkpoint.remove()
+        # Buffered rows only reach the database (and the loader's stats) on flush or close
+        if owns_loader:
+            loader.close()
+        elif loader is not None:
+            loader.flush()
+        
+        analysis = self.summarize_diversity(accumulator, results)
+        analysis["dereplication"] = {
+            "input_reads": dereplication["total_reads"],
+            "unique_sequences": dereplication["unique_sequences"],
+            "dedup_ratio": dereplication["dedup_ratio"]
+        } if dereplication else None
+        analysis["stage_timings"] = {
+            stage: seconds - timings_before[stage] for stage, seconds in self.stage_timings.items()
+        }
+        analysis["results_file"] = writer.reference() if writer else None
+        analysis["quality_filter"] = quality_filter.get_stats() if quality_filter is not None else None
+        analysis["database_load"] = loader.stats() if loader is not None else None
+        if self.profiler.enabled:
+            self._profile_analysis(analysis, time.perf_counter() - started)
+        return analysis
+    
+    def _profile_analysis(self, analysis: Dict, seconds: float):
+        """Record run-level throughput, cache and filter metrics of one analyze_biodiversity call"""
+        profiler = self.profiler
+        profiler.record("analyze_biodiversity", seconds, analysis["total_sequences"])
+        profiler.set_metric("total_sequences", analysis["total_sequences"])
+        profiler.set_metric("identified_sequences", analysis["identified_sequences"])
+        profiler.set_metric("reads_per_second", analysis["total_sequences"] / seconds if seconds else None)
         
-        # Calculate diversity metrics
-        total_identified = len([r for r in results if r["status"] == "identified"])
-        unique_species = len(species_counts)
+        cache_stats = self.cache_stats()
+        if cache_stats:
+            profiler.set_metric("cache_hits", cache_stats["hits"])
+            profiler.set_metric("cache_misses", cache_stats["misses"])
+            profiler.set_metric("cache_hit_rate", cache_stats["hit_rate"])
+        if analysis["dereplication"]:
+            profiler.set_metric("dedup_ratio", analysis["dereplication"]["dedup_ratio"])
+        if analysis["quality_filter"]:
+            profiler.set_metric("quality_passed_reads", analysis["quality_filter"]["passed_reads"])
+    
+    def summarize_diversity(self, accumulator: DiversityAccumulator, results: Optional[List[Dict]] = None) -> Dict:
+        """Build the analysis result from an accumulator, e.g. after merging shards from several machines"""
+        total_sequences = accumulator.total_sequences
         
-        # Shannon diversity index
-        shannon_diversity = 0
-        if total_identified > 0:
-            for count in species_counts.values():
-                p = count / total_identified
-                shannon_diversity -= p * np.log(p)
+        return {
+            "total_sequences": total_sequences,
+            "identified_sequences": accumulator.identified_sequences,
+            "unique_species": accumulator.richness,
+            "species_counts": dict(accumulator.species_counts),
+            "shannon_diversity": accumulator.shannon,
+            "simpson_diversity": accumulator.simpson,
+            "chao1_richness": accumulator.chao1,
+            "identification_rate": accumulator.identified_sequences / total_sequences if total_sequences else 0,
+            "results": results if results is not None else [],
+            "rank_diversity": {
+                rank: {"taxon_counts": dict(counts), **accumulator.rank_metrics(rank)}
+                for rank, counts in accumulator.rank_counts.items()
+            },
+            "diversity_state": accumulator.to_dict()
+        }
+    
+    def _quality_filtered_reads(self, sequences: Iterable[Union[str, SequenceRecord]],
+                                quality_filter: QualityFilter, batch_size: int) -> Iterable[str]:
+        """Run records through the quality filter batch by batch, yielding surviving read strings"""
+        for batch in chunked(sequences, batch_size):
+            records = [
+                record if isinstance(record, SequenceRecord) else SequenceRecord("", record)
+                for record in batch
+            ]
+            for record in quality_filter.apply(records):
+                yield record.sequence
+    
+    def _checkpoint_settings(self, batch_size: int, dereplicate: bool, store_results: bool,
+                             quality_filter: Optional[QualityFilter]) -> Dict:
+        """Settings a checkpoint must have been written with to be resumed"""
+        return {
+            "classification_version": self.classification_version(),
+            "batch_size": batch_size,
+            "dereplicate": dereplicate,
+            "store_results": store_results,
+            "diversity_ranks": list(self.diversity_ranks),
+            "quality_filter": None if quality_filter is None else {
+                "window": quality_filter.window,
+                "min_window_quality": quality_filter.min_window_quality,
+                "min_length": quality_filter.min_length,
+                "max_expected_errors": quality_filter.max_expected_errors,
+                "phred_offset": quality_filter.phred_offset
+            }
+        }
+    
+    def _checkpoint_batches(self, sequences: Iterable[Union[str, SequenceRecord]],
+                            quality_filter: Optional[QualityFilter], batch_size: int, skip: int,
+                            filter_snapshots: deque) -> Iterable[List[str]]:
+        """
+        Yield one (filtered) batch per raw input chunk, skipping chunks a checkpoint already covers
+        
+        Appends the quality filter counters as of each yielded batch to
+        filter_snapshots, so checkpoints stay exact when batches are classified ahead
+        """
+        for chunk in islice(chunked(sequences, batch_size), skip, None):
+            if quality_filter is not None:
+                records = [
+                    record if isinstance(record, SequenceRecord) else SequenceRecord("", record) for record in chunk
+                ]
+                reads = [record.sequence for record in quality_filter.apply(records)]
+                filter_snapshots.append(quality_filter.get_stats())
+            else:
+                reads = [record.sequence if isinstance(record, SequenceRecord) else record for record in chunk]
+                filter_snapshots.append(None)
+            yield reads
+    
+    def _tee_batches(self, batches: Iterable[List[str]], seen: deque) -> Iterable[List[str]]:
+        """Pass batches through, remembering each one until the main loop pops its results"""
+        for batch in batches:
+            seen.append(batch)
+            yield batch
+    
+    def _classify_batches(self, batches: Iterable[List[str]], workers: int = 1) -> Iterable[ResultBatch]:
+        """Classify batches serially or in a process pool, preserving input order"""
+        if workers > 1:
+            # Load everything before the pool forks so workers share it instead of rebuilding it
+            self.warmup()
+            return classify_chunks_parallel(self, batches, workers=workers)
+        return (self.identify_species_records(batch) for batch in batches)
+    
+    def analyze_file(self, path: str, batch_size: int = 1000, keep_results: bool = False,
+                     workers: int = 1, dereplicate: bool = False, results_path: Optional[str] = None,
+                     quality_filter: Optional[QualityFilter] = None,
+                     accumulator: Optional[DiversityAccumulator] = None,
+                     progress: Optional[Callable[[int], None]] = None,
+                     checkpoint_path: Optional[str] = None, checkpoint_every: int = 10,
+                     loader: Optional[BulkLoader] = None, sample_id: Optional[str] = None) -> Dict:
+        """Stream a FASTA/FASTQ file (plain or gzip) through analyze_biodiversity"""
+        return self.analyze_biodiversity(read_sequences(path), batch_size=batch_size, keep_results=keep_results,
+                                         workers=workers, dereplicate=dereplicate, results_path=results_path,
+                                         quality_filter=quality_filter, accumulator=accumulator,
+                                         progress=progress, checkpoint_path=checkpoint_path,
+                                         checkpoint_every=checkpoint_every, loader=loader, sample_id=sample_id)
+    
+    def compare_samples(self, db_path: Optional[str] = "edna_biodiversity.db",
+                        analyses: Optional[Dict[str, Dict]] = None, rank: str = "species",
+                        sample_ids: Optional[List[str]] = None, metrics: Tuple[str, ...] = METRICS,
+                        block_size: int = 256) -> Dict:
+        """
+        Pairwise beta diversity across samples
+        
+        Args:
+            db_path: Pipeline database whose stored identifications are counted per sample
+            analyses: Alternatively, {sample_id: analyze_biodiversity output}; rank must then
+                be species or one of the pipeline's diversity_ranks
+            rank: Taxonomic rank to compare at
+            sample_ids: Samples to include from the database (defaults to all)
+            metrics: Any of "bray_curtis" and "jaccard"
+            block_size: Samples per block of the distance computation
+        
+        Returns:
+            Dictionary with the sample order and one (samples x samples) distance array per metric
+        """
+        if analyses is not None:
+            matrix = AbundanceMatrix.from_counts({
+                sample: analysis["species_counts"] if rank == "species"
+                else analysis["rank_diversity"][rank]["taxon_counts"]
+                for sample, analysis in analyses.items()
+            })
+        else:
+            matrix = AbundanceMatrix.from_database(db_path, rank=rank, sample_ids=sample_ids)
+        
+        with self.profiler.stage("compare_samples", len(matrix.samples)):
+            distances = {
+                metric: pairwise_distances(matrix, metric, block_size=block_size) for metric in metrics
+            }
         
         return {
-            "total_sequences": len(sequences),
-            "identified_sequences": total_identified,
-            "unique_species": unique_species,
-            "species_counts": species_counts,
-            "shannon_diversity": shannon_diversity,
-            "identification_rate": total_identified / len(sequences) if sequences else 0,
-            "results": results
+            "samples": matrix.samples,
+            "rank": rank,
+            "taxa": len(matrix.taxa),
+            "sample_totals": dict(zip(matrix.samples, matrix.totals().tolist())),
+            "distances": distances
         }
     
-    def generate_report(self, analysis_results: Dict) -> Dict:
+    def generate_report(self, analysis_results: Dict, rarefaction_iterations: int = 100,
+                        bootstrap_iterations: int = 1000, seed: Optional[int] = None) -> Dict:
         """Generate comprehensive analysis report"""
+        with self.profiler.stage("generate_report", analysis_results["total_sequences"]):
+            return self._build_report(analysis_results, rarefaction_iterations, bootstrap_iterations, seed)
+    
+    def _build_report(self, analysis_results: Dict, rarefaction_iterations: int, bootstrap_iterations: int,
+                      seed: Optional[int]) -> Dict:
+        species_counts = list(analysis_results["species_counts"].values())
+        
         return {
             "report_id": f"EDNA_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
             "timestamp": datetime.now().isoformat(),
@@ -191,10 +930,19 @@ class EDNAMLPipeline:
                 "successful_identifications": analysis_results["identified_sequences"],
                 "unique_species_detected": analysis_results["unique_species"],
                 "biodiversity_index": round(analysis_results["shannon_diversity"], 3),
-                "identification_success_rate": round(analysis_results["identification_rate"] * 100, 1)
+                "identification_success_rate": round(analysis_results["identification_rate"] * 100, 1),
+                "simpson_index": round(analysis_results.get("simpson_diversity", 0), 3),
+                "chao1_richness": round(analysis_results.get("chao1_richness", 0), 1)
             },
             "species_composition": analysis_results["species_counts"],
-            "detailed_results": analysis_results["results"],
+            "rarefaction": rarefaction_curve(species_counts, iterations=rarefaction_iterations, seed=seed),
+            "diversity_confidence_intervals": bootstrap_diversity(
+                species_counts, iterations=bootstrap_iterations, seed=seed
+            ),
+            "detailed_results": self._result_dicts(analysis_results["results"]),
+            "detailed_results_file": analysis_results.get("results_file"),
+            "dereplication": analysis_results.get("dereplication"),
+            "rank_diversity": analysis_results.get("rank_diversity"),
             "recommendations": self._generate_recommendations(analysis_results),
             "metadata": {
                 "pipeline_version": "EDNA_ML_v2.1",
@@ -203,6 +951,37 @@ class EDNAMLPipeline:
             }
         }
     
+    def _result_dicts(self, results: Union[List[Dict], ResultBatch]) -> List[Dict]:
+        """Per-read results in dict format, converting compact batches on demand"""
+        return results.to_dicts() if isinstance(results, ResultBatch) else results
+    
+    def write_streaming_report(self, analysis_results: Dict, report_path: str,
+                               results_path: Optional[str] = None, **report_options) -> Dict:
+        """
+        Write a report whose per-read results live in a JSON Lines side file
+        
+        Args:
+            analysis_results: Output of analyze_biodiversity; results already streamed
+                with results_path are referenced as-is
+            report_path: Destination of the JSON summary report
+            results_path: Side file for in-memory per-read results (.gz compresses)
+            report_options: Passed through to generate_report
+        
+        Returns:
+            The report as written, with detailed_results replaced by a file reference
+        """
+        results_file = analysis_results.get("results_file")
+        if results_file is None and results_path:
+            with ResultsWriter(results_path) as writer:
+                results = analysis_results["results"]
+                writer.write_many(results.iter_dicts() if isinstance(results, ResultBatch) else results)
+            results_file = writer.reference()
+        
+        report = self.generate_report({**analysis_results, "results": []}, **report_options)
+        report["detailed_results_file"] = results_file
+        write_report(report, report_path)
+        return report
+    
     def _generate_recommendations(self, results: Dict) -> List[str]:
         """Generate recommendations based on analysis results"""
         recommendations = []
@@ -218,6 +997,26 @@ class EDNAMLPipeline:
         
         return recommendations
 
+_shared_pipeline: Optional[EDNAMLPipeline] = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_pipeline(warm: bool = True, **options) -> EDNAMLPipeline:
+    """
+    Process-wide pipeline instance, created on first call
+    
+    Warm it in the parent before forking workers or serving requests so
+    children inherit the loaded reference data copy-on-write. Options only
+    apply to the call that creates the instance.
+    """
+    global _shared_pipeline
+    with _shared_lock:
+        if _shared_pipeline is None:
+            _shared_pipeline = EDNAMLPipeline(**options)
+        if warm and not _shared_pipeline.is_warm:
+            _shared_pipeline.warmup()
+        return _shared_pipeline
+
 # Example usage and testing
 if __name__ == "__main__":
     pipeline = EDNAMLPipeline()
@@ -0,0 +1,75 @@
+"""
+Multi-core execution for the EDNA biodiversity pipeline
+Classifies read chunks in a process pool whose workers inherit the parent's
+already-loaded pipeline (and its reference data) instead of rebuilding it;
+workers send back only the compact records array of each chunk
+"""
+
+import multiprocessing
+import os
+from collections import deque
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from result_records import ResultBatch
+
+# Set in each worker by the pool initializer
+_WORKER_PIPELINE = None
+
+
+def _init_worker(pipeline):
+    """Pool initializer: keep the inherited pipeline for this worker process"""
+    global _WORKER_PIPELINE
+    _WORKER_PIPELINE = pipeline
+
+
+def _classify_chunk(chunk: List[str]) -> np.ndarray:
+    """
+    Classify one chunk of reads inside a worker, returning its records array
+
+    The parent rewraps it with its own species and lineage tables, so they
+    are not pickled back with every chunk.
+    """
+    return _WORKER_PIPELINE.identify_species_records(chunk).records
+
+
+def default_worker_count() -> int:
+    """Number of worker processes to use when none is configured"""
+    return os.cpu_count() or 1
+
+
+def classify_chunks_parallel(pipeline, chunks: Iterable[List[str]], workers: Optional[int] = None,
+                             max_pending: Optional[int] = None) -> Iterator:
+    """
+    Classify chunks of reads in a process pool, yielding results in input order
+
+    Args:
+        pipeline: Loaded EDNAMLPipeline shared with the workers
+        chunks: Iterable of read chunks, consumed lazily
+        workers: Number of worker processes (defaults to all cores)
+        max_pending: Chunks allowed in flight at once (defaults to 2 per worker)
+
+    Returns:
+        Generator of per-chunk ResultBatch objects in the same order as the input chunks
+    """
+    workers = workers or default_worker_count()
+    max_pending = max_pending or workers * 2
+
+    # fork lets workers share the parent's reference arrays copy-on-write;
+    # elsewhere the pipeline is pickled to each worker once at start-up
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    context = multiprocessing.get_context(method)
+
+    species_names = pipeline.reference_taxa["species_names"]
+    taxonomy, lineage = pipeline.taxonomy_hierarchy, pipeline.lineage_table
+
+    with context.Pool(workers, initializer=_init_worker, initargs=(pipeline,)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_classify_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                yield ResultBatch(pending.popleft().get(), species_names, taxonomy, lineage)
+
+        while pending:
+            yield ResultBatch(pending.popleft().get(), species_names, taxonomy, lineage)
@@ -0,0 +1,448 @@
+"""
+Persistent worker service for the EDNA biodiversity pipeline
+Keeps one warmed EDNAMLPipeline resident, pulls analysis jobs from a SQLite
+queue (status in pipeline_runs, payload and progress in pipeline_jobs) and
+runs several at once from an asyncio loop over a process pool. A small JSON
+HTTP API lets the ml-pipeline route enqueue jobs and poll their progress.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from database_setup import create_pipeline_run_tables
+from diversity import DiversityAccumulator
+from ml_pipeline import get_shared_pipeline
+from quality_filter import QualityFilter
+from sequence_io import SequenceFileReader
+
+# Share of the progress bar reserved for classification; the rest is set-up and reporting
+CLASSIFY_PROGRESS = (5.0, 95.0)
+
+# Client-chosen run ids end up in report file names, so keep them to a safe alphabet
+RUN_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class JobQueue:
+    """SQLite-backed FIFO of pipeline jobs, safe to share between processes"""
+
+    def __init__(self, db_path: str = "edna_biodiversity.db"):
+        self.db_path = db_path
+        self._conn = None
+        self._conn_pid = None
+        with self._connection() as conn:
+            create_pipeline_run_tables(conn.cursor())
+
+    def _connection(self) -> sqlite3.Connection:
+        """Per-process connection in autocommit mode (transactions are explicit)"""
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def enqueue(self, payload: Dict, run_id: Optional[str] = None) -> str:
+        """Add a job in the queued state and return its run id"""
+        run_id = run_id or f"ML_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        if not isinstance(run_id, str) or not RUN_ID_PATTERN.fullmatch(run_id):
+            raise ValueError("run_id must be 1-64 letters, digits, '_' or '-'")
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute('''
+                INSERT INTO pipeline_runs (run_id, status, input_samples) VALUES (?, 'queued', ?)
+            ''', (run_id, payload.get("sample_id")))
+            conn.execute('''
+                INSERT INTO pipeline_jobs (run_id, payload, current_step) VALUES (?, ?, 'Queued')
+            ''', (run_id, json.dumps(payload)))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return run_id
+
+    def claim(self) -> Optional[Dict]:
+        """Atomically move the oldest queued job to running and return it (None if the queue is empty)"""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute('''
+                SELECT j.run_id, j.payload FROM pipeline_jobs j
+                JOIN pipeline_runs r ON r.run_id = j.run_id
+                WHERE r.status = 'queued' ORDER BY j.id LIMIT 1
+            ''').fetchone()
+            if row is not None:
+                conn.execute('''
+                    UPDATE pipeline_runs SET status = 'running', start_time = ? WHERE run_id = ?
+                ''', (datetime.now().isoformat(), row["run_id"]))
+                self._set_progress(conn, row["run_id"], CLASSIFY_PROGRESS[0], "Starting")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return {"run_id": row["run_id"], "payload": json.loads(row["payload"])} if row else None
+
+    def requeue_interrupted(self) -> int:
+        """Put jobs left running by a worker that died back in the queue; returns how many"""
+        conn = self._connection()
+        cursor = conn.execute('''
+            UPDATE pipeline_runs SET status = 'queued', start_time = NULL
+            WHERE status = 'running' AND run_id IN (SELECT run_id FROM pipeline_jobs)
+        ''')
+        return cursor.rowcount
+
+    def _set_progress(self, conn: sqlite3.Connection, run_id: str, progress: float, step: str,
+                      reads_processed: Optional[int] = None):
+        conn.execute('''
+            UPDATE pipeline_jobs
+            SET progress = ?, current_step = ?, reads_processed = COALESCE(?, reads_processed),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE run_id = ?
+        ''', (progress, step, reads_processed, run_id))
+
+    def update_progress(self, run_id: str, progress: float, step: str, reads_processed: Optional[int] = None):
+        self._set_progress(self._connection(), run_id, progress, step, reads_processed)
+
+    def complete(self, run_id: str, report_id: str, report_path: str, processing_seconds: float):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''
+            UPDATE pipeline_runs
+            SET status = 'completed', end_time = ?, output_report_id = ?, processing_time_seconds = ?
+            WHERE run_id = ?
+        ''', (datetime.now().isoformat(), report_id, processing_seconds, run_id))
+        conn.execute('UPDATE pipeline_jobs SET report_path = ? WHERE run_id = ?', (report_path, run_id))
+        self._set_progress(conn, run_id, 100.0, "Analysis complete")
+        conn.execute("COMMIT")
+
+    def fail(self, run_id: str, error_message: str, processing_seconds: float):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute('''
+            UPDATE pipeline_runs
+            SET status = 'failed', end_time = ?, error_message = ?, processing_time_seconds = ?
+            WHERE run_id = ?
+        ''', (datetime.now().isoformat(), error_message, processing_seconds, run_id))
+        conn.execute('''
+            UPDATE pipeline_jobs SET current_step = 'Failed', updated_at = CURRENT_TIMESTAMP WHERE run_id = ?
+        ''', (run_id,))
+        conn.execute("COMMIT")
+
+    def status(self, run_id: str) -> Optional[Dict]:
+        """Status and progress of one job in the shape the API route returns"""
+        row = self._connection().execute('''
+            SELECT r.run_id, r.status, r.start_time, r.end_time, r.input_samples, r.output_report_id,
+                   r.error_message, r.processing_time_seconds,
+                   j.progress, j.current_step, j.reads_processed, j.report_path
+            FROM pipeline_runs r JOIN pipeline_jobs j ON j.run_id = r.run_id
+            WHERE r.run_id = ?
+        ''', (run_id,)).fetchone()
+        if row is None:
+            return None
+
+        return {
+            "runId": row["run_id"],
+            "sampleId": row["input_samples"],
+            "status": row["status"],
+            "progress": round(row["progress"] or 0, 1),
+            "currentStep": row["current_step"],
+            "readsProcessed": row["reads_processed"],
+            "startTime": row["start_time"],
+            "endTime": row["end_time"],
+            "reportId": row["output_report_id"],
+            "reportPath": row["report_path"],
+            "processingTimeSeconds": row["processing_time_seconds"],
+            "error": row["error_message"]
+        }
+
+    def counts(self) -> Dict[str, int]:
+        """Number of queue jobs per status"""
+        rows = self._connection().execute('''
+            SELECT r.status, COUNT(*) FROM pipeline_runs r JOIN pipeline_jobs j ON j.run_id = r.run_id
+            GROUP BY r.status
+        ''').fetchall()
+        return {status: count for status, count in rows}
+
+
+# Set in each executor process by the pool initializer
+_JOB_QUEUE: Optional[JobQueue] = None
+
+
+def _init_job_process(db_path: str, pipeline_options: Dict):
+    """Pool initializer: open the queue and make sure the shared pipeline is warm"""
+    global _JOB_QUEUE
+    _JOB_QUEUE = JobQueue(db_path)
+    # Under fork this is the parent's already-warm instance; otherwise it loads once per process
+    get_shared_pipeline(**pipeline_options)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def run_job(run_id: str, payload: Dict, report_dir: str) -> Dict:
+    """
+    Run one queued job to completion inside an executor process
+
+    Payload keys: sample_id, sequence_files (FASTA/FASTQ paths, plain or gzip)
+    and optional options (batch_size, dereplicate, quality_filter).
+    Progress is written to the queue as batches complete, at most twice a second,
+    advancing through each file's share of the bar as the file is consumed.
+    """
+    queue = _JOB_QUEUE
+    pipeline = get_shared_pipeline()
+    options = payload.get("options") or {}
+    files: List[str] = payload.get("sequence_files") or []
+    started = time.perf_counter()
+
+    try:
+        if not files:
+            raise ValueError("Job has no sequence files")
+
+        accumulator = DiversityAccumulator()
+        quality_filter = QualityFilter() if options.get("quality_filter") else None
+        low, high = CLASSIFY_PROGRESS
+        analysis = None
+
+        dereplicate = options.get("dereplicate", False)
+        for file_number, path in enumerate(files):
+            step = f"Classifying {os.path.basename(path)} ({file_number + 1}/{len(files)})"
+            reader = SequenceFileReader(path)
+            reads_before = accumulator.total_sequences
+            queue.update_progress(run_id, low + (high - low) * file_number / len(files), step)
+            last_update = time.monotonic()
+
+            def report_reads(reads: int):
+                nonlocal last_update
+                if time.monotonic() - last_update >= 0.5:
+                    # Dereplication reads the whole file up front, so follow the classified
+                    # (abundance-weighted) reads instead of the bytes read
+                    if dereplicate:
+                        done = min((reads - reads_before) / max(reader.records_read, 1), 1.0)
+                    else:
+                        done = reader.fraction_read
+                    queue.update_progress(run_id, low + (high - low) * (file_number + done) / len(files), step, reads)
+                    last_update = time.monotonic()
+
+            analysis = pipeline.analyze_biodiversity(
+                reader, batch_size=options.get("batch_size", 1000), keep_results=False, dereplicate=dereplicate,
+                quality_filter=quality_filter, accumulator=accumulator, progress=report_reads
+            )
+
+        queue.update_progress(run_id, high, "Generating report", accumulator.total_sequences)
+        os.makedirs(report_dir, exist_ok=True)
+        report_path = os.path.join(report_dir, f"{run_id}.json")
+        report = pipeline.write_streaming_report(analysis, report_path)
+
+        queue.complete(run_id, report["report_id"], report_path, time.perf_counter() - started)
+        return {"run_id": run_id, "status": "completed", "report_path": report_path}
+    except Exception as error:
+        queue.fail(run_id, f"{type(error).__name__}: {error}", time.perf_counter() - started)
+        return {"run_id": run_id, "status": "failed", "error": str(error)}
+
+
+class PipelineWorker:
+    """asyncio scheduler that keeps up to `concurrency` jobs running in a warm process pool"""
+
+    def __init__(self, db_path: str = "edna_biodiversity.db", concurrency: int = 2,
+                 report_dir: str = "reports", poll_interval: float = 1.0,
+                 pipeline_options: Optional[Dict] = None, upload_root: str = "uploads"):
+        self.db_path = db_path
+        self.concurrency = concurrency
+        self.report_dir = report_dir
+        self.upload_root = os.path.realpath(upload_root)
+        self.poll_interval = poll_interval
+        self.pipeline_options = pipeline_options or {}
+        self.queue = JobQueue(db_path)
+        self.running: Dict[str, asyncio.Task] = {}
+        self._executor: Optional[Executor] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def start_executor(self) -> Dict:
+        """Warm the pipeline, then fork the pool so every process inherits the loaded references"""
+        warmup = get_shared_pipeline(**self.pipeline_options).warmup()
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        self._executor = ProcessPoolExecutor(
+            self.concurrency, mp_context=multiprocessing.get_context(method),
+            initializer=_init_job_process, initargs=(self.db_path, self.pipeline_options)
+        )
+        # Start the processes now, before the event loop and its threads exist
+        for future in [self._executor.submit(_ping) for _ in range(self.concurrency)]:
+            future.result()
+        return warmup
+
+    def resolve_upload(self, path: str) -> str:
+        """Map a payload file path onto the upload root, rejecting anything outside it"""
+        if not isinstance(path, str) or not path:
+            raise ValueError("sequence_files must be a list of paths")
+        resolved = os.path.realpath(os.path.join(self.upload_root, path.lstrip("/")))
+        if os.path.commonpath([self.upload_root, resolved]) != self.upload_root:
+            raise ValueError(f"Sequence file is outside the upload directory: {path}")
+        return resolved
+
+    def submit(self, payload: Dict, run_id: Optional[str] = None) -> str:
+        """Enqueue a job and wake the scheduler; file paths are resolved under upload_root"""
+        files = payload.get("sequence_files") or []
+        if not isinstance(files, list):
+            raise ValueError("sequence_files must be a list of paths")
+        payload["sequence_files"] = [self.resolve_upload(path) for path in files]
+        run_id = self.queue.enqueue(payload, run_id)
+        if self._wake is not None:
+            self._wake.set()
+        return run_id
+
+    async def run(self):
+        """Claim and run jobs until stop() is called"""
+        if self._executor is None:
+            self.start_executor()
+        self._wake = asyncio.Event()
+        requeued = self.queue.requeue_interrupted()
+        if requeued:
+            print(f"Requeued {requeued} interrupted job(s)")
+
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            while len(self.running) < self.concurrency:
+                job = self.queue.claim()
+                if job is None:
+                    break
+                task = loop.run_in_executor(self._executor, run_job, job["run_id"], job["payload"], self.report_dir)
+                self.running[job["run_id"]] = task
+                task.add_done_callback(lambda _, run_id=job["run_id"]: self._job_done(run_id))
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+        if self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+        self._executor.shutdown()
+
+    def _job_done(self, run_id: str):
+        self.running.pop(run_id, None)
+        self._wake.set()
+
+    def stop(self):
+        self._stopping = True
+        if self._wake is not None:
+            self._wake.set()
+
+    def health(self) -> Dict:
+        pipeline = get_shared_pipeline(warm=False)
+        return {
+            "status": "ok",
+            "warm": pipeline.is_warm,
+            "concurrency": self.concurrency,
+            "running": list(self.running),
+            "jobs": self.queue.counts()
+        }
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Minimal JSON API: POST /jobs enqueues (body is the job payload, optional
+        run_id), GET /jobs/<run_id> returns progress, GET /health reports state
+        """
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+
+            method, path = (request_line + ["", ""])[:2]
+            status, response = self._route(method, path.split("?")[0], body)
+        except (ValueError, KeyError) as error:
+            status, response = 400, {"error": str(error)}
+        except (sqlite3.Error, OSError) as error:
+            status, response = 500, {"error": f"{type(error).__name__}: {error}"}
+        except asyncio.IncompleteReadError:
+            writer.close()
+            return
+
+        payload = json.dumps(response, default=str).encode("utf-8")
+        reason = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found",
+                  500: "Internal Server Error"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+        writer.close()
+
+    def _route(self, method: str, path: str, body: bytes):
+        if method == "GET" and path == "/health":
+            return 200, self.health()
+
+        if method == "POST" and path == "/jobs":
+            payload = json.loads(body or b"{}")
+            if not payload.get("sample_id"):
+                raise ValueError("sample_id is required")
+            run_id = self.submit(payload, payload.pop("run_id", None))
+            return 202, self.queue.status(run_id)
+
+        if method == "GET" and path.startswith("/jobs/"):
+            status = self.queue.status(path[len("/jobs/"):])
+            return (200, status) if status else (404, {"error": "Unknown run id"})
+
+        return 404, {"error": f"No route for {method} {path}"}
+
+
+async def serve(worker: PipelineWorker, host: str = "127.0.0.1", port: int = 8765):
+    """Run the scheduler and the HTTP API until cancelled"""
+    server = await asyncio.start_server(worker.handle_http, host, port)
+    print(f"Pipeline worker listening on http://{host}:{port} ({worker.concurrency} concurrent jobs)")
+    async with server:
+        try:
+            await worker.run()
+        finally:
+            worker.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the EDNA pipeline worker service")
+    parser.add_argument("--db", default="edna_biodiversity.db", help="SQLite database holding the job queue")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", type=int, default=2, help="Jobs run at the same time")
+    parser.add_argument("--report-dir", default="reports")
+    parser.add_argument("--upload-root", default="uploads",
+                        help="Directory job sequence_files are resolved in; paths outside it are rejected")
+    parser.add_argument("--reference-store", help="Memory-mapped reference store built by reference_store.py")
+    parser.add_argument("--index-path", help="Persisted k-mer index")
+    parser.add_argument("--cache-path", help="On-disk classification cache")
+    parser.add_argument("--classifier", default="ungapped", choices=["ungapped", "two_stage"])
+    args = parser.parse_args()
+
+    pipeline_options = {"classifier": args.classifier}
+    if args.reference_store:
+        pipeline_options["reference_store_path"] = args.reference_store
+    if args.index_path:
+        pipeline_options["index_path"] = args.index_path
+    if args.cache_path:
+        pipeline_options["cache_path"] = args.cache_path
+
+    worker = PipelineWorker(args.db, concurrency=args.concurrency, report_dir=args.report_dir,
+                            pipeline_options=pipeline_options, upload_root=args.upload_root)
+    warmup = worker.start_executor()
+    print(f"Pipeline warmed in {warmup['total_seconds']:.2f}s")
+    try:
+        asyncio.run(serve(worker, args.host, args.port))
+    except KeyboardInterrupt:
+        print("Pipeline worker stopped")
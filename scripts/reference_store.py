@@ -0,0 +1,181 @@
+"""
+Compact reference store for the EDNA biodiversity pipeline
+Compiles the reference_taxonomy table into a packed binary file (2-bit base
+codes, offsets and integer taxon ids) that the pipeline memory-maps at startup
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import sys
+from datetime import datetime
+from typing import Dict, List
+
+import numpy as np
+
+from similarity_engine import BASE_CODES
+
+MAGIC = b"EDNAREF1"
+ALIGNMENT = 8
+RANKS = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+# 2-bit codes back to bases
+CODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def build_reference_store(db_path: str, output_path: str, default_confidence: float = 0.9) -> Dict:
+    """
+    Compile reference_taxonomy into a packed reference store file
+
+    Args:
+        db_path: SQLite database created by database_setup.py
+        output_path: Destination of the binary store
+        default_confidence: Reference confidence recorded for every sequence
+
+    Returns:
+        Header dictionary written to the store
+    """
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''
+        SELECT species_name, kingdom, phylum, class, order_name, family, genus, species,
+               ncbi_taxid, reference_sequence
+        FROM reference_taxonomy
+        WHERE reference_sequence IS NOT NULL AND reference_sequence != ''
+        ORDER BY id
+    ''').fetchall()
+    conn.close()
+
+    taxa: List[Dict] = []
+    taxon_ids: Dict[str, int] = {}
+    sequences: List[bytes] = []
+    sequence_taxa: List[int] = []
+    digest = hashlib.sha1()
+
+    for species_name, kingdom, phylum, class_name, order_name, family, genus, species, ncbi_taxid, ref_seq in rows:
+        clean_seq = re.sub(r'[^ATCG]', '', ref_seq.upper())
+        if not clean_seq:
+            continue
+
+        if species_name not in taxon_ids:
+            taxon_ids[species_name] = len(taxa)
+            taxa.append({
+                "species_name": species_name,
+                "ncbi_taxid": ncbi_taxid,
+                "lineage": dict(zip(RANKS, [kingdom, phylum, class_name, order_name, family, genus, species]))
+            })
+
+        sequences.append(clean_seq.encode("ascii"))
+        sequence_taxa.append(taxon_ids[species_name])
+        digest.update(species_name.encode() + b"\0" + clean_seq.encode() + b"\n")
+
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    codes = BASE_CODES[np.frombuffer(b"".join(sequences), dtype=np.uint8)]
+    taxon_array = np.array(sequence_taxa, dtype=np.int32)
+    confidence = np.full(len(sequences), default_confidence, dtype=np.float64)
+
+    sections = [("offsets", offsets), ("taxon_ids", taxon_array), ("confidence", confidence), ("codes", codes)]
+    header = {
+        "version": f"sqlite-{digest.hexdigest()[:12]}",
+        "built_at": datetime.now().isoformat(),
+        "total_sequences": len(sequences),
+        "total_bases": int(offsets[-1]),
+        "taxa": taxa,
+        "sections": {}
+    }
+
+    # Section positions depend on the header size, so lay out until it is stable
+    header_size = 0
+    while True:
+        position = _align(len(MAGIC) + 8 + header_size)
+        for name, array in sections:
+            header["sections"][name] = {"offset": position, "dtype": array.dtype.str, "count": int(array.size)}
+            position = _align(position + array.nbytes)
+        header_bytes = json.dumps(header).encode()
+        if len(header_bytes) == header_size:
+            break
+        header_size = len(header_bytes)
+
+    with open(output_path, "wb") as handle:
+        handle.write(MAGIC)
+        handle.write(np.uint64(len(header_bytes)).tobytes())
+        handle.write(header_bytes)
+        for name, array in sections:
+            handle.write(b"\0" * (header["sections"][name]["offset"] - handle.tell()))
+            handle.write(array.tobytes())
+
+    return header
+
+
+class ReferenceStore:
+    """Read-only, memory-mapped view of a packed reference store"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._buffer = np.memmap(path, dtype=np.uint8, mode="r")
+
+        if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"Not an EDNA reference store: {path}")
+
+        header_len = int(self._buffer[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(bytes(self._buffer[header_start:header_start + header_len]))
+
+        self.offsets = self._section("offsets")
+        self.taxon_ids = self._section("taxon_ids")
+        self.confidence = self._section("confidence")
+        self.codes = self._section("codes")
+        self.taxa = self.header["taxa"]
+
+    def _section(self, name: str) -> np.ndarray:
+        """Zero-copy array view of one section of the mapped file"""
+        info = self.header["sections"][name]
+        dtype = np.dtype(info["dtype"])
+        start = info["offset"]
+        return self._buffer[start:start + info["count"] * dtype.itemsize].view(dtype)
+
+    @property
+    def version(self) -> str:
+        return self.header["version"]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return self.header["total_sequences"]
+
+    def sequence(self, ref_id: int) -> str:
+        """Decode one reference sequence"""
+        start, stop = self.offsets[ref_id], self.offsets[ref_id + 1]
+        return CODE_BASES[self.codes[start:stop]].tobytes().decode("ascii")
+
+    def sequences(self) -> List[str]:
+        """Decode every reference sequence in one pass"""
+        text = CODE_BASES[self.codes].tobytes().decode("ascii")
+        offsets = self.offsets.tolist()
+        return [text[offsets[i]:offsets[i + 1]] for i in range(len(self))]
+
+    def species(self, ref_id: int) -> str:
+        return self.taxa[int(self.taxon_ids[ref_id])]["species_name"]
+
+    def taxonomy_hierarchy(self) -> Dict[str, Dict]:
+        """Species name -> lineage mapping in the pipeline's taxonomy format"""
+        return {taxon["species_name"]: dict(taxon["lineage"]) for taxon in self.taxa}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python reference_store.py <edna_biodiversity.db> <output.bin>")
+        sys.exit(1)
+
+    header = build_reference_store(sys.argv[1], sys.argv[2])
+    print(f"Reference store written to {sys.argv[2]}")
+    print(f"  Version: {header['version']}")
+    print(f"  Sequences: {header['total_sequences']} ({header['total_bases']} bases, {len(header['taxa'])} taxa)")
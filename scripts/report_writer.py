@@ -0,0 +1,83 @@
+"""
+Streaming report output for the EDNA biodiversity pipeline
+Spills per-read results to a JSON Lines side file (optionally gzip) so report
+size and memory stay constant, and pages back through it lazily
+"""
+
+import gzip
+import json
+from itertools import islice
+from typing import Dict, IO, Iterable, Iterator, List, Optional
+
+
+def _is_gzip_path(path: str) -> bool:
+    return path.endswith(".gz")
+
+
+class ResultsWriter:
+    """Append-only JSON Lines writer for per-read results"""
+
+    def __init__(self, path: str, compress: Optional[bool] = None):
+        self.path = path
+        self.compress = _is_gzip_path(path) if compress is None else compress
+        self.count = 0
+        self._handle: Optional[IO[str]] = None
+
+    def __enter__(self) -> "ResultsWriter":
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def open(self):
+        """Open (and truncate) the side file"""
+        if self.compress:
+            self._handle = gzip.open(self.path, "wt", encoding="utf-8", compresslevel=6)
+        else:
+            self._handle = open(self.path, "w", encoding="utf-8")
+        self.count = 0
+
+    def write(self, result: Dict):
+        """Write one result as a single JSON line"""
+        self._handle.write(json.dumps(result, separators=(",", ":"), default=float))
+        self._handle.write("\n")
+        self.count += 1
+
+    def write_many(self, results: Iterable[Dict]):
+        for result in results:
+            self.write(result)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def reference(self) -> Dict:
+        """Description of the side file for embedding in a report"""
+        return {
+            "path": self.path,
+            "format": "jsonl",
+            "compression": "gzip" if self.compress else None,
+            "count": self.count
+        }
+
+
+def iter_results(path: str) -> Iterator[Dict]:
+    """Lazily yield results from a JSON Lines side file"""
+    opener = gzip.open if _is_gzip_path(path) else open
+    with opener(path, "rt", encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_results_page(path: str, offset: int = 0, limit: int = 100) -> List[Dict]:
+    """Read one page of results without loading the rest of the file"""
+    return list(islice(iter_results(path), offset, offset + limit))
+
+
+def write_report(report: Dict, report_path: str):
+    """Write the (already side-filed) report summary as JSON"""
+    with open(report_path, "w", encoding="utf-8") as handle:
+        json.dump(report, handle, indent=2, default=float)
@@ -0,0 +1,189 @@
+"""
+Compact identification results for the EDNA biodiversity pipeline
+Stores batch results in a NumPy structured array (status code, taxon id,
+assigned rank and node, scores, length) and only builds the per-read dict
+format on demand
+"""
+
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from taxonomy import LineageTable, NO_TAXON, RANK_INDEX, RANKS, SPECIES_RANK
+
+STATUS_IDENTIFIED = 0
+STATUS_UNKNOWN = 1
+STATUS_LOW_QUALITY = 2
+# Hits were ambiguous between species; the read is assigned to their common ancestor
+STATUS_HIGHER_TAXON = 3
+
+STATUS_NAMES = ("identified", "unknown", "low_quality", "higher_taxon")
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+STATUS_MESSAGES = {
+    STATUS_UNKNOWN: "No reliable match found in reference database",
+    STATUS_LOW_QUALITY: "Sequence quality too low for reliable identification"
+}
+
+RESULT_DTYPE = np.dtype([
+    ("status", np.uint8),
+    ("taxon_id", np.int32),
+    ("rank", np.int8),
+    ("node_id", np.int32),
+    ("strand", np.int8),
+    ("confidence", np.float64),
+    ("best_similarity", np.float64),
+    ("quality_score", np.float64),
+    ("gc_content", np.float64),
+    ("length", np.int32)
+])
+
+
+class ResultBatch:
+    """Array-backed identification results for a batch of reads"""
+
+    __slots__ = ("records", "species_names", "taxonomy", "lineage")
+
+    def __init__(self, records: np.ndarray, species_names: Sequence[str], taxonomy: Dict[str, Dict],
+                 lineage: Optional[LineageTable] = None):
+        self.records = records
+        self.species_names = species_names
+        self.taxonomy = taxonomy
+        self.lineage = lineage
+
+    @classmethod
+    def empty(cls, size: int, species_names: Sequence[str], taxonomy: Dict[str, Dict],
+              lineage: Optional[LineageTable] = None) -> "ResultBatch":
+        records = np.zeros(size, dtype=RESULT_DTYPE)
+        records["taxon_id"] = -1
+        records["rank"] = NO_TAXON
+        records["node_id"] = NO_TAXON
+        return cls(records, species_names, taxonomy, lineage)
+
+    @classmethod
+    def concatenate(cls, batches: Sequence["ResultBatch"]) -> "ResultBatch":
+        """Join batches that share the same species table"""
+        first = batches[0]
+        return cls(np.concatenate([batch.records for batch in batches]), first.species_names, first.taxonomy,
+                   first.lineage)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def take(self, indices: Sequence[int]) -> "ResultBatch":
+        """Rows at the given positions (e.g. expanding dereplicated results)"""
+        return ResultBatch(self.records[np.asarray(indices, dtype=np.int64)], self.species_names, self.taxonomy,
+                           self.lineage)
+
+    def set_from_dict(self, position: int, result: Dict, species_ids: Dict[str, int]):
+        """Fill one row from a result in the dict format"""
+        row = self.records[position]
+        row["status"] = STATUS_CODES[result["status"]]
+        row["strand"] = 1 if result.get("strand") == "-" else 0
+        row["quality_score"] = result["quality_score"]
+        if result["status"] == "identified":
+            row["taxon_id"] = species_ids[result["species"]]
+            row["rank"] = SPECIES_RANK
+            row["node_id"] = row["taxon_id"]
+            row["confidence"] = result["confidence"]
+            row["gc_content"] = result["gc_content"]
+            row["length"] = result["sequence_length"]
+        elif result["status"] == "higher_taxon":
+            rank = RANK_INDEX[result["rank"]]
+            row["rank"] = rank
+            row["node_id"] = self.lineage.find(rank, result["taxonomy"])
+            row["confidence"] = result["confidence"]
+            row["gc_content"] = result["gc_content"]
+            row["length"] = result["sequence_length"]
+        elif result["status"] == "unknown":
+            row["best_similarity"] = result["best_similarity"]
+
+    def to_dict(self, position: int) -> Dict:
+        """One row in the identify_species dict format"""
+        row = self.records[position]
+        status = int(row["status"])
+
+        if status == STATUS_UNKNOWN:
+            return {
+                "status": "unknown",
+                "message": STATUS_MESSAGES[STATUS_UNKNOWN],
+                "best_similarity": float(row["best_similarity"]),
+                "quality_score": float(row["quality_score"])
+            }
+        if status == STATUS_LOW_QUALITY:
+            return {
+                "status": "low_quality",
+                "message": STATUS_MESSAGES[STATUS_LOW_QUALITY],
+                "quality_score": float(row["quality_score"])
+            }
+
+        if status == STATUS_IDENTIFIED:
+            species = self.species_names[int(row["taxon_id"])]
+            result = {
+                "status": "identified",
+                "species": species,
+                "confidence": float(row["confidence"]),
+                "taxonomy": self.taxonomy.get(species, {}),
+                "quality_score": float(row["quality_score"]),
+                "sequence_length": int(row["length"]),
+                "gc_content": float(row["gc_content"])
+            }
+        else:
+            rank, node = int(row["rank"]), int(row["node_id"])
+            result = {
+                "status": "higher_taxon",
+                "rank": RANKS[rank],
+                "taxon": self.lineage.label(rank, node),
+                "confidence": float(row["confidence"]),
+                "taxonomy": self.lineage.lineage_dict(rank, node),
+                "quality_score": float(row["quality_score"]),
+                "sequence_length": int(row["length"]),
+                "gc_content": float(row["gc_content"])
+            }
+
+        # Reverse-strand matches are marked; forward ones keep the original format
+        if row["strand"]:
+            result["strand"] = "-"
+        return result
+
+    def iter_dicts(self) -> Iterator[Dict]:
+        for position in range(len(self.records)):
+            yield self.to_dict(position)
+
+    def to_dicts(self) -> List[Dict]:
+        """All rows in the dict format, for the report and API layer"""
+        return list(self.iter_dicts())
+
+    def species_totals(self, weights: Optional[np.ndarray] = None) -> List[tuple]:
+        """
+        (species, count) pairs for identified rows, in order of first appearance
+
+        Args:
+            weights: Optional per-row weights (e.g. dereplication abundances)
+        """
+        identified = self.records["status"] == STATUS_IDENTIFIED
+        taxon_ids = self.records["taxon_id"][identified].astype(np.int64)
+        if len(taxon_ids) == 0:
+            return []
+
+        row_weights = np.ones(len(taxon_ids), dtype=np.int64) if weights is None else \
+            np.asarray(weights, dtype=np.int64)[identified]
+        totals = np.bincount(taxon_ids, weights=row_weights)
+        unique_ids, first_seen = np.unique(taxon_ids, return_index=True)
+        ordered = unique_ids[np.argsort(first_seen)]
+        return [(self.species_names[taxon_id], int(totals[taxon_id])) for taxon_id in ordered.tolist()]
+
+    def rank_totals(self, rank: str, weights: Optional[np.ndarray] = None) -> List[tuple]:
+        """
+        (taxon, count) pairs at a rank (e.g. "genus"), in order of first appearance
+
+        Counts species-level and higher-taxon assignments at or below the rank;
+        needs the batch's lineage table.
+        """
+        return self.lineage.counts_at(self.records["rank"], self.records["node_id"], RANK_INDEX[rank], weights)
+
+    def status_totals(self, weights: Optional[np.ndarray] = None) -> Dict[str, int]:
+        """Weighted read count per status name"""
+        row_weights = None if weights is None else np.asarray(weights, dtype=np.int64)
+        counts = np.bincount(self.records["status"], weights=row_weights, minlength=len(STATUS_NAMES))
+        return {STATUS_NAMES[code]: int(count) for code, count in enumerate(counts) if count}
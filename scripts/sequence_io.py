@@ -0,0 +1,161 @@
+"""
+Streaming sequence file reader for the EDNA biodiversity pipeline
+Reads FASTA/FASTQ files, plain or gzip-compressed, one record at a time
+so whole sequencing runs never have to be held in memory
+"""
+
+import gzip
+import io
+import os
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, TextIO, TypeVar
+
+T = TypeVar("T")
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class SequenceRecord(NamedTuple):
+    """A single sequencing read (quality is None for FASTA input)"""
+    id: str
+    sequence: str
+    quality: Optional[str] = None
+
+
+def open_sequence_file(path: str) -> TextIO:
+    """Open a sequence file as text, transparently decompressing gzip input"""
+    with open(path, "rb") as probe:
+        magic = probe.read(2)
+
+    if magic == GZIP_MAGIC:
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="ascii", errors="replace")
+    return open(path, "r", encoding="ascii", errors="replace")
+
+
+def _read_fasta(handle: TextIO, first_line: str) -> Iterator[SequenceRecord]:
+    """Yield records from a FASTA stream positioned after its first header"""
+    record_id = first_line[1:].strip()
+    parts: List[str] = []
+
+    for line in handle:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(">"):
+            yield SequenceRecord(record_id, "".join(parts))
+            record_id, parts = line[1:].strip(), []
+        else:
+            parts.append(line)
+
+    yield SequenceRecord(record_id, "".join(parts))
+
+
+def _read_fastq(handle: TextIO, first_line: str) -> Iterator[SequenceRecord]:
+    """Yield records from a FASTQ stream positioned after its first header"""
+    header = first_line
+    while header:
+        header = header.strip()
+        if not header:
+            header = handle.readline()
+            continue
+        if not header.startswith("@"):
+            raise ValueError(f"Malformed FASTQ record header: {header[:50]}")
+
+        sequence = handle.readline().strip()
+        separator = handle.readline()
+        quality = handle.readline().strip()
+        if not separator.startswith("+") or len(quality) != len(sequence):
+            raise ValueError(f"Truncated or malformed FASTQ record: {header[:50]}")
+
+        yield SequenceRecord(header[1:], sequence, quality)
+        header = handle.readline()
+
+
+def read_sequences(path: str) -> Iterator[SequenceRecord]:
+    """
+    Stream records from a FASTA or FASTQ file
+
+    Args:
+        path: Path to a .fasta/.fa/.fastq/.fq file, optionally gzip-compressed
+
+    Returns:
+        Generator of SequenceRecord, format detected from the first record
+    """
+    with open_sequence_file(path) as handle:
+        yield from _read_records(handle, path)
+
+
+def _read_records(handle: TextIO, path: str) -> Iterator[SequenceRecord]:
+    """Yield records from a text stream, detecting FASTA or FASTQ from its first record"""
+    first_line = handle.readline()
+    while first_line and not first_line.strip():
+        first_line = handle.readline()
+
+    if not first_line:
+        return
+    if first_line.startswith(">"):
+        yield from _read_fasta(handle, first_line)
+    elif first_line.startswith("@"):
+        yield from _read_fastq(handle, first_line)
+    else:
+        raise ValueError(f"Unrecognised sequence file format: {path}")
+
+
+class SequenceFileReader:
+    """
+    Re-iterable record stream over one sequence file that reports how far it has read
+
+    Progress is measured on the file as stored (compressed bytes for gzip input),
+    so it can drive a progress bar without a separate counting pass
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.records_read = 0
+        self._raw: Optional[BinaryIO] = None
+        self._finished = False
+
+    def __iter__(self) -> Iterator[SequenceRecord]:
+        self.records_read = 0
+        self._finished = False
+        with open(self.path, "rb") as raw:
+            magic = raw.read(2)
+            raw.seek(0)
+            stream: BinaryIO = gzip.GzipFile(fileobj=raw, mode="rb") if magic == GZIP_MAGIC else raw
+            self._raw = raw
+            try:
+                with io.TextIOWrapper(stream, encoding="ascii", errors="replace") as handle:
+                    for record in _read_records(handle, self.path):
+                        self.records_read += 1
+                        yield record
+                self._finished = True
+            finally:
+                self._raw = None
+
+    @property
+    def fraction_read(self) -> float:
+        """Share of the file consumed so far, 1.0 once iteration has finished"""
+        if self._finished or not self.size:
+            return 1.0
+        if self._raw is None or self._raw.closed:
+            return 0.0
+        return min(self._raw.tell() / self.size, 1.0)
+
+
+def chunked(items: Iterable[T], chunk_size: int) -> Iterator[List[T]]:
+    """Group any iterable into lists of at most chunk_size items"""
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_sequence_chunks(path: str, chunk_size: int = 10000) -> Iterator[List[SequenceRecord]]:
+    """Stream records from a sequence file in bounded-size chunks"""
+    return chunked(read_sequences(path), chunk_size)
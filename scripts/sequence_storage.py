@@ -0,0 +1,304 @@
+"""
+Packed sequence storage for the EDNA biodiversity pipeline
+Keeps each distinct read once in sequence_blobs as a 2-bit packed BLOB keyed
+by its SHA-1 content hash, with sequences rows pointing at it and carrying an
+abundance. Helpers decode packed rows transparently (also as an SQL
+function), and a migration converts databases that store raw TEXT.
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from database_setup import create_analysis_tables, create_summary_tables, recover_interrupted_load
+from similarity_engine import BASE_CODES
+
+# 2-bit codes back to bases
+CODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+# Packing weights of the four 2-bit codes in one byte, first base in the high bits
+_SHIFTS = np.array([64, 16, 4, 1], dtype=np.uint8)
+
+
+def content_hash(sequence: str) -> bytes:
+    """SHA-1 digest identifying a sequence's exact content"""
+    return hashlib.sha1(sequence.encode("ascii")).digest()
+
+
+def pack_sequence(sequence: str) -> Tuple[bytes, Optional[str]]:
+    """
+    Pack a sequence into 2 bits per base
+
+    Characters other than upper-case ACGT (N, IUPAC codes, lower case) are
+    packed as A and recorded as exceptions, so unpacking is lossless.
+
+    Returns:
+        Tuple of (packed bytes, exceptions as JSON [[start, "run"], ...] or None)
+    """
+    raw = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+    codes = BASE_CODES[raw]
+    unknown = codes == 255
+
+    exceptions = None
+    if unknown.any():
+        positions = np.flatnonzero(unknown)
+        # Group consecutive positions into runs
+        run_starts = positions[np.r_[True, np.diff(positions) > 1]]
+        run_ends = positions[np.r_[np.diff(positions) > 1, True]] + 1
+        exceptions = json.dumps([[int(start), sequence[start:end]]
+                                 for start, end in zip(run_starts.tolist(), run_ends.tolist())],
+                                separators=(",", ":"))
+        codes = np.where(unknown, 0, codes)
+
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    return (padded.reshape(-1, 4) * _SHIFTS).sum(axis=1, dtype=np.uint8).tobytes(), exceptions
+
+
+def unpack_sequence(packed: bytes, length: int, exceptions: Optional[str] = None) -> str:
+    """Inverse of pack_sequence"""
+    data = np.frombuffer(packed, dtype=np.uint8)
+    codes = (data[:, None] // _SHIFTS) & 3
+    sequence = CODE_BASES[codes.reshape(-1)[:length]].tobytes().decode("ascii")
+    if exceptions:
+        chars = list(sequence)
+        for start, run in json.loads(exceptions):
+            chars[start:start + len(run)] = run
+        sequence = "".join(chars)
+    return sequence
+
+
+def connect(db_path: str = "edna_biodiversity.db", **options) -> sqlite3.Connection:
+    """
+    Open the pipeline database with unpack_sequence(packed, length, exceptions)
+    registered as an SQL function, first repairing what an interrupted bulk load left
+    """
+    recover_interrupted_load(db_path)
+    conn = sqlite3.connect(db_path, **options)
+    conn.create_function("unpack_sequence", 3, _sql_unpack, deterministic=True)
+    return conn
+
+
+def _sql_unpack(packed: Optional[bytes], length: Optional[int], exceptions: Optional[str]) -> Optional[str]:
+    if packed is None:
+        return None
+    return unpack_sequence(packed, length, exceptions)
+
+
+# Sequence text of a sequences row s joined to its blob b, whichever storage it uses
+SEQUENCE_TEXT_SQL = "COALESCE(s.sequence_data, unpack_sequence(b.packed_sequence, b.sequence_length, b.exceptions))"
+
+
+def get_sequence(conn: sqlite3.Connection, sequence_id: int) -> Optional[str]:
+    """Sequence text of one sequences row, decoding packed storage (conn from connect())"""
+    row = conn.execute(f'''
+        SELECT {SEQUENCE_TEXT_SQL} FROM sequences s
+        LEFT JOIN sequence_blobs b ON b.id = s.blob_id
+        WHERE s.id = ?
+    ''', (sequence_id,)).fetchone()
+    return row[0] if row else None
+
+
+def iter_sample_sequences(conn: sqlite3.Connection, sample_id: str,
+                          expand: bool = False) -> Iterator[Tuple[int, str, int]]:
+    """
+    (sequences id, sequence, abundance) of every row of a sample, in either storage
+
+    Args:
+        conn: Connection from connect()
+        sample_id: Sample to read
+        expand: Yield abundance-many copies with abundance 1 instead
+    """
+    cursor = conn.execute(f'''
+        SELECT s.id, {SEQUENCE_TEXT_SQL}, COALESCE(s.abundance, 1) FROM sequences s
+        LEFT JOIN sequence_blobs b ON b.id = s.blob_id
+        WHERE s.sample_id = ? ORDER BY s.id
+    ''', (sample_id,))
+    for sequence_id, sequence, abundance in cursor:
+        if expand:
+            for _ in range(abundance):
+                yield sequence_id, sequence, 1
+        else:
+            yield sequence_id, sequence, abundance
+
+
+class BlobWriter:
+    """
+    Interns sequences into sequence_blobs within a write transaction
+
+    Known hashes are cached, unknown ones are looked up in bulk and new blobs
+    get explicit ids, so callers can reference them before they are flushed.
+    """
+
+    # Bound parameters per lookup query (SQLite's default limit is 999 on old builds)
+    LOOKUP_CHUNK = 900
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.ids: Dict[bytes, int] = {}
+        self.pending: List[Tuple] = []
+        self.next_id = self.last_id() + 1
+        self.blobs_written = 0
+        self.packed_bytes = 0
+
+    def last_id(self) -> int:
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM sequence_blobs").fetchone()[0]
+
+    def intern(self, sequences: List[str]) -> List[int]:
+        """Blob id of every sequence, queueing blobs for the ones not stored yet"""
+        hashes = [content_hash(sequence) for sequence in sequences]
+        unseen = list({digest for digest in hashes if digest not in self.ids})
+        for start in range(0, len(unseen), self.LOOKUP_CHUNK):
+            chunk = unseen[start:start + self.LOOKUP_CHUNK]
+            self.ids.update(self.conn.execute(f'''
+                SELECT content_hash, id FROM sequence_blobs WHERE content_hash IN ({", ".join("?" * len(chunk))})
+            ''', chunk).fetchall())
+
+        blob_ids = []
+        for sequence, digest in zip(sequences, hashes):
+            blob_id = self.ids.get(digest)
+            if blob_id is None:
+                packed, exceptions = pack_sequence(sequence)
+                blob_id = self.ids[digest] = self.next_id
+                self.next_id += 1
+                self.pending.append((blob_id, digest, len(sequence), packed, exceptions))
+                self.packed_bytes += len(packed)
+            blob_ids.append(blob_id)
+        return blob_ids
+
+    def flush(self):
+        if self.pending:
+            self.conn.executemany('''
+                INSERT INTO sequence_blobs (id, content_hash, sequence_length, packed_sequence, exceptions)
+                VALUES (?, ?, ?, ?, ?)
+            ''', self.pending)
+            self.blobs_written += len(self.pending)
+            self.pending.clear()
+
+    def resync(self):
+        """Continue after another writer may have added blobs (call at the start of a transaction)"""
+        self.next_id = max(self.next_id, self.last_id() + 1)
+
+
+def migrate_sequence_storage(db_path: str = "edna_biodiversity.db", batch_size: int = 10000,
+                             vacuum: bool = True) -> Dict:
+    """
+    Convert a database storing raw TEXT sequences to packed, content-hashed storage
+
+    Rebuilds the sequences table with a nullable sequence_data plus blob_id
+    and abundance (ids are kept, so identifications stay attached), moving
+    every TEXT sequence into sequence_blobs. Identical reads share one blob.
+    Safe to rerun: rows already packed are left alone.
+
+    Args:
+        db_path: Pipeline database
+        batch_size: Rows converted per executemany
+        vacuum: Run VACUUM afterwards so the freed pages are returned to the filesystem
+
+    Returns:
+        Dictionary of converted rows, unique blobs and timing
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA foreign_keys=OFF")
+    converted = 0
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(sequences)")}
+        if columns and "blob_id" not in columns:
+            indexes = conn.execute('''
+                SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'sequences' AND sql IS NOT NULL
+            ''').fetchall()
+            # Legacy rename leaves species_identifications' foreign key naming "sequences"
+            conn.execute("PRAGMA legacy_alter_table=ON")
+            conn.execute("ALTER TABLE sequences RENAME TO sequences_text")
+            conn.execute("PRAGMA legacy_alter_table=OFF")
+            for (name,) in conn.execute('''
+                SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'sequences_text' AND sql IS NOT NULL
+            ''').fetchall():
+                conn.execute(f'DROP INDEX "{name}"')
+            create_analysis_tables(conn.cursor())
+            source = "sequences_text"
+        else:
+            create_analysis_tables(conn.cursor())
+            source = None
+
+        blobs = BlobWriter(conn)
+        if source:
+            cursor = conn.execute(f'''
+                SELECT id, sample_id, sequence_data, sequence_length, gc_content, quality_score, primer_used,
+                       sequencing_platform, created_at
+                FROM {source} ORDER BY id
+            ''')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                blob_ids = blobs.intern([row[2] for row in rows])
+                blobs.flush()
+                conn.executemany('''
+                    INSERT INTO sequences (id, sample_id, sequence_data, sequence_length, gc_content, quality_score,
+                                           primer_used, sequencing_platform, created_at, blob_id, abundance)
+                    VALUES (?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, 1)
+                ''', [row[:2] + row[3:] + (blob_id,) for row, blob_id in zip(rows, blob_ids)])
+                converted += len(rows)
+            conn.execute(f"DROP TABLE {source}")
+            # Custom indexes of the old table come back; the standard ones were recreated with the table
+            existing = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            for name, sql in indexes:
+                if name not in existing:
+                    conn.execute(sql)
+            # Summary triggers now weight by the new abundance column
+            create_summary_tables(conn.cursor(), replace_triggers=True)
+        else:
+            # Rows loaded as TEXT into an already migrated schema
+            while True:
+                rows = conn.execute('''
+                    SELECT id, sequence_data FROM sequences
+                    WHERE blob_id IS NULL AND sequence_data IS NOT NULL LIMIT ?
+                ''', (batch_size,)).fetchall()
+                if not rows:
+                    break
+                blob_ids = blobs.intern([sequence for _, sequence in rows])
+                blobs.flush()
+                conn.executemany('''
+                    UPDATE sequences SET blob_id = ?, sequence_data = NULL, abundance = COALESCE(abundance, 1)
+                    WHERE id = ?
+                ''', [(blob_id, sequence_id) for (sequence_id, _), blob_id in zip(rows, blob_ids)])
+                converted += len(rows)
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        conn.close()
+        raise
+
+    if vacuum and converted:
+        conn.execute("VACUUM")
+    conn.close()
+
+    return {
+        "converted_rows": converted,
+        "new_blobs": blobs.blobs_written,
+        "packed_bytes": blobs.packed_bytes,
+        "seconds": time.perf_counter() - started
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Packed sequence storage for the EDNA pipeline database")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--db", default="edna_biodiversity.db")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--no-vacuum", action="store_true")
+    args = parser.parse_args()
+
+    stats = migrate_sequence_storage(args.db, batch_size=args.batch_size, vacuum=not args.no_vacuum)
+    print(f"Converted {stats['converted_rows']} sequences into {stats['new_blobs']} packed blobs "
+          f"({stats['packed_bytes']} bytes) in {stats['seconds']:.1f}s")
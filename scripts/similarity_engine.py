@@ -0,0 +1,278 @@
+"""
+Vectorized sequence similarity engine for the EDNA biodiversity pipeline
+Encodes reads and references as 2-bit base codes in uint8 arrays and scores
+whole batches of reads against blocks of references with NumPy
+"""
+
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
+
+from alignment import alignment_identity
+
+# A/C/G/T map to 2-bit codes 0-3; anything else is treated as padding
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    BASE_CODES[_base] = _code
+
+# Reads and references are padded with different values so padding never matches
+READ_PAD = 4
+REFERENCE_PAD = 5
+
+
+def encode_sequences(sequences: Sequence[str], pad: int = READ_PAD) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode cleaned sequences into a padded 2-bit code matrix
+
+    Args:
+        sequences: Cleaned (ACGT-only) sequences
+        pad: Code written past the end of each sequence
+
+    Returns:
+        Tuple of (codes, lengths) with codes shaped (n, max_length)
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    width = int(lengths.max()) if len(sequences) else 0
+    codes = np.full((len(sequences), width), pad, dtype=np.uint8)
+
+    for row, seq in enumerate(sequences):
+        if seq:
+            raw = np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+            encoded = BASE_CODES[raw]
+            codes[row, :len(seq)] = np.where(encoded == 255, pad, encoded)
+
+    return codes, lengths
+
+
+def encode_flat(sequences: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode sequences back to back as 2-bit codes, without padding
+
+    Returns:
+        Tuple of (codes, offsets): uint8 codes of all sequences joined (255 for
+        non-ACGT characters) and the start of every sequence plus the total length
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    codes = BASE_CODES[np.frombuffer("".join(sequences).encode("ascii"), dtype=np.uint8)]
+    return codes, offsets
+
+
+def similarity_matrix(read_codes: np.ndarray, read_lengths: np.ndarray,
+                      ref_codes: np.ndarray, ref_lengths: np.ndarray) -> np.ndarray:
+    """
+    Score every read against every reference
+
+    Similarity is the fraction of matching positions over the shorter of the
+    two sequences, the same measure the pipeline has always used.
+    """
+    width = min(read_codes.shape[1], ref_codes.shape[1])
+    matches = (read_codes[:, None, :width] == ref_codes[None, :, :width]).sum(axis=2)
+    min_len = np.minimum(read_lengths[:, None], ref_lengths[None, :])
+
+    similarity = np.zeros(matches.shape, dtype=np.float64)
+    np.divide(matches, min_len, out=similarity, where=min_len > 0)
+    return similarity
+
+
+def pair_similarity(read_codes: np.ndarray, read_lengths: np.ndarray,
+                    ref_codes: np.ndarray, ref_lengths: np.ndarray) -> np.ndarray:
+    """similarity_matrix for aligned pairs: row i of the reads against row i of the references only"""
+    width = min(read_codes.shape[1], ref_codes.shape[1])
+    matches = (read_codes[:, :width] == ref_codes[:, :width]).sum(axis=1)
+    min_len = np.minimum(read_lengths, ref_lengths)
+
+    similarity = np.zeros(len(matches), dtype=np.float64)
+    np.divide(matches, min_len, out=similarity, where=min_len > 0)
+    return similarity
+
+
+class SimilarityEngine:
+    """
+    Batch similarity scoring of reads against an encoded reference set
+
+    References are held flat (codes back to back plus offsets, see
+    encode_flat), so a memory-mapped reference store can be scored in place;
+    padded rows are only gathered for the references a block needs.
+    """
+
+    def __init__(self, references: Sequence[str], max_block_elements: int = 1 << 24):
+        self.ref_codes, self.ref_offsets = encode_flat(references)
+        self.ref_lengths = np.diff(self.ref_offsets)
+        self.max_block_elements = max_block_elements
+
+    @classmethod
+    def from_encoded(cls, ref_codes: np.ndarray, ref_offsets: np.ndarray,
+                     max_block_elements: int = 1 << 24) -> "SimilarityEngine":
+        """Build an engine over references that are already flat encoded (e.g. reference store arrays)"""
+        engine = cls([], max_block_elements=max_block_elements)
+        engine.ref_codes, engine.ref_offsets = ref_codes, ref_offsets
+        engine.ref_lengths = np.diff(ref_offsets)
+        return engine
+
+    def reference_codes(self, ref_ids: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Padded (n, max_length) code matrix and lengths of the given references (all by default)"""
+        ref_ids = np.arange(len(self.ref_lengths)) if ref_ids is None else np.asarray(ref_ids, dtype=np.int64)
+        lengths = self.ref_lengths[ref_ids]
+        width = int(lengths.max()) if len(ref_ids) else 0
+        columns = np.arange(width)
+        inside = columns[None, :] < lengths[:, None]
+        codes = np.full(inside.shape, REFERENCE_PAD, dtype=np.uint8)
+        codes[inside] = self.ref_codes[(self.ref_offsets[ref_ids][:, None] + columns[None, :])[inside]]
+        # Non-ACGT reference bases must never match a read
+        codes[codes > 3] = REFERENCE_PAD
+        return codes, lengths
+
+    def score(self, reads: Sequence[str], ref_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Return the (reads x references) similarity matrix, optionally for a reference subset"""
+        read_codes, read_lengths = encode_sequences(reads)
+        return self._score_encoded(read_codes, read_lengths, ref_ids)
+
+    def _score_encoded(self, read_codes: np.ndarray, read_lengths: np.ndarray,
+                       ref_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Score pre-encoded reads, splitting them into blocks to bound memory"""
+        ref_codes, ref_lengths = self.reference_codes(ref_ids)
+
+        n_reads, n_refs = len(read_lengths), len(ref_lengths)
+        similarity = np.zeros((n_reads, n_refs), dtype=np.float64)
+        if n_reads == 0 or n_refs == 0:
+            return similarity
+
+        width = max(1, min(read_codes.shape[1], ref_codes.shape[1]))
+        block = max(1, self.max_block_elements // (n_refs * width))
+        for start in range(0, n_reads, block):
+            stop = start + block
+            similarity[start:stop] = similarity_matrix(
+                read_codes[start:stop], read_lengths[start:stop], ref_codes, ref_lengths
+            )
+
+        return similarity
+
+    def best_hits(self, reads: Sequence[str], candidates: Optional[List[List[int]]] = None,
+                  max_pairs: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the best-scoring reference for each read
+
+        Args:
+            reads: Cleaned read sequences
+            candidates: Optional per-read candidate reference ids; a read is
+                only scored against its own candidates, in blocks of at most
+                max_pairs (read, candidate) pairs
+
+        Returns:
+            Tuple of (best reference id, best similarity); reads without any
+            positive-scoring candidate get id -1 and similarity 0.0
+        """
+        if candidates is not None:
+            pair_refs, similarity = self._pair_identity(reads, candidates, 0, "ungapped", max_pairs)
+            return _best_pairs(candidates, pair_refs, similarity)
+
+        n_reads = len(reads)
+        best_ids = np.full(n_reads, -1, dtype=np.int64)
+        best_scores = np.zeros(n_reads, dtype=np.float64)
+        if n_reads == 0 or len(self.ref_lengths) == 0:
+            return best_ids, best_scores
+
+        # argmax keeps the first (lowest id) reference among ties, like a sequential scan
+        similarity = self.score(reads)
+        best_cols = similarity.argmax(axis=1)
+        top = similarity[np.arange(n_reads), best_cols]
+        hit = top > 0
+        best_ids[hit] = best_cols[hit]
+        best_scores[hit] = top[hit]
+        return best_ids, best_scores
+
+    def candidate_scores(self, reads: Sequence[str], candidates: List[List[int]],
+                         max_pairs: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ungapped similarity of every read against each of its candidates
+
+        Only the listed (read, candidate) pairs are scored, max_pairs at a time,
+        so the cost follows the candidate count rather than reads x distinct candidates.
+
+        Returns:
+            Tuple of (candidate ids, similarities), both shaped (reads, max
+            candidates) in candidate order; padding columns have id -1 and score -1.0
+        """
+        ref_ids, scores = _padded_candidates(candidates)
+        valid = ref_ids >= 0
+        scores[valid] = self._pair_identity(reads, candidates, 0, "ungapped", max_pairs)[1]
+        return ref_ids, scores
+
+    def aligned_candidate_scores(self, reads: Sequence[str], candidates: List[List[int]], band: int = 16,
+                                 mode: str = "semi_global", max_pairs: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+        """Banded alignment identity of every read against each of its candidates, laid out like candidate_scores"""
+        ref_ids, scores = _padded_candidates(candidates)
+        valid = ref_ids >= 0
+        scores[valid] = self._pair_identity(reads, candidates, band, mode, max_pairs)[1]
+        return ref_ids, scores
+
+    def _pair_identity(self, reads: Sequence[str], candidates: List[List[int]], band: int, mode: str,
+                       max_pairs: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Identity of every (read, candidate) pair in read-major order, with the pair's reference ids
+
+        mode "ungapped" scores pairs position by position (pair_similarity);
+        alignment modes use banded alignment identity.
+        """
+        read_codes, read_lengths = encode_sequences(reads)
+        counts = np.array([len(row) for row in candidates], dtype=np.int64)
+        pair_reads = np.repeat(np.arange(len(reads)), counts)
+        pair_refs = np.array([ref_id for row in candidates for ref_id in row], dtype=np.int64)
+
+        identity = np.zeros(len(pair_reads), dtype=np.float64)
+        for start in range(0, len(pair_reads), max_pairs):
+            block_reads = pair_reads[start:start + max_pairs]
+            block_refs = pair_refs[start:start + max_pairs]
+            block_args = (read_codes[block_reads], read_lengths[block_reads], *self.reference_codes(block_refs))
+            if mode == "ungapped":
+                identity[start:start + max_pairs] = pair_similarity(*block_args)
+            else:
+                identity[start:start + max_pairs] = alignment_identity(*block_args, band=band, mode=mode)
+        return pair_refs, identity
+
+    def aligned_best_hits(self, reads: Sequence[str], candidates: List[List[int]], band: int = 16,
+                          mode: str = "semi_global", max_pairs: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the best reference per read by banded alignment against its candidates only
+
+        All (read, candidate) pairs of the batch are aligned together in blocks
+        of at most max_pairs pairs.
+
+        Returns:
+            Tuple of (best reference id, best alignment identity), with the same
+            conventions as best_hits
+        """
+        pair_refs, identity = self._pair_identity(reads, candidates, band, mode, max_pairs)
+        return _best_pairs(candidates, pair_refs, identity)
+
+
+def _best_pairs(candidates: List[List[int]], pair_refs: np.ndarray,
+                scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Best (reference id, score) per read from read-major pair scores
+
+    Ties go to the lowest reference id, like a sequential scan; reads whose
+    best score is not positive get id -1 and score 0.0.
+    """
+    counts = np.array([len(row) for row in candidates], dtype=np.int64)
+    best_ids = np.full(len(counts), -1, dtype=np.int64)
+    best_scores = np.zeros(len(counts), dtype=np.float64)
+
+    pair_reads = np.repeat(np.arange(len(counts)), counts)
+    order = np.lexsort((pair_refs, -scores, pair_reads))
+    rows = np.flatnonzero(counts)
+    best = order[(np.cumsum(counts) - counts)[rows]]
+    hit = scores[best] > 0
+    best_ids[rows[hit]] = pair_refs[best[hit]]
+    best_scores[rows[hit]] = scores[best[hit]]
+    return best_ids, best_scores
+
+
+def _padded_candidates(candidates: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Ragged candidate lists as a (reads, max candidates) id matrix padded with -1, plus a matching score matrix"""
+    counts = np.array([len(row) for row in candidates], dtype=np.int64)
+    width = int(counts.max()) if len(candidates) else 0
+    ref_ids = np.full((len(candidates), width), -1, dtype=np.int64)
+    ref_ids[np.arange(width)[None, :] < counts[:, None]] = [ref_id for row in candidates for ref_id in row]
+    return ref_ids, np.full(ref_ids.shape, -1.0, dtype=np.float64)
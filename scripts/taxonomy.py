@@ -0,0 +1,148 @@
+"""
+Integer-encoded taxonomy for the EDNA biodiversity pipeline
+Compiles the species -> lineage dicts into one int32 node-id array per rank
+so lowest-common-ancestor assignment and rank-level aggregation run as NumPy
+operations over whole batches instead of string comparisons
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+RANKS = ("kingdom", "phylum", "class", "order", "family", "genus", "species")
+RANK_INDEX = {rank: depth for depth, rank in enumerate(RANKS)}
+SPECIES_RANK = RANK_INDEX["species"]
+
+# Node id of a rank that is missing from a lineage
+NO_TAXON = -1
+
+
+class LineageTable:
+    """
+    Per-rank integer lineages of the reference species
+
+    Nodes are interned by their full path from the kingdom down, so equal ids
+    at one rank imply equal ids at every rank above it. Species-rank node ids
+    are the pipeline's species (taxon) ids.
+    """
+
+    def __init__(self, species_names: Sequence[str], taxonomy: Dict[str, Dict]):
+        self.species_names = list(species_names)
+        self.lineages = np.full((len(self.species_names), len(RANKS)), NO_TAXON, dtype=np.int32)
+        # names[rank][node] is the node's label; _node_ids[rank] maps label paths to node ids
+        self.names: List[List[str]] = [[] for _ in RANKS]
+        self._node_ids: List[Dict[Tuple, int]] = [{} for _ in RANKS]
+        ancestor_rows: List[List[np.ndarray]] = [[] for _ in RANKS]
+
+        for species_id, species in enumerate(self.species_names):
+            lineage = taxonomy.get(species, {})
+            path: Tuple = ()
+            for depth, rank in enumerate(RANKS[:-1]):
+                label = lineage.get(rank)
+                if not label:
+                    # Unknown rank: the species only keeps the ranks above the gap
+                    break
+                path += (label,)
+                node = self._node_ids[depth].get(path)
+                if node is None:
+                    node = self._node_ids[depth][path] = len(self.names[depth])
+                    self.names[depth].append(label)
+                    ancestor_rows[depth].append(self.lineages[species_id].copy())
+                self.lineages[species_id, depth] = node
+                ancestor_rows[depth][node][depth] = node
+
+            self.lineages[species_id, SPECIES_RANK] = species_id
+            self.names[SPECIES_RANK].append(species)
+            self._node_ids[SPECIES_RANK][(species,)] = species_id
+            ancestor_rows[SPECIES_RANK].append(self.lineages[species_id].copy())
+
+        # ancestors[rank] has shape (nodes at rank, len(RANKS)): the node ids of each node's lineage
+        self.ancestors = [
+            np.array(rows, dtype=np.int32).reshape(len(rows), len(RANKS)) for rows in ancestor_rows
+        ]
+
+    def __len__(self) -> int:
+        return len(self.species_names)
+
+    def lca(self, taxon_ids: np.ndarray, valid: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Lowest common ancestor of every row of hits
+
+        Args:
+            taxon_ids: Species ids of the hits per read, shape (reads, hits)
+            valid: Which hits take part, shape (reads, hits); defaults to all
+
+        Returns:
+            Tuple of (rank index, node id at that rank) per read; reads with no
+            valid hit or whose hits disagree at kingdom level get NO_TAXON for both
+        """
+        taxon_ids = np.asarray(taxon_ids, dtype=np.int64)
+        valid = np.ones(taxon_ids.shape, dtype=bool) if valid is None else valid
+        n_reads = len(taxon_ids)
+        if taxon_ids.shape[1] == 0:
+            return np.full(n_reads, NO_TAXON, dtype=np.int8), np.full(n_reads, NO_TAXON, dtype=np.int32)
+        has_hit = valid.any(axis=1)
+
+        lineages = self.lineages[np.where(valid, taxon_ids, 0)]
+        first = lineages[np.arange(n_reads), valid.argmax(axis=1)]
+        agrees = ((lineages == first[:, None, :]) | ~valid[:, :, None]).all(axis=1)
+        agrees &= (first != NO_TAXON) & has_hit[:, None]
+
+        # Path interning makes agreement at a rank imply agreement at every known rank
+        # above it, so the LCA is simply the deepest agreeing rank
+        depth = np.where(agrees.any(axis=1), len(RANKS) - 1 - agrees[:, ::-1].argmax(axis=1), NO_TAXON)
+        nodes = np.where(depth >= 0, first[np.arange(n_reads), np.maximum(depth, 0)], NO_TAXON)
+        return depth.astype(np.int8), nodes.astype(np.int32)
+
+    def ancestor(self, ranks: np.ndarray, nodes: np.ndarray, rank: int) -> np.ndarray:
+        """
+        Node id at `rank` of each (rank, node) assignment
+
+        Assignments shallower than `rank` (or unassigned) get NO_TAXON.
+        """
+        ranks = np.asarray(ranks)
+        nodes = np.asarray(nodes)
+        result = np.full(len(nodes), NO_TAXON, dtype=np.int32)
+        for depth in np.unique(ranks[ranks >= rank]).tolist():
+            rows = ranks == depth
+            result[rows] = self.ancestors[depth][nodes[rows], rank]
+        return result
+
+    def label(self, rank: int, node: int) -> str:
+        return self.names[rank][node]
+
+    def lineage_dict(self, rank: int, node: int) -> Dict[str, str]:
+        """Lineage of a node in the taxonomy dict format, down to its own rank"""
+        path = self.ancestors[rank][node]
+        return {
+            RANKS[depth]: self.names[depth][path[depth]] for depth in range(rank + 1) if path[depth] != NO_TAXON
+        }
+
+    def find(self, rank: int, lineage: Dict[str, str]) -> Optional[int]:
+        """Node id of the node a lineage dict ends in at `rank` (None if unknown)"""
+        if rank == SPECIES_RANK:
+            return self._node_ids[rank].get((lineage.get("species"),))
+        return self._node_ids[rank].get(tuple(lineage.get(RANKS[depth]) for depth in range(rank + 1)))
+
+    def counts_at(self, ranks: np.ndarray, nodes: np.ndarray, rank: int,
+                  weights: Optional[np.ndarray] = None) -> List[Tuple[str, int]]:
+        """
+        (label, count) per node at `rank`, in order of first appearance
+
+        Args:
+            ranks, nodes: Assignment rank and node id of every read
+            rank: Rank index to aggregate at
+            weights: Optional per-read weights
+        """
+        at_rank = self.ancestor(ranks, nodes, rank)
+        assigned = at_rank != NO_TAXON
+        node_ids = at_rank[assigned].astype(np.int64)
+        if len(node_ids) == 0:
+            return []
+
+        row_weights = np.ones(len(node_ids), dtype=np.int64) if weights is None else \
+            np.asarray(weights, dtype=np.int64)[assigned]
+        totals = np.bincount(node_ids, weights=row_weights)
+        unique_ids, first_seen = np.unique(node_ids, return_index=True)
+        ordered = unique_ids[np.argsort(first_seen)]
+        return [(self.names[rank][node], int(totals[node])) for node in ordered.tolist()]